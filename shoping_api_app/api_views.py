@@ -1,20 +1,31 @@
 from rest_framework.generics import ListAPIView, CreateAPIView, DestroyAPIView, RetrieveUpdateDestroyAPIView, RetrieveAPIView
 from django_filters.rest_framework import DjangoFilterBackend
-from rest_framework.filters import SearchFilter
-from rest_framework.pagination import LimitOffsetPagination
+from rest_framework import status
 from rest_framework.exceptions import ValidationError
+from django.conf import settings
+from django.http import StreamingHttpResponse
+from django.shortcuts import get_object_or_404
+from rest_framework.response import Response
+from rest_framework.views import APIView
 
-from .serializers import ProductSerializer
-from .models import Product
-
-
-class ProductsPagination(LimitOffsetPagination):
-    '''
-    Setting the default and maximum limit a client can request
-    for number of response objects on a single page.
-    '''
-    default_limit = 10
-    max_limit = 100
+from . import bulk
+from . import cache as product_cache
+from . import conditional
+from . import db
+from . import export
+from . import facets
+from . import guest_carts
+from . import outbox
+from .parsers import FastJSONParser, NDJSONParser
+from .filters import ProductFilter
+from .pagination import ProductsPagination, ProductsCursorPagination, positive_int
+from .search import ProductSearchFilter
+from .serializers import (CartItemQuantitySerializer, GuestCartCheckoutSerializer,
+                          GuestCartItemSerializer, GuestCartQuantitySerializer,
+                          ProductChangeSerializer, ProductSerializer,
+                          ShoppingCartItemSerializer, ShoppingCartSerializer,
+                          TopSellerSerializer)
+from .models import Product, ShoppingCart, ShoppingCartItem
 
 
 class ProductList(ListAPIView):
@@ -24,7 +35,8 @@ class ProductList(ListAPIView):
     are required to be returned.
     '''
 
-    queryset = Product.objects.all()
+    # 'stats' for the products' 'average_product_sold'.
+    queryset = Product.objects.select_related('stats')
     serializer_class = ProductSerializer
 
     # Need to add the feature of being able to
@@ -33,35 +45,131 @@ class ProductList(ListAPIView):
     # use ListAPIView. But, the only thing is that
     # we use a filter and search by 'id'. Hence, need to
     # write the code for so to happen.
-    filter_backends = (DjangoFilterBackend, SearchFilter)
+    # ProductFilter for '?on_sale=true' and price ranges.
+    filter_backends = (DjangoFilterBackend, ProductFilter, ProductSearchFilter)
     filter_fields = ('id',)
     # Below will enable search on the basis of name and
-    # description for client.
+    # description for client. Searches go through the full-text index
+    # where there is one, '?ordering=relevance' ranks the results.
     search_fields = ('name', 'description')
-    pagination_class = ProductsPagination
+
+    @property
+    def pagination_class(self):
+        # Limit/offset pages by default, keyset pages for clients walking
+        # through the whole catalog ('?pagination=cursor').
+        if ProductsCursorPagination.is_requested(self.request):
+            return ProductsCursorPagination
+        return ProductsPagination
 
     def get_queryset(self):
-        on_sale = self.request.query_params.get('on_sale', None)
-        # If on_sale is Not defined in the URL, i.e. in the case
-        # when client does not want results on the basis of
-        # on_sale or not.
-        # request.get_params() is the dictionary that is used to
-        # pull out data from URL query.
-        print(self.request.query_params.get('search'))
-        # If the client wants to see all the products :
-        if on_sale is None:
-            return super().get_queryset()
-        # If he/she mentioned on_sale=true in query:
-        else:
-            queryset = Product.objects.all()
-            if on_sale.lower() == 'true':
-                from django.utils import timezone
-                now = timezone.now()
-                return queryset.filter(
-                    sale_start__lte=now,
-                    sale_end__gte=now,
-                )
-            return queryset
+        queryset = super().get_queryset()
+        # Sorting by price goes by the stored effective price (see
+        # prices.py), through its index.
+        ordering = self.request.query_params.get('ordering', '')
+        if ordering.lstrip('-') == 'current_price':
+            prefix = '-' if ordering.startswith('-') else ''
+            queryset = queryset.order_by(prefix + 'effective_price', prefix + 'id')
+        return self.only_requested(queryset)
+
+    # Loaded whatever the fields asked for: the sale window for the
+    # cache timeouts, the prices for keyset pages ordered by them.
+    always_loaded = ('id', 'price', 'effective_price', 'sale_start', 'sale_end')
+
+    def get_fields(self):
+        '''
+        The fields of the products in the response, a compact set of
+        them unless others are asked for with '?fields=' or '?exclude='.
+        '''
+        return ProductSerializer.requested_fields(
+            self.request.query_params, ProductSerializer.compact_fields)
+
+    def only_requested(self, queryset):
+        '''
+        Loads only the columns (and relations) that the requested fields
+        are computed from, leaving out the description, say.
+        '''
+        fields = self.get_fields()
+        if 'average_product_sold' not in fields:
+            queryset = queryset.select_related(None)
+        return queryset.only(
+            *ProductSerializer.columns_for(fields).union(self.always_loaded))
+
+    def get_serializer(self, *args, **kwargs):
+        kwargs.setdefault('fields', self.get_fields())
+        return super().get_serializer(*args, **kwargs)
+
+    def list(self, request, *args, **kwargs):
+        '''
+        Same as ListAPIView.list(), except that pages are served from
+        the product cache when possible (a single worker rebuilding a
+        stale page at a time, see cache.py), and conditional GETs are
+        answered with a 304 when the page has not changed. Pages are
+        read from the replica, if there is one (see db.py).
+        '''
+        entry, versions = product_cache.get_list(request)
+        if entry is None:
+            try:
+                with db.replica_reads(product_cache.last_write()):
+                    queryset = self.filter_queryset(self.get_queryset())
+                    products = self.paginate_queryset(queryset)
+                    if products is not None:
+                        serializer = self.get_serializer(products, many=True)
+                        data = self.get_paginated_response(serializer.data).data
+                    else:
+                        products = list(queryset)
+                        data = self.get_serializer(products, many=True).data
+                    next_sale_change = None
+                    if ProductFilter().depends_on_sales(request):
+                        next_sale_change = Product.objects.next_sale_change()
+            except BaseException:
+                product_cache.release_list(request)
+                raise
+            entry = product_cache.set_list(request, products, data, versions,
+                                           next_sale_change)
+        # Clients that already have this page get a 304.
+        return conditional.respond(request, entry)
+
+
+class CatalogStats(APIView):
+    '''
+    Statistics of the products (see facets.py), of all of them or of
+    those the product list would hold given the same filters ('?search=',
+    '?on_sale=', '?min_price=', '?max_price='). '?buckets=' is the number
+    of ranges of the price histogram. Cached like the pages of
+    ProductList, until the next write or sale start or end (of the whole
+    catalog when filtering on sales or prices).
+    '''
+    filter_backends = (ProductFilter, ProductSearchFilter)
+    search_fields = ('name', 'description')
+    default_buckets = 10
+    max_buckets = 100
+
+    def get_buckets(self, request):
+        try:
+            return positive_int(request.query_params.get('buckets', self.default_buckets),
+                                strict=True, cutoff=self.max_buckets)
+        except ValueError:
+            raise ValidationError({'buckets': 'A positive integer is required.'})
+
+    def get(self, request, *args, **kwargs):
+        buckets = self.get_buckets(request)
+        entry, versions = product_cache.get_stats(request)
+        if entry is None:
+            try:
+                with db.replica_reads(product_cache.last_write()):
+                    queryset = Product.objects.all()
+                    for backend in self.filter_backends:
+                        queryset = backend().filter_queryset(request, queryset, self)
+                    data, boundaries = facets.compute(queryset, buckets)
+                    # As with the ProductList pages, a product filtered out
+                    # may count once the next sale of the catalog starts or ends.
+                    if ProductFilter().depends_on_sales(request):
+                        boundaries.append(Product.objects.next_sale_change())
+            except BaseException:
+                product_cache.release_stats(request)
+                raise
+            entry = product_cache.set_stats(request, data, boundaries, versions)
+        return conditional.respond(request, entry)
 
 
 class ProductCreate(CreateAPIView):
@@ -102,23 +210,13 @@ class ProductCreate(CreateAPIView):
 
 # First thing that should come to the mind when wanting to destroy a resource is using
 # DestroyAPIView.
+# The cached data of a deleted product is cleared by the signal handlers
+# in signals.py, so there is nothing more to do here.
 
 class ProductDestroy(DestroyAPIView):
     queryset = Product.objects.all()
     lookup_field = 'id'
 
-    # We want to clear the cache when deleting an object from,
-    # the Product Model so that the space can be used.
-    # We override the delete method and put the logic for clearing the cache
-    # for that particular product as well.
-    def delete(self, request, *args, **kwargs):
-        product_id = request.data.get('id')
-        response = super().delete(request, *args, **kwargs)
-        if response.status_code == 204:
-            from django.core.cache import cache
-            cache.delete(f'product_data_{product_id}')
-        return response
-
 
 class ProductRetrieveUpdateDestroy(RetrieveUpdateDestroyAPIView):
     '''
@@ -126,34 +224,316 @@ class ProductRetrieveUpdateDestroy(RetrieveUpdateDestroyAPIView):
     updated and deleted.
     '''
 
-    queryset = Product.objects.all()
+    queryset = Product.objects.select_related('stats')
     lookup_field = 'id'
 
     serializer_class = ProductSerializer
 
-    # We want to clear the cache when deleting an object from,
-    # the Product Model so that the space can be used.
-    # We override the delete method and put the logic for clearing the cache
-    # for that particular product as well.
+    # Retrieving goes through the product cache. Updating or deleting
+    # the product evicts it (see signals.py), so the next retrieve
+    # serializes it afresh (from the replica if there is one, see db.py).
+    # Clients that already have the product get a 304.
+    def retrieve(self, request, *args, **kwargs):
+        fields = ProductSerializer.requested_fields(request.query_params)
+        entry = product_cache.get_product(self.kwargs['id'])
+        if entry is None:
+            with db.replica_reads(product_cache.last_write()):
+                product = self.get_object()
+                data = self.get_serializer(product).data
+            entry = product_cache.set_product(product, data)
+        # '?fields=' and '?exclude=' are served from the whole product.
+        if fields != ProductSerializer.Meta.fields:
+            entry = product_cache.project(entry, fields)
+        return conditional.respond(request, entry)
+
+
+class TopSellers(ListAPIView):
+    '''
+    The products with the most items in shopping carts, best selling
+    first, read straight off the index of their statistics.
+    '''
+    queryset = (Product.objects.filter(stats__total_quantity__gt=0)
+                .select_related('stats')
+                .order_by('-stats__total_quantity', '-stats__product_id'))
+    serializer_class = TopSellerSerializer
+    pagination_class = ProductsPagination
+
+
+class ProductBatch(APIView):
+    '''
+    Reads many products in one request, by their ids ('?ids=3,1,2', at
+    most PRODUCT_BATCH_MAX_IDS of them), for clients that would otherwise
+    retrieve them one at a time. The products come in the order asked
+    for, from the product cache when it has them and from a single query
+    otherwise, and the ids of those that do not exist are listed under
+    'missing'. '?fields=' and '?exclude=' work as they do for one product.
+    '''
+
+    def get_ids(self, request):
+        values = ','.join(request.query_params.getlist('ids'))
+        try:
+            ids = [int(value) for value in values.split(',') if value.strip()]
+        except ValueError:
+            raise ValidationError({'ids': 'Expected comma separated product ids.'})
+        if not ids:
+            raise ValidationError({'ids': 'This parameter is required.'})
+        max_ids = getattr(settings, 'PRODUCT_BATCH_MAX_IDS', 200)
+        if len(ids) > max_ids:
+            raise ValidationError(
+                {'ids': 'Ask for at most {} products at a time.'.format(max_ids)})
+        return ids
+
+    def get(self, request, *args, **kwargs):
+        ids = self.get_ids(request)
+        fields = ProductSerializer.requested_fields(request.query_params)
+        entries = product_cache.get_products(set(ids))
+        uncached = set(ids) - entries.keys()
+        if uncached:
+            with db.replica_reads(product_cache.last_write()):
+                products = list(Product.objects.select_related('stats')
+                                .filter(id__in=uncached))
+                data = ProductSerializer(products, many=True,
+                                         context={'request': request}).data
+            entries.update(product_cache.set_products(products, data))
+
+        results, missing = [], []
+        for product_id in ids:
+            entry = entries.get(product_id)
+            if entry is None:
+                missing.append(product_id)
+            elif fields != ProductSerializer.Meta.fields:
+                results.append({name: value for name, value in entry['data'].items()
+                                if name in fields})
+            else:
+                results.append(entry['data'])
+        return Response({'results': results, 'missing': missing})
+
+
+class ProductBulk(APIView):
+    '''
+    Writes many products in one request, given as a JSON array or as
+    NDJSON (one product per line). POSTing creates the products without
+    an 'id' and updates the ones with one (only the fields given change);
+    DELETE takes the ids of the products to delete. Invalid rows are
+    reported by their index and do not stop the others from being written.
+    '''
+    parser_classes = (FastJSONParser, NDJSONParser)
+
+    def get_rows(self, request):
+        rows = request.data
+        if isinstance(rows, (dict, str)) or not hasattr(rows, '__iter__'):
+            raise ValidationError(
+                {'non_field_errors': 'Expected a list of products.'})
+        return rows
+
+    def post(self, request, *args, **kwargs):
+        return Response(bulk.write_products(self.get_rows(request)))
+
     def delete(self, request, *args, **kwargs):
-        product_id = request.data.get('id')
-        response = super().delete(request, *args, **kwargs)
-        if response.status_code == 204:
-            from django.core.cache import cache
-            cache.delete(f'product_data_{product_id}')
+        product_ids = list(self.get_rows(request))
+        # JSON's true and false are ints to Python.
+        if not all(isinstance(product_id, int) and not isinstance(product_id, bool)
+                   for product_id in product_ids):
+            raise ValidationError(
+                {'non_field_errors': 'Expected a list of product ids.'})
+        return Response(bulk.delete_products(product_ids))
+
+
+class ProductExport(APIView):
+    '''
+    Streams the whole catalog, as NDJSON by default or as CSV with
+    '?export_format=csv'. '?on_sale=true' exports only the products on
+    sale now.
+    '''
+
+    def get(self, request, *args, **kwargs):
+        export_format = request.query_params.get('export_format', 'ndjson')
+        if export_format not in export.FORMATS:
+            raise ValidationError({'export_format': 'Must be one of {}.'.format(
+                ', '.join(export.FORMATS))})
+        queryset = Product.objects.all()
+        if request.query_params.get('on_sale', '').lower() == 'true':
+            queryset = queryset.on_sale()
+        response = StreamingHttpResponse(
+            export.export_lines(export_format, queryset),
+            content_type=export.FORMATS[export_format])
+        response['Content-Disposition'] = (
+            'attachment; filename="products.{}"'.format(export_format))
         return response
 
-    # Overriding the default update() method, in order to
-    # update the cache of the product object which is updated.
-    def update(self, request, *args, **kwargs):
-        response = super().update(request, *args, **kwargs)
-        # If the product was successfully updated, then adding the
-        # updated cache or updating the cache.
-        if response.status_code == 204:
-            from django.core.cache import cache
-            product = response.data
-            cache.set('product_data_{}'.format(product['id']), {
-                      'name': product['name'],
-                      'description': product['description'],
-                      'price': product['price']})
+
+class ProductChanges(APIView):
+    '''
+    The change feed (see outbox.py): the changes after '?since=<seq>',
+    oldest first, up to '?limit=' of them. 'last' is the position to
+    ask from next time, and 'reset' tells that changes after 'since'
+    were pruned already, i.e. that everything may have changed.
+    '''
+    default_limit = 500
+    max_limit = 1000
+
+    def get_param(self, request, name, default, strict=False, cutoff=None):
+        try:
+            return positive_int(request.query_params.get(name, default),
+                                strict=strict, cutoff=cutoff)
+        except ValueError:
+            raise ValidationError({name: 'A positive integer is required.'})
+
+    def get(self, request, *args, **kwargs):
+        since = self.get_param(request, 'since', 0)
+        limit = self.get_param(request, 'limit', self.default_limit,
+                               strict=True, cutoff=self.max_limit)
+        changes, pruned = outbox.changes_since(since, limit)
+        return Response({
+            'changes': ProductChangeSerializer(changes, many=True).data,
+            'last': changes[-1].seq if changes else since,
+            'reset': pruned,
+        })
+
+
+class ProductCacheStats(APIView):
+    '''
+    Shows how often the product cache of this process was hit or missed.
+    '''
+
+    def get(self, request, *args, **kwargs):
+        return Response(product_cache.stats())
+
+
+class ShoppingCartCreate(CreateAPIView):
+    '''
+    This view/endpoint is so that the client
+    can create shopping carts.
+    '''
+    serializer_class = ShoppingCartSerializer
+
+
+class ShoppingCartRetrieve(RetrieveAPIView):
+    '''
+    Returns a shopping cart with its items, subtotal, taxes and total.
+    '''
+    queryset = ShoppingCart.objects.prefetch_related('items')
+    lookup_field = 'id'
+    serializer_class = ShoppingCartSerializer
+
+
+class ShoppingCartItemCreate(CreateAPIView):
+    '''
+    Adds a product to a shopping cart. Adding a product that is
+    already in the cart adds to the quantity of its item instead.
+    '''
+    serializer_class = ShoppingCartItemSerializer
+
+    def perform_create(self, serializer):
+        shopping_cart = get_object_or_404(ShoppingCart, id=self.kwargs['id'])
+        product = serializer.validated_data['product']
+        quantity = serializer.validated_data['quantity']
+        item = shopping_cart.items.filter(product=product).first()
+        if item is None:
+            serializer.save(shopping_cart=shopping_cart)
+            return
+        max_quantity = serializer.fields['quantity'].max_value
+        if item.quantity + quantity > max_quantity:
+            raise ValidationError({'quantity': (
+                'Cannot have more than {} of a product in the cart.'
+                .format(max_quantity))})
+        item.quantity += quantity
+        item.save()
+        serializer.instance = item
+
+
+class ShoppingCartItemUpdateDestroy(RetrieveUpdateDestroyAPIView):
+    '''
+    An item of a shopping cart, whose quantity can be updated
+    or which can be removed from the cart.
+    '''
+    lookup_field = 'id'
+    lookup_url_kwarg = 'item_id'
+    serializer_class = CartItemQuantitySerializer
+
+    def get_queryset(self):
+        return ShoppingCartItem.objects.filter(shopping_cart_id=self.kwargs['id'])
+
+
+class GuestCartCreate(APIView):
+    '''
+    Starts a guest cart, kept in the cache rather than in the database
+    until it is checked out (see guest_carts.py). Its token, in the
+    response and in the 'guest_cart' cookie, is the one to use with its
+    other endpoints.
+    '''
+
+    def post(self, request, *args, **kwargs):
+        cart = guest_carts.create()
+        response = Response(guest_carts.represent(cart), status=status.HTTP_201_CREATED)
+        response.set_cookie(guest_carts.COOKIE_NAME, cart['token'],
+                            max_age=guest_carts.get_timeout(),
+                            httponly=True, samesite='Lax')
         return response
+
+
+class GuestCartRetrieve(APIView):
+    '''
+    Returns a guest cart with its items, subtotal, taxes and total, or
+    the id of its shopping cart once it was checked out.
+    '''
+
+    def get(self, request, token, *args, **kwargs):
+        return Response(guest_carts.represent(guest_carts.get(token)))
+
+
+class GuestCartItemCreate(APIView):
+    '''
+    Adds a product to a guest cart. Adding a product that is already
+    in the cart adds to its quantity instead.
+    '''
+
+    def post(self, request, token, *args, **kwargs):
+        serializer = GuestCartItemSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        cart = guest_carts.add(token, serializer.validated_data['product'].id,
+                               serializer.validated_data['quantity'],
+                               serializer.fields['quantity'].max_value)
+        return Response(guest_carts.represent(cart), status=status.HTTP_201_CREATED)
+
+
+class GuestCartItemUpdateDestroy(APIView):
+    '''
+    A product of a guest cart, whose quantity can be updated or which
+    can be removed from the cart.
+    '''
+
+    def put(self, request, token, product_id, *args, **kwargs):
+        serializer = GuestCartQuantitySerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        cart = guest_carts.set_quantity(token, product_id,
+                                        serializer.validated_data['quantity'])
+        return Response(guest_carts.represent(cart))
+
+    patch = put
+
+    def delete(self, request, token, product_id, *args, **kwargs):
+        guest_carts.remove(token, product_id)
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
+
+class GuestCartCheckout(APIView):
+    '''
+    Checks a guest cart out, given the name and address to ship to: it
+    becomes a shopping cart, returned as such. When checkouts are
+    deferred (GUEST_CART_DEFERRED_CHECKOUT) the cart is only queued, and
+    the response is the guest cart, whose shopping cart shows up in it
+    once written. A 409 means the cart was being changed or written
+    already (its user logging in, say).
+    '''
+
+    def post(self, request, token, *args, **kwargs):
+        serializer = GuestCartCheckoutSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        shopping_cart = guest_carts.checkout(token, **serializer.validated_data)
+        if shopping_cart is None:
+            return Response(guest_carts.represent(guest_carts.get(token)),
+                            status=status.HTTP_202_ACCEPTED)
+        shopping_cart = ShoppingCart.objects.prefetch_related('items').get(id=shopping_cart.id)
+        return Response(ShoppingCartSerializer(shopping_cart).data,
+                        status=status.HTTP_201_CREATED)
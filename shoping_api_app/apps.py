@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class ShopingApiAppConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'shoping_api_app'
+
+    def ready(self):
+        # Connecting the signal handlers (cache invalidation etc.).
+        from . import signals  # noqa: F401
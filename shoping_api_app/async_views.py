@@ -0,0 +1,121 @@
+'''
+Async versions of the product reads, for deployments running under ASGI
+(see ASYNC_PRODUCT_READS in settings). They go through Django's async ORM
+so a slow client waiting on its response does not hold on to a worker
+thread, and answer exactly like their sync counterparts in api_views.py.
+
+Anything other than the plain reads (writes, keyset pages) is handed over
+to the sync views.
+'''
+from asgiref.sync import sync_to_async
+from django.http import HttpResponse, HttpResponseNotAllowed
+from rest_framework.exceptions import ValidationError
+from rest_framework.request import Request
+
+from . import cache as product_cache
+from . import conditional
+from . import db
+from .api_views import ProductList, ProductRetrieveUpdateDestroy
+from .filters import ProductFilter
+from .models import Product
+from .pagination import ProductsCursorPagination
+from .renderers import dumps
+from .serializers import ProductSerializer, acart_data_for
+
+
+sync_product_list = ProductList.as_view()
+sync_product_detail = ProductRetrieveUpdateDestroy.as_view()
+
+
+def render(data):
+    return HttpResponse(dumps(data),
+                        content_type='application/json')
+
+
+async def product_list(request):
+    if request.method != 'GET':
+        if request.method == 'HEAD':
+            return await sync_to_async(sync_product_list)(request)
+        return HttpResponseNotAllowed(['GET', 'HEAD'])
+    drf_request = Request(request)
+    if ProductsCursorPagination.is_requested(drf_request):
+        return await sync_to_async(sync_product_list)(request)
+
+    entry, versions = await sync_to_async(product_cache.get_list)(request)
+    if entry is not None:
+        return conditional.respond(request, entry, render)
+
+    last_write = await sync_to_async(product_cache.last_write)()
+    try:
+        with db.replica_reads(last_write):
+            return await _product_list(request, drf_request, versions)
+    except BaseException:
+        await sync_to_async(product_cache.release_list)(request)
+        raise
+
+
+async def _product_list(request, drf_request, versions):
+    # The same filtering as ProductList, building the queryset does not
+    # query anything (bar the one-off check for the search index).
+    view = ProductList(request=drf_request, args=(), kwargs={}, format_kwarg=None)
+    try:
+        fields = view.get_fields()
+        # Raises on a bad price range too.
+        queryset = await sync_to_async(
+            lambda: view.filter_queryset(view.get_queryset()))()
+    except ValidationError:
+        # Let the sync view answer with its usual 400, without waiting
+        # for this one to build the page.
+        await sync_to_async(product_cache.release_list)(request)
+        return await sync_to_async(sync_product_list)(request)
+
+    paginator = view.paginator
+    paginator.request = drf_request
+    paginator.limit = paginator.get_limit(drf_request)
+    paginator.offset = paginator.get_offset(drf_request)
+    paginator.count = await queryset.acount()
+    products = [product async for product in
+                queryset[paginator.offset:paginator.offset + paginator.limit]]
+
+    context = {'request': drf_request}
+    if 'cart_items' in fields or 'average_product_sold' in fields:
+        context['cart_data'] = await acart_data_for(
+            [product.id for product in products], items='cart_items' in fields)
+    serializer = ProductSerializer(products, many=True, fields=fields, context=context)
+    data = {
+        'count': paginator.count,
+        'next': paginator.get_next_link(),
+        'previous': paginator.get_previous_link(),
+        'results': serializer.data,
+    }
+    next_sale_change = None
+    if ProductFilter().depends_on_sales(drf_request):
+        next_sale_change = await sync_to_async(Product.objects.next_sale_change)()
+    entry = await sync_to_async(product_cache.set_list)(request, products, data, versions,
+                                                        next_sale_change)
+    return conditional.respond(request, entry, render)
+
+
+async def product_detail(request, id):
+    if request.method != 'GET':
+        return await sync_to_async(sync_product_detail)(request, id=id)
+
+    try:
+        fields = ProductSerializer.requested_fields(request.GET)
+    except ValidationError:
+        return await sync_to_async(sync_product_detail)(request, id=id)
+    entry = await sync_to_async(product_cache.get_product)(id)
+    if entry is None:
+        last_write = await sync_to_async(product_cache.last_write)()
+        with db.replica_reads(last_write):
+            try:
+                product = await Product.objects.select_related('stats').aget(id=id)
+            except Product.DoesNotExist:
+                # Let the sync view answer with its usual 404.
+                return await sync_to_async(sync_product_detail)(request, id=id)
+            cart_data = await acart_data_for([product.id])
+            data = ProductSerializer(product, context={'cart_data': cart_data}).data
+        entry = await sync_to_async(product_cache.set_product)(product, data)
+    if fields != ProductSerializer.Meta.fields:
+        entry = product_cache.project(entry, fields)
+    return conditional.respond(request, entry, render)
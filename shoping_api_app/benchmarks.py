@@ -0,0 +1,218 @@
+'''
+Benchmarks of the API, run by 'manage.py benchmark_api'.
+
+A synthetic catalog is seeded with bulk inserts into a throwaway test
+database, then every scenario drives one endpoint through the Django test
+client and records the latency and number of queries of each request.
+Everything runs in process against SQLite, no network involved.
+
+time_serialization() is the micro-benchmark of the serializers and
+renderers alone, run by 'manage.py benchmark_serializers'.
+'''
+import platform
+import sqlite3
+import statistics
+import time
+
+import django
+from django.core.cache import cache
+from django.utils import timezone
+
+from . import stats as product_stats
+from .models import Product, ShoppingCart, ShoppingCartItem
+from .serializers import cart_data_for
+
+
+WORDS = ('red', 'blue', 'green', 'shoe', 'shirt', 'hat', 'coat', 'bag', 'sock',
+         'linen', 'wool', 'cotton', 'leather', 'classic', 'sport', 'summer')
+SEED_BATCH_SIZE = 5000
+
+
+def _batched_create(model, objects):
+    batch = []
+    for obj in objects:
+        batch.append(obj)
+        if len(batch) == SEED_BATCH_SIZE:
+            model.objects.bulk_create(batch)
+            batch = []
+    if batch:
+        model.objects.bulk_create(batch)
+
+
+def seed(products, carts, items_per_cart, rng):
+    '''
+    Fills the database with the given number of products and carts, each
+    cart holding items_per_cart products. About a quarter of the products
+    are on sale, some of them for good.
+    '''
+    now = timezone.now()
+    day = timezone.timedelta(days=1)
+
+    def make_product(index):
+        name = ' '.join(rng.sample(WORDS, 3))
+        sale_start = sale_end = None
+        if rng.random() < 0.25:
+            sale_start = now - rng.randint(0, 30) * day
+            sale_end = None if rng.random() < 0.3 else now + rng.randint(-10, 30) * day
+        product = Product(name='{} {}'.format(name, index),
+                          description=' '.join(rng.choices(WORDS, k=20)),
+                          price=round(rng.uniform(1, 500), 2),
+                          sale_start=sale_start, sale_end=sale_end)
+        product.set_effective_price(now)
+        return product
+
+    _batched_create(Product, (make_product(index) for index in range(products)))
+    _batched_create(ShoppingCart, (ShoppingCart(name='cart {}'.format(index),
+                                                address='address {}'.format(index))
+                                   for index in range(carts)))
+    if not products or not items_per_cart:
+        return
+    first_product = Product.objects.order_by('id').values_list('id', flat=True)[0]
+    cart_ids = ShoppingCart.objects.values_list('id', flat=True).iterator()
+    _batched_create(ShoppingCartItem, (
+        ShoppingCartItem(shopping_cart_id=cart_id, product_id=first_product + offset,
+                         quantity=rng.randint(1, 10))
+        for cart_id in cart_ids
+        for offset in rng.sample(range(products), min(items_per_cart, products))))
+    # bulk_create() skips the signal handlers keeping these up to date.
+    product_stats.rebuild()
+
+
+def scenarios(products, rng):
+    '''
+    Returns the scenarios as (name, function making the next request
+    from a client).
+    '''
+    first = Product.objects.order_by('id').values_list('id', flat=True).first() or 1
+    created = []
+
+    def random_id():
+        return first + rng.randrange(max(products, 1))
+
+    def create(client):
+        response = client.post('/api/v1/create-products/', {
+            'name': 'benchmark product', 'description': 'made by the benchmark',
+            'price': '9.99'}, content_type='application/json')
+        created.append(response.json()['id'])
+        return response
+
+    def delete(client):
+        product_id = created.pop() if created else random_id()
+        return client.delete('/api/v1/retrieve-update-destroy-products/{}'.format(product_id))
+
+    return [
+        ('list', lambda client: client.get('/api/v1/products/')),
+        ('list_search', lambda client: client.get(
+            '/api/v1/products/', {'search': rng.choice(WORDS)})),
+        ('list_on_sale', lambda client: client.get(
+            '/api/v1/products/', {'on_sale': 'true'})),
+        ('list_price_range', lambda client: client.get(
+            '/api/v1/products/', {'max_price': 20, 'ordering': 'current_price'})),
+        ('list_deep_offset', lambda client: client.get(
+            '/api/v1/products/', {'limit': 10, 'offset': max(products - 10, 0)})),
+        ('detail', lambda client: client.get(
+            '/api/v1/retrieve-update-destroy-products/{}'.format(random_id()))),
+        ('create', create),
+        ('update', lambda client: client.patch(
+            '/api/v1/retrieve-update-destroy-products/{}'.format(random_id()),
+            {'price': '{:.2f}'.format(rng.uniform(1, 500))},
+            content_type='application/json')),
+        ('delete', delete),
+    ]
+
+
+def summarize(latencies, queries, elapsed):
+    '''
+    Returns the latency percentiles (in milliseconds), throughput and
+    queries per request of a scenario.
+    '''
+    percentiles = statistics.quantiles(latencies, n=100, method='inclusive')
+    return {
+        'requests': len(latencies),
+        'p50_ms': round(percentiles[49] * 1000, 3),
+        'p95_ms': round(percentiles[94] * 1000, 3),
+        'p99_ms': round(percentiles[98] * 1000, 3),
+        'throughput_rps': round(len(latencies) / elapsed, 1) if elapsed else None,
+        'queries_per_request': round(sum(queries) / len(queries), 2),
+    }
+
+
+def run(client, scenario, requests, warm_cache=False):
+    '''
+    Makes the scenario's requests one after the other and summarizes them.
+    With a cold cache (the default) every request starts with an empty
+    cache, so that the database and serializers are what is measured.
+    '''
+    latencies, queries = [], []
+    started = time.perf_counter()
+    for _ in range(requests):
+        if not warm_cache:
+            cache.clear()
+        request_started = time.perf_counter()
+        response = scenario(client)
+        latencies.append(time.perf_counter() - request_started)
+        if response.status_code >= 400:
+            raise RuntimeError('{} {} returned {}'.format(
+                response.request['REQUEST_METHOD'], response.request['PATH_INFO'],
+                response.status_code))
+        metrics = getattr(response, 'metrics', None)
+        queries.append(metrics.queries if metrics else 0)
+    return summarize(latencies, queries, time.perf_counter() - started)
+
+
+def environment(**scale):
+    return {
+        'python': platform.python_version(),
+        'django': django.get_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'machine': platform.machine(),
+        **scale,
+    }
+
+
+def compare(results, baseline, tolerance):
+    '''
+    Compares the scenarios with a baseline run. Returns a line per
+    scenario and the names of the ones whose p95 latency or queries per
+    request grew by more than the tolerance (0.2 for 20%).
+    '''
+    lines, regressions = [], []
+    for name, result in results['scenarios'].items():
+        before = baseline.get('scenarios', {}).get(name)
+        if before is None:
+            lines.append('{}: no baseline'.format(name))
+            continue
+        p95 = result['p95_ms'] / before['p95_ms'] if before['p95_ms'] else 1.0
+        queries = (result['queries_per_request'] / before['queries_per_request']
+                   if before['queries_per_request'] else 1.0)
+        lines.append('{}: p95 {:.3f} ms -> {:.3f} ms ({:+.0%}), queries {} -> {}'.format(
+            name, before['p95_ms'], result['p95_ms'], p95 - 1,
+            before['queries_per_request'], result['queries_per_request']))
+        if p95 > 1 + tolerance or queries > 1 + tolerance:
+            regressions.append(name)
+    return lines, regressions
+
+
+def time_serialization(serializer_class, products, render, rounds, **kwargs):
+    '''
+    Serializes and renders the products 'rounds' times, returning the
+    median milliseconds per round spent in each step. The data the
+    ProductListSerializer would fetch is fetched beforehand, so only
+    serializing and rendering are measured.
+    '''
+    context = {'cart_data': cart_data_for([product.id for product in products])}
+    serialize_times, render_times = [], []
+    for _ in range(rounds):
+        started = time.perf_counter()
+        data = serializer_class(products, many=True, context=context, **kwargs).data
+        serialized = time.perf_counter()
+        render(data)
+        serialize_times.append(serialized - started)
+        render_times.append(time.perf_counter() - serialized)
+    serialize_ms = statistics.median(serialize_times) * 1000
+    render_ms = statistics.median(render_times) * 1000
+    return {
+        'serialize_ms': round(serialize_ms, 3),
+        'render_ms': round(render_ms, 3),
+        'total_ms': round(serialize_ms + render_ms, 3),
+    }
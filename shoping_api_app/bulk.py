@@ -0,0 +1,166 @@
+'''
+Writing many products at once, for catalog syncs and imports.
+
+Rows are validated with the same rules as ProductSerializer, one by one
+so that a bad row is reported by its index instead of failing the whole
+batch, and the valid ones are written with bulk_create()/bulk_update()
+in chunks of PRODUCT_BULK_BATCH_SIZE, each in its own transaction.
+'''
+from functools import partial
+from itertools import islice
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from rest_framework.exceptions import ValidationError
+
+from . import cache as product_cache
+from . import outbox
+from .models import Product
+from .serializers import ProductSerializer
+
+
+def get_batch_size(batch_size=None):
+    return batch_size or getattr(settings, 'PRODUCT_BULK_BATCH_SIZE', 500)
+
+
+def batches(rows, batch_size):
+    '''
+    Splits an iterable of rows into lists of at most batch_size rows,
+    without reading more than one batch ahead.
+    '''
+    rows = iter(rows)
+    while True:
+        batch = list(islice(rows, batch_size))
+        if not batch:
+            return
+        yield batch
+
+
+def validate_products(rows, start=0):
+    '''
+    Validates the rows against ProductSerializer. Rows with an 'id' are
+    updates and only need the fields that change, the others are new
+    products.
+
+    Returns a list of (index, id, validated data) for the valid rows, 'id'
+    being None for new products, and a list of {'index', 'errors'} for the
+    others. Indexes count from 'start'.
+    '''
+    # run_validation() of the child is what ProductSerializer(many=True)
+    # does for every row, minus giving up on the first invalid one.
+    create = ProductSerializer(many=True).child
+    update = ProductSerializer(many=True, partial=True).child
+    valid, errors = [], []
+    for index, row in enumerate(rows, start):
+        if isinstance(row, Exception):
+            errors.append({'index': index, 'errors': {
+                'non_field_errors': [str(row)]}})
+            continue
+        if not isinstance(row, dict):
+            errors.append({'index': index, 'errors': {
+                'non_field_errors': ['Expected a product object.']}})
+            continue
+        product_id = row.get('id')
+        try:
+            if product_id is not None:
+                try:
+                    if isinstance(product_id, bool):
+                        raise TypeError
+                    product_id = int(product_id)
+                except (TypeError, ValueError):
+                    raise ValidationError({'id': ['A valid integer is required.']})
+                data = update.run_validation(row)
+            else:
+                data = create.run_validation(row)
+        except ValidationError as exc:
+            errors.append({'index': index, 'errors': exc.detail})
+            continue
+        valid.append((index, product_id, data))
+    return valid, errors
+
+
+def save_products(valid):
+    '''
+    Writes validated rows (as returned by validate_products()) in a
+    single transaction. Returns the ids of the created and updated
+    products, and errors for updates of products that do not exist.
+    '''
+    errors = []
+    with transaction.atomic():
+        existing = Product.objects.in_bulk(
+            {product_id for _, product_id, _ in valid if product_id is not None})
+        new_products, changed, fields = [], {}, set()
+        for index, product_id, data in valid:
+            if product_id is None:
+                product = Product(**data)
+                product.set_effective_price()
+                new_products.append(product)
+                continue
+            product = existing.get(product_id)
+            if product is None:
+                errors.append({'index': index, 'errors': {
+                    'id': ['No product with this id.']}})
+                continue
+            for field, value in data.items():
+                setattr(product, field, value)
+            changed[product_id] = product
+            fields.update(data)
+
+        Product.objects.bulk_create(new_products)
+        if changed and fields:
+            # bulk_update() leaves 'auto_now' fields alone, and both go
+            # around Product.save() which sets the effective price.
+            now = timezone.now()
+            for product in changed.values():
+                product.updated_at = now
+                product.set_effective_price(now)
+            Product.objects.bulk_update(
+                changed.values(), fields | {'updated_at', 'effective_price'})
+
+        created = [product.id for product in new_products]
+        updated = list(changed)
+        # bulk_create()/bulk_update() send no signals.
+        outbox.record(created + updated)
+    # Once committed, should the caller have a transaction of its own.
+    transaction.on_commit(partial(product_cache.evict_products, created + updated))
+    return created, updated, errors
+
+
+def write_products(rows, batch_size=None):
+    '''
+    Creates or updates products from an iterable of rows, batch by batch.
+    Returns the ids of the created and updated products along with the
+    errors of the rows that were left out.
+    '''
+    result = {'created': [], 'updated': [], 'errors': []}
+    start = 0
+    for batch in batches(rows, get_batch_size(batch_size)):
+        valid, errors = validate_products(batch, start)
+        created, updated, save_errors = save_products(valid)
+        result['created'] += created
+        result['updated'] += updated
+        result['errors'] += sorted(errors + save_errors,
+                                   key=lambda error: error['index'])
+        start += len(batch)
+    return result
+
+
+def delete_products(product_ids, batch_size=None):
+    '''
+    Deletes the products with the given ids, batch by batch. Returns the
+    ids that were deleted and the ones no product has.
+    '''
+    result = {'deleted': [], 'missing': []}
+    for batch in batches(product_ids, get_batch_size(batch_size)):
+        # Deleting goes through the signal handlers (the products' cart
+        # items go with them), their evictions are done once per batch.
+        with product_cache.batch_evictions(), transaction.atomic():
+            queryset = Product.objects.filter(id__in=batch)
+            found = set(queryset.values_list('id', flat=True))
+            queryset.delete()
+        result['deleted'] += [product_id for product_id in batch
+                              if product_id in found]
+        result['missing'] += [product_id for product_id in batch
+                              if product_id not in found]
+    return result
@@ -0,0 +1,419 @@
+'''
+Read-through cache for serialized products.
+
+Single products are stored under 'product_data_<id>' and pages of
+ProductList under a key derived from the requested URL, its query
+parameters normalized (sorted, empty ones dropped) so that equivalent
+requests share an entry. Entries live in the default cache (see CACHES
+in settings, which bounds its size) for at most PRODUCT_CACHE_TIMEOUT
+seconds, and never past the next sale start or end of the products they
+contain, since 'is_on_sale' and 'current_price' change at those moments.
+Pages filtered on sales or prices are not kept past the next sale start
+or end of the whole catalog either, products joining them then.
+The catalog statistics (see facets.py) are cached like the pages, under
+'catalog_stats_<digest>'.
+
+Invalidation is tag based so it works the same on every cache backend:
+each tag (the catalog, the shopping carts) has a version in the cache,
+entries remember the versions of their tags when they were computed, and
+bumping a tag's version makes all of its entries stale. The signal
+handlers in signals.py evict products and bump the tags on writes (the
+number of shopping carts feeds into every product's
+'average_product_sold').
+
+A list page that went stale (or past its timeout) is not recomputed by
+every worker asking for it at once: the first one takes a lock (see
+locks.py) and rebuilds it while the others keep serving the stale page,
+for at most PRODUCT_CACHE_STALE_TIMEOUT seconds past its timeout. Those
+finding no page at all wait for it, up to PRODUCT_CACHE_LOCK_TIMEOUT
+seconds, after which the lock expires in case its holder died.
+
+Every entry also carries the validators for conditional GETs: an ETag
+hashed from the representation itself, and a Last-Modified rounded up to
+the second. For a product it is the time of its last write, of the last
+write to its statistics (its 'cart_items' and 'average_product_sold')
+or of the last shopping cart created or deleted, for pages and
+statistics that of the last catalog write, the last sale start or end
+they passed counting too.
+'''
+import contextvars
+import hashlib
+import math
+import threading
+import time
+from contextlib import contextmanager
+from urllib.parse import urlencode
+
+from django.conf import settings
+from django.core.exceptions import ObjectDoesNotExist
+from django.core.cache import cache
+from django.utils import timezone
+
+from . import locks
+from .renderers import dumps
+
+
+PRODUCT_KEY = 'product_data_{}'
+LIST_KEY = 'product_list_{}'
+LIST_LOCK_KEY = 'product_list_lock_{}'
+STATS_KEY = 'catalog_stats_{}'
+STATS_LOCK_KEY = 'catalog_stats_lock_{}'
+CATALOG_VERSION_KEY = 'product_catalog_version'
+CARTS_VERSION_KEY = 'product_carts_version'
+
+# How often a worker waiting for a list page checks whether it is there.
+LOCK_POLL_INTERVAL = 0.02
+
+# Evictions held back by batch_evictions(), if one is running.
+_pending_evictions = contextvars.ContextVar('pending_evictions', default=None)
+
+_stats_lock = threading.Lock()
+_stats = {'hits': 0, 'misses': 0, 'stale': 0}
+
+
+def _record(hit):
+    with _stats_lock:
+        _stats['hits' if hit else 'misses'] += 1
+
+
+def stats():
+    '''
+    Returns the hit/miss counters of this process, stale pages served
+    while being rebuilt counting as hits.
+    '''
+    with _stats_lock:
+        hits, misses, stale = _stats['hits'], _stats['misses'], _stats['stale']
+    lookups = hits + misses
+    return {
+        'hits': hits,
+        'misses': misses,
+        'stale': stale,
+        'hit_rate': round(hits / lookups, 4) if lookups else 0.0,
+    }
+
+
+def get_stale_timeout():
+    return getattr(settings, 'PRODUCT_CACHE_STALE_TIMEOUT', 60)
+
+
+def get_lock_timeout():
+    return getattr(settings, 'PRODUCT_CACHE_LOCK_TIMEOUT', 10)
+
+
+def get_timeout(products):
+    '''
+    Returns for how long the serialized form of the given products stays
+    valid, i.e. the configured timeout cut short by the closest upcoming
+    sale start or end among them.
+    '''
+    return _timeout_until(_sale_boundaries(products))
+
+
+def _sale_boundaries(products):
+    for product in products:
+        yield product.sale_start
+        yield product.sale_end
+
+
+def _timeout_until(boundaries):
+    # The configured timeout, cut short by the closest upcoming boundary.
+    timeout = getattr(settings, 'PRODUCT_CACHE_TIMEOUT', 300)
+    now = timezone.now()
+    for boundary in boundaries:
+        if boundary and boundary > now:
+            timeout = min(timeout, (boundary - now).total_seconds())
+    return max(int(timeout), 1)
+
+
+def _get_version(key):
+    version = cache.get(key)
+    if version is None:
+        # The version may have been culled from the cache, so start again
+        # from a value that no existing entry can have been built with.
+        cache.add(key, time.time_ns(), timeout=None)
+        version = cache.get(key)
+    return version
+
+
+def _bump_version(key):
+    cache.set(key, time.time_ns(), timeout=None)
+
+
+def last_write():
+    '''
+    Returns when the catalog last changed (a timestamp), or 'now' if the
+    cache does not know.
+    '''
+    return _get_version(CATALOG_VERSION_KEY) / 1e9
+
+
+def _tag_versions(tags):
+    found = cache.get_many(tags)
+    return {tag: found[tag] if tag in found else _get_version(tag)
+            for tag in tags}
+
+
+def _is_fresh(entry, found):
+    # Whether the tags of the entry have the versions found in the cache.
+    return all(found.get(tag) == version for tag, version in entry['tags'].items())
+
+
+def _entry(data, boundaries, last_change):
+    # 'boundaries' are the sale starts and ends the data depends on,
+    # 'last_change' the time of the last write it depends on.
+    now = timezone.now()
+    last_modified = last_change
+    for boundary in boundaries:
+        if boundary and boundary <= now:
+            last_modified = max(last_modified, boundary.timestamp())
+    return {
+        'data': data,
+        'etag': _etag(data),
+        # Rounded up, a write later in the same second must not look
+        # older than the entry.
+        'last_modified': math.ceil(last_modified),
+    }
+
+
+def _last_product_change(product, carts_version):
+    # For products read with select_related('stats').
+    changes = [product.updated_at.timestamp(), carts_version / 1e9]
+    try:
+        changes.append(product.stats.updated_at.timestamp())
+    except ObjectDoesNotExist:
+        pass
+    return max(changes)
+
+
+def _etag(data):
+    return '"{}"'.format(hashlib.md5(dumps(data)).hexdigest())
+
+
+def project(entry, fields):
+    '''
+    Returns a copy of a product's entry holding only the given fields
+    of it, with the ETag to match.
+    '''
+    data = {name: value for name, value in entry['data'].items() if name in fields}
+    return dict(entry, data=data, etag=_etag(data))
+
+
+def get_product(product_id):
+    '''
+    Returns the cache entry of a product ('data', 'etag' and
+    'last_modified'), None on a miss.
+    '''
+    return get_products([product_id]).get(product_id)
+
+
+def get_products(product_ids):
+    '''
+    Returns the cache entries of those of the given products that are
+    cached, by product id, in a single lookup.
+    '''
+    keys = {PRODUCT_KEY.format(product_id): product_id for product_id in product_ids}
+    found = cache.get_many([*keys, CARTS_VERSION_KEY])
+    entries = {}
+    for key, product_id in keys.items():
+        entry = found.get(key)
+        hit = entry is not None and _is_fresh(entry, found)
+        _record(hit)
+        if hit:
+            entries[product_id] = entry
+    return entries
+
+
+def set_product(product, data):
+    '''
+    Caches the representation of a product and returns its entry.
+    '''
+    return set_products([product], [data])[product.id]
+
+
+def set_products(products, data):
+    '''
+    Caches the representations of the given products ('data', in the
+    same order) and returns their entries by product id.
+    '''
+    tags = _tag_versions([CARTS_VERSION_KEY])
+    entries, by_timeout = {}, {}
+    for product, product_data in zip(products, data):
+        entry = _entry(product_data, _sale_boundaries([product]),
+                       _last_product_change(product, tags[CARTS_VERSION_KEY]))
+        entry['tags'] = tags
+        entries[product.id] = entry
+        # Written with one set_many() per timeout, most share the default.
+        by_timeout.setdefault(get_timeout([product]), {})[
+            PRODUCT_KEY.format(product.id)] = entry
+    for timeout, group in by_timeout.items():
+        cache.set_many(group, timeout)
+    return entries
+
+
+def normalize_params(query_params):
+    '''
+    Returns the query parameters as a query string that is the same for
+    all the requests asking for the same thing: sorted, with the blanks
+    in values collapsed and the empty ones left out.
+    '''
+    params = []
+    for name in sorted(query_params):
+        values = (' '.join(value.split()) for value in query_params.getlist(name))
+        params.extend((name, value) for value in values if value)
+    return urlencode(params)
+
+
+def _list_digest(request):
+    # The host is part of it, being part of the 'next' and 'previous'
+    # links of the page.
+    url = '{}://{}{}?{}'.format(request.scheme, request.get_host(), request.path,
+                                normalize_params(request.GET))
+    return hashlib.md5(url.encode('utf-8')).hexdigest()
+
+
+def get_list(request):
+    '''
+    Looks up the ProductList response for this request. Returns its
+    cache entry (stale ones included while another worker rebuilds
+    them), or None and the tag versions to pass to set_list() when the
+    caller is to build the response.
+    '''
+    digest = _list_digest(request)
+    return _get_rebuilt(LIST_KEY.format(digest), LIST_LOCK_KEY.format(digest))
+
+
+def _get_rebuilt(key, lock_key):
+    # get_list() for any entry rebuilt by a single worker at a time.
+    found = cache.get_many([key, CATALOG_VERSION_KEY])
+    entry = found.get(key)
+    if entry is not None and _is_fresh(entry, found) and entry['expires'] > time.time():
+        _record(True)
+        return entry, None
+    versions = _tag_versions([CATALOG_VERSION_KEY])
+    lock_timeout = get_lock_timeout()
+    if locks.acquire(lock_key, lock_timeout):
+        _record(False)
+        return None, versions
+    if entry is None:
+        # Someone is building it already, wait for them.
+        deadline = time.monotonic() + lock_timeout
+        while entry is None and time.monotonic() < deadline:
+            time.sleep(LOCK_POLL_INTERVAL)
+            entry = cache.get(key)
+        if entry is None:
+            _record(False)
+            return None, versions
+    _record(True)
+    with _stats_lock:
+        _stats['stale'] += 1
+    return entry, None
+
+
+def set_list(request, products, data, versions, next_sale_change=None):
+    '''
+    Caches a ProductList response holding the given products, given the
+    tag versions get_list() returned, and returns its entry. Pages whose
+    filters keep the products on sale (or in a price range) pass the
+    closest sale start or end of the whole catalog as
+    'next_sale_change', since a product not on the page yet may join
+    it then.
+    '''
+    digest = _list_digest(request)
+    boundaries = [*_sale_boundaries(products), next_sale_change]
+    return _set_rebuilt(LIST_KEY.format(digest), LIST_LOCK_KEY.format(digest),
+                        data, boundaries, versions)
+
+
+def _set_rebuilt(key, lock_key, data, boundaries, versions):
+    timeout = _timeout_until(boundaries)
+    # The versions from before the data was read, later writes bump them.
+    entry = _entry(data, boundaries, versions[CATALOG_VERSION_KEY] / 1e9)
+    entry['tags'] = versions
+    entry['expires'] = time.time() + timeout
+    # Kept past its timeout to be served while it is rebuilt.
+    cache.set(key, entry, timeout + get_stale_timeout())
+    locks.release([lock_key])
+    return entry
+
+
+def release_list(request):
+    '''
+    Gives up building the ProductList response get_list() asked for (the
+    request failed), for the next worker not to wait on it.
+    '''
+    locks.release([LIST_LOCK_KEY.format(_list_digest(request))])
+
+
+def get_stats(request):
+    '''
+    Same as get_list(), for the catalog statistics of this request (see
+    facets.py).
+    '''
+    digest = _list_digest(request)
+    return _get_rebuilt(STATS_KEY.format(digest), STATS_LOCK_KEY.format(digest))
+
+
+def set_stats(request, data, boundaries, versions):
+    '''
+    Caches the catalog statistics of this request, given the sale starts
+    and ends they change at and the tag versions get_stats() returned,
+    and returns their entry.
+    '''
+    digest = _list_digest(request)
+    return _set_rebuilt(STATS_KEY.format(digest), STATS_LOCK_KEY.format(digest),
+                        data, boundaries, versions)
+
+
+def release_stats(request):
+    '''
+    Same as release_list(), for the catalog statistics.
+    '''
+    locks.release([STATS_LOCK_KEY.format(_list_digest(request))])
+
+
+def evict_products(product_ids):
+    '''
+    Drops the given products and every cached list page.
+    '''
+    pending = _pending_evictions.get()
+    if pending is not None:
+        pending['products'].update(product_ids)
+        return
+    cache.delete_many([PRODUCT_KEY.format(product_id)
+                       for product_id in product_ids])
+    _bump_version(CATALOG_VERSION_KEY)
+
+
+def evict_all():
+    '''
+    Drops every cached product and list page, for changes that affect
+    all products such as a shopping cart being created or deleted.
+    '''
+    pending = _pending_evictions.get()
+    if pending is not None:
+        pending['all'] = True
+        return
+    _bump_version(CARTS_VERSION_KEY)
+    _bump_version(CATALOG_VERSION_KEY)
+
+
+@contextmanager
+def batch_evictions():
+    '''
+    Holds back the evictions made inside the block (by the signal
+    handlers, say) and performs them in one pass when it ends, for
+    writes touching many products at once.
+    '''
+    if _pending_evictions.get() is not None:
+        yield
+        return
+    pending = {'products': set(), 'all': False}
+    token = _pending_evictions.set(pending)
+    try:
+        yield
+    finally:
+        _pending_evictions.reset(token)
+        if pending['all']:
+            evict_all()
+        if pending['products']:
+            evict_products(pending['products'])
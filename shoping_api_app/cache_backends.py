@@ -0,0 +1,24 @@
+'''
+Cache backends for what must not be culled from the cache.
+'''
+from django.core.cache.backends.db import DatabaseCache
+from django.db import connections
+
+
+class NonCullingDatabaseCache(DatabaseCache):
+    '''
+    A DatabaseCache that never culls entries that did not expire. Past
+    MAX_ENTRIES rows, DatabaseCache deletes the expired entries and then
+    some of the oldest live ones; this one only deletes the expired
+    entries, MAX_ENTRIES being the number of rows kept before they are.
+    Guest carts (see guest_carts.py) live in one, as culling a cart
+    would lose it.
+    '''
+
+    def _cull(self, db, cursor, now, num):
+        connection = connections[db]
+        cursor.execute(
+            'DELETE FROM %s WHERE %s < %%s' % (
+                connection.ops.quote_name(self._table),
+                connection.ops.quote_name('expires')),
+            [connection.ops.adapt_datetimefield_value(now)])
@@ -0,0 +1,29 @@
+'''
+Conditional GETs (ETag/Last-Modified) for the product reads, answered
+from the validators stored with the product cache entries, so that a
+client polling an unchanged product or page gets a 304 without anything
+being queried or serialized.
+'''
+import time
+
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date
+from rest_framework.response import Response
+
+
+def respond(request, entry, make_response=Response):
+    '''
+    Returns a 304 if the request's If-None-Match/If-Modified-Since
+    match the cache entry, the entry's data otherwise, with the
+    validators set either way (Last-Modified only once it is past).
+    '''
+    response = get_conditional_response(
+        request, etag=entry['etag'], last_modified=entry['last_modified'])
+    if response is None:
+        response = make_response(entry['data'])
+    response['ETag'] = entry['etag']
+    # Left out until that second is over: a write later in it would get
+    # the same Last-Modified, and this response would pass for its own.
+    if entry['last_modified'] <= time.time():
+        response['Last-Modified'] = http_date(entry['last_modified'])
+    return response
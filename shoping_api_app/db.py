@@ -0,0 +1,138 @@
+'''
+The database side of deployments: tuning SQLite connections, and sending
+the product reads to a read replica when there is one.
+
+The replica is the 'replica' alias of DATABASES (see settings). Reads go
+there only inside replica_reads(), which the product list and detail
+views use, and only if the replica was last synced more than
+DATABASE_REPLICA_LAG seconds after the last catalog write, so a client
+reading after a write (and the cache filled by that read) never gets
+what the replica has not caught up with yet. Everything else, writes
+included, goes to the primary.
+
+SQLite has no replication of its own: 'manage.py sync_replica' copies
+the primary into the replica file, for running with two local files,
+and sets the modification time of '<replica>.synced' to when the copy
+started. Without that file the replica is not read from, so a replica
+kept up to date some other way has to be marked the same way.
+'''
+import contextvars
+import os
+import sqlite3
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+
+
+REPLICA = 'replica'
+
+_replica_reads = contextvars.ContextVar('replica_reads', default=False)
+
+
+def has_replica():
+    return REPLICA in settings.DATABASES
+
+
+def configure_connection(connection):
+    '''
+    Runs the SQLITE_PRAGMAS on a new SQLite connection, straight on the
+    DB-API connection so that they are not counted as queries of the
+    request that happened to open it.
+    '''
+    if connection.vendor != 'sqlite':
+        return
+    for name, value in getattr(settings, 'SQLITE_PRAGMAS', {}).items():
+        connection.connection.execute('PRAGMA {} = {}'.format(name, value))
+
+
+def _synced_path():
+    return '{}.synced'.format(connections[REPLICA].settings_dict['NAME'])
+
+
+def replica_synced_at():
+    '''
+    Returns when the replica was last synced (a timestamp, everything
+    committed on the primary before it is on the replica), None if that
+    is not known.
+    '''
+    try:
+        return os.stat(_synced_path()).st_mtime
+    except OSError:
+        return None
+
+
+def sync_replica(pages=1024):
+    '''
+    Copies the SQLite primary into the replica with SQLite's online
+    backup, 'pages' pages at a time so that the primary's writers are not
+    held up for the whole copy, and records when it started (see
+    replica_synced_at()). Returns the number of pages copied.
+    '''
+    primary, replica = connections[DEFAULT_DB_ALIAS], connections[REPLICA]
+    if primary.vendor != 'sqlite' or replica.vendor != 'sqlite':
+        raise ValueError('Only SQLite databases are copied, '
+                         'other databases replicate on their own.')
+    # Connections of our own rather than Django's, which may be in a
+    # transaction.
+    source = sqlite3.connect(primary.settings_dict['NAME'])
+    target = sqlite3.connect(replica.settings_dict['NAME'])
+    copied = 0
+    # The copy holds what was committed by then, and whatever the
+    # primary's writers commit meanwhile (the backup starts over then).
+    started = time.time()
+    try:
+        def progress(status, remaining, total):
+            nonlocal copied
+            copied = total - remaining
+        source.backup(target, pages=pages, progress=progress)
+    finally:
+        source.close()
+        target.close()
+    with open(_synced_path(), 'a'):
+        pass
+    os.utime(_synced_path(), (started, started))
+    return copied
+
+
+@contextmanager
+def replica_reads(last_write=None):
+    '''
+    Sends the reads made inside the block to the replica, if it was
+    synced after the last write (a timestamp, None if unknown).
+    '''
+    use_replica = False
+    if has_replica() and last_write is not None:
+        synced_at = replica_synced_at()
+        # The last write is timed before its transaction commits.
+        lag = getattr(settings, 'DATABASE_REPLICA_LAG', 1)
+        use_replica = synced_at is not None and synced_at - last_write > lag
+    token = _replica_reads.set(use_replica)
+    try:
+        yield
+    finally:
+        _replica_reads.reset(token)
+
+
+class PrimaryReplicaRouter:
+    '''
+    Reads from the replica inside replica_reads(), from the primary
+    otherwise. Only the primary is migrated, the replica being a copy
+    of it.
+    '''
+
+    def db_for_read(self, model, **hints):
+        if _replica_reads.get():
+            return REPLICA
+        return DEFAULT_DB_ALIAS
+
+    def db_for_write(self, model, **hints):
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Both hold the same data.
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db != REPLICA
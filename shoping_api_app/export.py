@@ -0,0 +1,74 @@
+'''
+Exporting the catalog as NDJSON or CSV.
+
+Products are read in chunks straight into tuples (no model instances, no
+ProductSerializer) and encoded one line at a time, so the memory used
+stays the same however big the catalog is.
+'''
+import csv
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils import timezone
+
+from .models import Product, sale_is_active, sale_price
+
+
+EXPORT_FIELDS = ('id', 'name', 'description', 'price', 'sale_start',
+                 'sale_end', 'is_on_sale', 'current_price')
+FORMATS = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv',
+}
+
+
+def product_rows(queryset=None, chunk_size=None):
+    '''
+    Yields a tuple of EXPORT_FIELDS for every product of the queryset
+    (all products by default), in id order.
+    '''
+    if queryset is None:
+        queryset = Product.objects.all()
+    chunk_size = chunk_size or getattr(settings, 'PRODUCT_EXPORT_CHUNK_SIZE', 2000)
+    now = timezone.now()
+    rows = queryset.order_by('id').values_list(
+        'id', 'name', 'description', 'price', 'sale_start', 'sale_end')
+    for row in rows.iterator(chunk_size=chunk_size):
+        on_sale = sale_is_active(row[4], row[5], now)
+        yield row + (on_sale, sale_price(row[3], on_sale, Product.DISCOUNT_RATE))
+
+
+def ndjson_lines(rows):
+    encoder = DjangoJSONEncoder(separators=(',', ':'))
+    for row in rows:
+        yield encoder.encode(dict(zip(EXPORT_FIELDS, row))) + '\n'
+
+
+class Echo:
+    '''
+    File-like object handing back what is written to it, for getting
+    csv.writer() lines one at a time.
+    '''
+
+    def write(self, value):
+        return value
+
+
+def csv_lines(rows):
+    writer = csv.writer(Echo())
+    yield writer.writerow(EXPORT_FIELDS)
+    for row in rows:
+        yield writer.writerow(
+            value.isoformat() if hasattr(value, 'isoformat') else value
+            for value in row)
+
+
+def export_lines(export_format, queryset=None, chunk_size=None):
+    '''
+    Yields the catalog as lines of text in the given format
+    ('ndjson' or 'csv').
+    '''
+    rows = product_rows(queryset, chunk_size)
+    if export_format == 'csv':
+        return csv_lines(rows)
+    return ndjson_lines(rows)
@@ -0,0 +1,78 @@
+'''
+Statistics of the catalog for dashboards, computed in the database: the
+number of products and of those on sale, their current prices (lowest,
+highest, average and a histogram of them) and their average
+'average_product_sold'. Three queries whatever the number of products:
+one for the aggregates, one grouping the products by histogram bucket
+and one counting the shopping carts.
+
+Prices are the stored effective prices (see prices.py).
+'''
+from django.db.models import Avg, Count, F, FloatField, IntegerField, Max, Min, Q, Value
+from django.db.models.functions import Cast, Coalesce, Least
+from django.utils import timezone
+
+from .models import ShoppingCart, on_sale_condition
+
+
+def histogram(queryset, low, high, buckets):
+    '''
+    Returns the number of products of the queryset per price range,
+    'buckets' ranges of equal width from 'low' to 'high', in one query.
+    '''
+    width = (high - low) / buckets
+    if not width:
+        return [{'min': low, 'max': high, 'count': queryset.count()}]
+    bucket = Cast((F('effective_price') - low) / width, IntegerField())
+    counts = dict(queryset.order_by().annotate(
+        # The highest price falls at the end of the last range.
+        bucket=Least(bucket, Value(buckets - 1)),
+    ).values_list('bucket').annotate(count=Count('id')))
+    return [{
+        'min': round(low + index * width, 2),
+        'max': round(high if index == buckets - 1 else low + (index + 1) * width, 2),
+        'count': counts.get(index, 0),
+    } for index in range(buckets)]
+
+
+def compute(queryset, buckets=10):
+    '''
+    Returns the statistics of the products of the queryset, and the sale
+    starts and ends they change at: the closest upcoming ones and the
+    last ones passed.
+    '''
+    now = timezone.now()
+    totals = queryset.order_by().aggregate(
+        count=Count('id'),
+        on_sale=Count('id', filter=on_sale_condition(now)),
+        min_price=Min('effective_price'),
+        max_price=Max('effective_price'),
+        average_price=Avg('effective_price'),
+        average_quantity=Avg(Coalesce('stats__total_quantity', 0), output_field=FloatField()),
+        next_sale_start=Min('sale_start', filter=Q(sale_start__gt=now)),
+        next_sale_end=Min('sale_end', filter=Q(sale_end__gte=now)),
+        last_sale_start=Max('sale_start', filter=Q(sale_start__lte=now)),
+        last_sale_end=Max('sale_end', filter=Q(sale_end__lt=now)),
+    )
+    boundaries = [totals['next_sale_start'], totals['next_sale_end'],
+                  totals['last_sale_start'], totals['last_sale_end']]
+    if not totals['count']:
+        return {'count': 0, 'on_sale': {'true': 0, 'false': 0}, 'price': None,
+                'average_product_sold': 0, 'histogram': []}, boundaries
+
+    # Like ProductSerializer.get_average_product_sold(), per product.
+    shopping_carts = ShoppingCart.objects.count()
+    average_sold = totals['average_quantity'] / shopping_carts if shopping_carts else 0
+    data = {
+        'count': totals['count'],
+        'on_sale': {'true': totals['on_sale'],
+                    'false': totals['count'] - totals['on_sale']},
+        'price': {
+            'min': totals['min_price'],
+            'max': totals['max_price'],
+            'average': round(totals['average_price'], 2),
+        },
+        'average_product_sold': round(average_sold, 4),
+        'histogram': histogram(queryset, totals['min_price'], totals['max_price'], buckets),
+    }
+    return data, boundaries
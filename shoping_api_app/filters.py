@@ -0,0 +1,57 @@
+'''
+Filtering the products on the query parameters, shared by the product
+list and the catalog statistics.
+'''
+import math
+
+from rest_framework.exceptions import ValidationError
+from rest_framework.filters import BaseFilterBackend
+
+
+class ProductFilter(BaseFilterBackend):
+    '''
+    '?on_sale=true' keeps the products on sale, '?min_price=' and
+    '?max_price=' bound their current price. Price ranges go by the stored
+    effective price (see prices.py), through its index.
+    '''
+
+    def filter_queryset(self, request, queryset, view):
+        on_sale = request.query_params.get('on_sale')
+        if on_sale is not None and on_sale.lower() == 'true':
+            queryset = queryset.on_sale()
+        min_price, max_price = self.get_price_range(request)
+        if min_price is not None:
+            queryset = queryset.filter(effective_price__gte=min_price)
+        if max_price is not None:
+            queryset = queryset.filter(effective_price__lte=max_price)
+        return queryset
+
+    def depends_on_sales(self, request):
+        '''
+        Returns whether the products kept can change whenever any sale
+        starts or ends, products not kept yet included (a product
+        starting its sale joins '?on_sale=true', say).
+        '''
+        on_sale = request.query_params.get('on_sale')
+        return ((on_sale is not None and on_sale.lower() == 'true') or
+                any(bound is not None for bound in self.get_price_range(request)))
+
+    def get_price_range(self, request):
+        '''
+        Returns the '?min_price=' and '?max_price=' bounds, None for
+        the ones not given.
+        '''
+        bounds = []
+        for param in ('min_price', 'max_price'):
+            value = request.query_params.get(param)
+            if not value:
+                bounds.append(None)
+                continue
+            try:
+                bound = float(value)
+            except ValueError:
+                bound = math.nan
+            if not math.isfinite(bound):
+                raise ValidationError({param: 'A valid number is required.'})
+            bounds.append(bound)
+        return bounds
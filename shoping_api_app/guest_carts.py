@@ -0,0 +1,357 @@
+'''
+Guest shopping carts, kept in the cache rather than in the database.
+
+A guest cart is a small dict in the GUEST_CART_CACHE cache under
+'guest_cart_<token>': its items as {product id: quantity}, and the name
+and address given at checkout. Filling it writes nothing to the
+database, and a cart that is abandoned expires GUEST_CART_TIMEOUT
+seconds after it was last changed without ever being written. That
+cache has to be shared by the processes serving the carts and must not
+cull them (see CACHES in the settings), unlike the default one.
+
+A cart is changed under its lock, read again and saved while holding
+it (see edit()), so that two requests adding to the same cart together
+do not lose one or the other's product. Its totals are kept next to it,
+under 'guest_cart_totals_<token>', for the items they were computed for.
+
+Guest carts become ShoppingCarts (with their items) when flushed, all
+the carts flushed together being written with one bulk_create() per
+table:
+- at checkout, right away, or queued when GUEST_CART_DEFERRED_CHECKOUT
+  is on and then written in batches by 'manage.py flush_guest_carts';
+- when the user logs in, for the cart of the 'guest_cart' cookie.
+bulk_create() sending no signals, flush() updates the product statistics,
+the change feed and the product cache itself. Once flushed, the guest
+cart points to its ShoppingCart for a day.
+'''
+import secrets
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.cache import DEFAULT_CACHE_ALIAS, caches
+from django.db import transaction
+from rest_framework import status
+from rest_framework.exceptions import APIException, NotFound, ValidationError
+
+from . import cache as product_cache
+from . import locks
+from . import outbox
+from . import stats as product_stats
+from .models import Product, ShoppingCart, ShoppingCartItem
+
+
+KEY = 'guest_cart_{}'
+TOTALS_KEY = 'guest_cart_totals_{}'
+LOCK_KEY = 'guest_cart_lock_{}'
+QUEUE_KEY = 'guest_carts_queue'
+QUEUE_LOCK_KEY = 'guest_carts_queue_lock'
+COOKIE_NAME = 'guest_cart'
+FLUSHED_TIMEOUT = 24 * 60 * 60
+LOCK_TIMEOUT = 10
+# Seconds a change waits for the lock of its cart.
+LOCK_WAIT = 10
+
+
+class CartBusy(APIException):
+    status_code = status.HTTP_409_CONFLICT
+    default_detail = 'The cart is being changed or checked out already.'
+    default_code = 'conflict'
+
+
+def get_cache_alias():
+    return getattr(settings, 'GUEST_CART_CACHE', DEFAULT_CACHE_ALIAS)
+
+
+def get_cache():
+    return caches[get_cache_alias()]
+
+
+def get_timeout():
+    return getattr(settings, 'GUEST_CART_TIMEOUT', 3 * 24 * 60 * 60)
+
+
+def is_deferred():
+    return getattr(settings, 'GUEST_CART_DEFERRED_CHECKOUT', False)
+
+
+def create():
+    '''
+    Starts an empty guest cart and returns it.
+    '''
+    cart = {'token': secrets.token_urlsafe(16), 'items': {},
+            'name': '', 'address': '', 'checked_out': False}
+    save(cart)
+    return cart
+
+
+def get(token):
+    '''
+    Returns the guest cart with the given token, raises NotFound if it
+    expired or never existed.
+    '''
+    cart = get_cache().get(KEY.format(token))
+    if cart is None:
+        raise NotFound('No guest cart with this token.')
+    return cart
+
+
+def save(cart):
+    get_cache().set(KEY.format(cart['token']), cart, get_timeout())
+
+
+def check_editable(cart):
+    '''
+    Raises a ValidationError if the cart was checked out already.
+    '''
+    if 'shopping_cart' in cart or cart['checked_out']:
+        raise ValidationError({'non_field_errors': 'The cart is checked out already.'})
+
+
+@contextmanager
+def edit(token):
+    '''
+    Yields the guest cart with the given token to be changed, and saves
+    it once changed. The cart is read and saved under its lock, changes
+    to it going one at a time rather than each saving the cart as it
+    was before the others. Raises CartBusy if the lock is not let go of
+    within LOCK_WAIT seconds.
+    '''
+    with _lock(LOCK_KEY.format(token), LOCK_WAIT):
+        cart = get(token)
+        check_editable(cart)
+        yield cart
+        save(cart)
+
+
+def add(token, product_id, quantity, max_quantity):
+    '''
+    Adds a quantity of a product to the cart, up to max_quantity of it
+    in all, and returns the cart.
+    '''
+    with edit(token) as cart:
+        quantity += cart['items'].get(product_id, 0)
+        if quantity > max_quantity:
+            raise ValidationError({'quantity': (
+                'Cannot have more than {} of a product in the cart.'
+                .format(max_quantity))})
+        cart['items'][product_id] = quantity
+    return cart
+
+
+def set_quantity(token, product_id, quantity):
+    '''
+    Changes the quantity of a product of the cart and returns the cart.
+    '''
+    with edit(token) as cart:
+        if product_id not in cart['items']:
+            raise NotFound('No such product in the cart.')
+        cart['items'][product_id] = quantity
+    return cart
+
+
+def remove(token, product_id):
+    '''
+    Takes a product out of the cart.
+    '''
+    with edit(token) as cart:
+        if cart['items'].pop(product_id, None) is None:
+            raise NotFound('No such product in the cart.')
+
+
+def totals(cart):
+    '''
+    Returns the subtotal, taxes and total of the cart, priced like
+    ShoppingCart.totals(). They are kept until the items of the cart or
+    the catalog change, or a sale of its products starts or ends.
+    '''
+    key = TOTALS_KEY.format(cart['token'])
+    version = product_cache.last_write()
+    kept = get_cache().get(key)
+    if (kept and kept['items'] == cart['items'] and kept['version'] == version
+            and kept['expires'] > time.time()):
+        return kept['amounts']
+    products = list(Product.objects.filter(id__in=cart['items']).only(
+        'id', 'price', 'sale_start', 'sale_end'))
+    amounts = ShoppingCart.price_lines(
+        [(cart['items'][product.id], product.current_price()) for product in products])
+    # Saved apart from the cart, which is only saved under its lock.
+    get_cache().set(key, {
+        'items': cart['items'], 'amounts': amounts, 'version': version,
+        'expires': time.time() + product_cache.get_timeout(products),
+    }, get_timeout())
+    return amounts
+
+
+def represent(cart):
+    '''
+    Returns the cart the way the API shows it, like a ShoppingCart, or
+    the id of its ShoppingCart once flushed.
+    '''
+    if 'shopping_cart' in cart:
+        return {'token': cart['token'], 'shopping_cart': cart['shopping_cart']}
+    return {
+        'token': cart['token'],
+        'name': cart['name'],
+        'address': cart['address'],
+        'checked_out': cart['checked_out'],
+        'items': [{'product': product_id, 'quantity': quantity}
+                  for product_id, quantity in cart['items'].items()],
+        **totals(cart),
+    }
+
+
+def checkout(token, name, address):
+    '''
+    Checks the cart out: flushes it and returns its ShoppingCart, or
+    queues it and returns None when checkouts are deferred. Raises
+    CartBusy if the cart is being changed or flushed already.
+    '''
+    with _flush_locks([token]) as claimed:
+        if not claimed:
+            raise CartBusy()
+        cart = get(token)
+        check_editable(cart)
+        if not cart['items']:
+            raise ValidationError({'items': 'The cart is empty.'})
+        cart.update(name=name, address=address, checked_out=True)
+        save(cart)
+        try:
+            if is_deferred():
+                _queue([token])
+                return None
+            return _flush([cart])[token]
+        except BaseException:
+            # Neither queued nor written, it can be changed and checked
+            # out again.
+            cart['checked_out'] = False
+            save(cart)
+            raise
+
+
+def logged_in(request):
+    '''
+    Flushes the guest cart of a user who just logged in, remembering its
+    ShoppingCart in the session.
+    '''
+    token = request.COOKIES.get(COOKIE_NAME) if request is not None else None
+    if not token:
+        return
+    shopping_cart = flush([token]).get(token)
+    if shopping_cart is not None:
+        request.session['shopping_cart_id'] = shopping_cart.id
+
+
+def flush(tokens):
+    '''
+    Writes the given guest carts to the database, but for the ones gone,
+    flushed already or whose lock is held. Returns the ShoppingCart made of
+    each by token.
+    '''
+    with _flush_locks(tokens) as claimed:
+        return _flush(_unflushed(claimed))
+
+
+@contextmanager
+def _flush_locks(tokens):
+    # Yields the tokens whose lock could be taken right away.
+    alias = get_cache_alias()
+    claimed = [token for token in tokens
+               if locks.acquire(LOCK_KEY.format(token), LOCK_TIMEOUT, using=alias)]
+    try:
+        yield claimed
+    finally:
+        if claimed:
+            locks.release([LOCK_KEY.format(token) for token in claimed], using=alias)
+
+
+def _unflushed(tokens):
+    # The carts still there and not flushed yet.
+    found = get_cache().get_many([KEY.format(token) for token in tokens])
+    return [cart for cart in found.values() if 'shopping_cart' not in cart]
+
+
+def _flush(carts):
+    if not carts:
+        return {}
+    shopping_carts = _write(carts)
+    flushed = {cart['token']: shopping_cart
+               for cart, shopping_cart in zip(carts, shopping_carts)}
+    get_cache().set_many({KEY.format(token): {'token': token, 'shopping_cart': shopping_cart.id}
+                          for token, shopping_cart in flushed.items()}, FLUSHED_TIMEOUT)
+    return flushed
+
+
+def _write(carts):
+    product_ids = {product_id for cart in carts for product_id in cart['items']}
+    with transaction.atomic():
+        # Products may have been deleted since they were added.
+        existing = set(Product.objects.filter(id__in=product_ids).values_list('id', flat=True))
+        shopping_carts = ShoppingCart.objects.bulk_create(
+            [ShoppingCart(name=cart['name'], address=cart['address']) for cart in carts])
+        items = [ShoppingCartItem(shopping_cart=shopping_cart, product_id=product_id,
+                                  quantity=quantity)
+                 for cart, shopping_cart in zip(carts, shopping_carts)
+                 for product_id, quantity in cart['items'].items()
+                 if product_id in existing]
+        ShoppingCartItem.objects.bulk_create(items)
+
+        # What the signal handlers do for carts and items saved one by
+        # one, once per product.
+        added = {}
+        for item in items:
+            quantity, carts_count = added.get(item.product_id, (0, 0))
+            added[item.product_id] = (quantity + item.quantity, carts_count + 1)
+        for product_id, (quantity, carts_count) in added.items():
+            product_stats.add(product_id, quantity, carts_count)
+        # The number of shopping carts is part of every product.
+        outbox.record_all()
+    product_cache.evict_all()
+    return shopping_carts
+
+
+@contextmanager
+def _lock(key, wait):
+    # Expires by itself should its holder die.
+    alias = get_cache_alias()
+    deadline = time.monotonic() + wait
+    while not locks.acquire(key, LOCK_TIMEOUT, using=alias):
+        if time.monotonic() >= deadline:
+            raise CartBusy()
+        time.sleep(0.01)
+    try:
+        yield
+    finally:
+        locks.release([key], using=alias)
+
+
+def _queue(tokens, first=False):
+    # Adds the carts to the end of the queue, or to its start.
+    with _lock(QUEUE_LOCK_KEY, LOCK_WAIT):
+        queued = get_cache().get(QUEUE_KEY) or []
+        get_cache().set(QUEUE_KEY, tokens + queued if first else queued + tokens, None)
+
+
+def flush_queued(batch_size=500):
+    '''
+    Flushes the carts checked out while checkouts were deferred, up to
+    batch_size of them. Returns the number of queued carts gone through
+    (those that expired meanwhile included), 0 once none are left. The
+    carts whose lock is held (by a change to them being turned down,
+    say) go back in the queue for the next run and are not counted.
+    '''
+    with _lock(QUEUE_LOCK_KEY, LOCK_WAIT):
+        queued = get_cache().get(QUEUE_KEY) or []
+        get_cache().set(QUEUE_KEY, queued[batch_size:], None)
+    batch = queued[:batch_size]
+    try:
+        with _flush_locks(batch) as claimed:
+            _flush(_unflushed(claimed))
+    except Exception:
+        # Back in the queue for the next run.
+        _queue(batch, first=True)
+        raise
+    busy = [token for token in batch if token not in claimed]
+    if busy:
+        _queue(busy, first=True)
+    return len(batch) - len(busy)
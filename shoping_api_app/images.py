@@ -0,0 +1,259 @@
+'''
+Resized copies of the product photos.
+
+Every photo gets a copy per width of PRODUCT_IMAGE_VARIANTS, each as
+WebP and as JPEG (PNG for photos with transparency) for the browsers
+without WebP. They are made in a pool of PRODUCT_IMAGE_WORKERS processes
+when a product is saved with a new photo (see signals.py), the workers
+reading the photo themselves, and the original keeps being served until
+they are ready. 'manage.py generate_product_images' makes those still
+missing (a product written around save(), a failed job). Serializing a
+product only builds URLs.
+
+The copies are stored under a name derived from the content of the
+original ('products/variants/<hash>/<width>.webp'), so a given URL always
+has the same content and can be cached for good, and identical photos
+share their copies. Product.photo_variants records them.
+'''
+import hashlib
+import io
+import logging
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+import django
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import connections, transaction
+from django.utils import timezone
+from django.views.static import serve as static_serve
+
+from . import cache as product_cache
+from . import outbox
+from .models import Product
+
+
+VARIANTS_DIR = 'products/variants'
+# A year, the longest caches are asked to keep anything.
+IMMUTABLE_MAX_AGE = 365 * 24 * 60 * 60
+PHOTO_MAX_AGE = 60 * 60
+
+logger = logging.getLogger(__name__)
+
+_executor = None
+_executor_lock = threading.Lock()
+# (product id, photo) pairs whose copies are being made.
+_in_flight = set()
+_in_flight_lock = threading.Lock()
+
+
+def get_variants():
+    return getattr(settings, 'PRODUCT_IMAGE_VARIANTS',
+                   {'thumbnail': 160, 'small': 320, 'medium': 640})
+
+
+def get_workers():
+    return getattr(settings, 'PRODUCT_IMAGE_WORKERS', 2)
+
+
+def content_hash(data):
+    return hashlib.sha256(data).hexdigest()[:24]
+
+
+def render_variants(data, variants):
+    '''
+    Resizes the image in 'data' (bytes) to every width of 'variants'
+    ({name: width}), never enlarging it. Returns the size of the original
+    and {name: {'width', 'height', 'formats': {format: bytes}}}.
+
+    Runs in the worker processes, so it does not touch the database.
+    '''
+    from PIL import Image, ImageOps
+
+    with Image.open(io.BytesIO(data)) as original:
+        image = ImageOps.exif_transpose(original)
+        image.load()
+    has_alpha = image.mode in ('RGBA', 'LA') or (
+        image.mode == 'P' and 'transparency' in image.info)
+    image = image.convert('RGBA' if has_alpha else 'RGB')
+
+    rendered = {}
+    for name, width in variants.items():
+        resized = image.copy()
+        if width < image.width:
+            resized.thumbnail((width, image.height), Image.Resampling.LANCZOS)
+        fallback = ('PNG', {'optimize': True}) if has_alpha else (
+            'JPEG', {'quality': 82, 'optimize': True, 'progressive': True})
+        formats = {}
+        for image_format, options in (('WEBP', {'quality': 80, 'method': 4}), fallback):
+            buffer = io.BytesIO()
+            resized.save(buffer, image_format, **options)
+            formats[image_format.lower()] = buffer.getvalue()
+        rendered[name] = {'width': resized.width, 'height': resized.height,
+                          'formats': formats}
+    return {'width': image.width, 'height': image.height, 'variants': rendered}
+
+
+EXTENSIONS = {'webp': 'webp', 'jpeg': 'jpg', 'png': 'png'}
+
+
+def render_photo(photo_name, variants):
+    '''
+    Reads a photo from the storage and resizes it. Returns the hash of its
+    content and what render_variants() made of it.
+
+    Runs in the worker processes.
+    '''
+    with default_storage.open(photo_name, 'rb') as file:
+        data = file.read()
+    return content_hash(data), render_variants(data, variants)
+
+
+def store_variants(product_id, photo_name, digest, rendered):
+    '''
+    Saves the copies made by render_variants() and records them on the
+    product, unless its photo changed in the meantime.
+    '''
+    variants = {}
+    for name, variant in rendered['variants'].items():
+        stored = {'width': variant['width'], 'height': variant['height']}
+        for image_format, content in variant['formats'].items():
+            path = '{}/{}/{}.{}'.format(VARIANTS_DIR, digest, variant['width'],
+                                        EXTENSIONS[image_format])
+            if not default_storage.exists(path):
+                path = default_storage.save(path, ContentFile(content))
+            stored[image_format] = path
+        variants[name] = stored
+    photo_variants = {'source': photo_name, 'width': rendered['width'],
+                      'height': rendered['height'], 'variants': variants}
+    # update() rather than save(), for not making them all over again
+    # from the signal handler.
+    with transaction.atomic():
+        updated = Product.objects.filter(id=product_id, photo=photo_name).update(
+            photo_variants=photo_variants, updated_at=timezone.now())
+        if updated:
+            outbox.record([product_id])
+    if updated:
+        product_cache.evict_products([product_id])
+    return photo_variants
+
+
+def is_stale(product):
+    '''
+    Returns True if the copies of the product's photo are missing or
+    were made from another photo.
+    '''
+    return bool(product.photo) and (
+        (product.photo_variants or {}).get('source') != product.photo.name)
+
+
+def _get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            # Spawned, forking a web worker's threads and connections
+            # being unsafe. They set Django up before unpickling their
+            # first job imports this module.
+            _executor = ProcessPoolExecutor(
+                get_workers(), mp_context=multiprocessing.get_context('spawn'),
+                initializer=django.setup)
+        return _executor
+
+
+def schedule(product):
+    '''
+    Has the copies of the product's photo made, in the background when
+    there are workers for it. Does nothing if they are being made already.
+    '''
+    photo_name = product.photo.name
+    key = (product.id, photo_name)
+    with _in_flight_lock:
+        if key in _in_flight:
+            return
+        _in_flight.add(key)
+    submitted = False
+    try:
+        if get_workers():
+            future = _get_executor().submit(render_photo, photo_name, get_variants())
+            future.add_done_callback(partial(
+                _rendered, product.id, photo_name, threading.get_ident()))
+            submitted = True
+        else:
+            store_variants(product.id, photo_name,
+                           *render_photo(photo_name, get_variants()))
+    finally:
+        if not submitted:
+            _done(key)
+
+
+def _done(key):
+    with _in_flight_lock:
+        _in_flight.discard(key)
+
+
+def _rendered(product_id, photo_name, scheduled_in, future):
+    # Runs in a thread of the executor, with its own database connection,
+    # unless the copies were ready before schedule() was even done.
+    try:
+        store_variants(product_id, photo_name, *future.result())
+    except Exception:
+        logger.exception('Could not make the copies of %s', photo_name)
+    finally:
+        _done((product_id, photo_name))
+        if threading.get_ident() != scheduled_in:
+            connections.close_all()
+
+
+def photo_saved(product):
+    '''
+    Called once a product is saved: has the copies of a new photo made,
+    forgets those of a photo that was removed.
+    '''
+    if is_stale(product):
+        try:
+            schedule(product)
+        except Exception:
+            # 'manage.py generate_product_images' tries again.
+            logger.exception('Could not make the copies of %s', product.photo.name)
+    elif not product.photo and product.photo_variants:
+        Product.objects.filter(id=product.id).update(photo_variants={})
+
+
+def urls_for(product):
+    '''
+    Returns the URLs of the product's photo ('original') and of its
+    copies ({name: {'width', 'height', 'url', 'webp'}}), None if it has
+    no photo. The original is all there is until the copies are made.
+    '''
+    if not product.photo:
+        return None
+    urls = {'original': default_storage.url(product.photo.name)}
+    if is_stale(product):
+        return urls
+    for name, variant in product.photo_variants['variants'].items():
+        urls[name] = {
+            'width': variant['width'],
+            'height': variant['height'],
+            'url': default_storage.url(variant.get('jpeg') or variant['png']),
+            'webp': default_storage.url(variant['webp']),
+        }
+    return urls
+
+
+def serve(request, path, document_root=None, show_indexes=False):
+    '''
+    django.views.static.serve() for the media files, telling caches to
+    keep the copies of the photos for good (their names change with their
+    content) and the originals for an hour.
+    '''
+    response = static_serve(request, path, document_root, show_indexes)
+    if response.status_code == 200:
+        if path.startswith(VARIANTS_DIR + '/'):
+            response['Cache-Control'] = 'public, max-age={}, immutable'.format(
+                IMMUTABLE_MAX_AGE)
+        else:
+            response['Cache-Control'] = 'public, max-age={}'.format(PHOTO_MAX_AGE)
+    return response
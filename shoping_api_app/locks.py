@@ -0,0 +1,52 @@
+'''
+Locks for the work a single process is to do at a time: rebuilding a
+ProductList page (see cache.py), writing a guest cart (see
+guest_carts.py). They expire by themselves should their holder die.
+
+They are entries add()ed to a cache, the default one unless 'using'
+names another, add() only succeeding for the first process on the
+local-memory, database, Redis and Memcached backends. The file based backend checks whether the file exists before
+writing it, which two processes can get through together, so with it
+the locks are CacheLock rows instead, the database refusing a second one
+with the same key.
+'''
+from datetime import timedelta
+
+from django.core.cache import DEFAULT_CACHE_ALIAS, caches
+from django.core.cache.backends.filebased import FileBasedCache
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+
+from .models import CacheLock
+
+
+def in_database(using=DEFAULT_CACHE_ALIAS):
+    return isinstance(caches[using], FileBasedCache)
+
+
+def acquire(key, timeout, using=DEFAULT_CACHE_ALIAS):
+    '''
+    Takes the lock named 'key' for 'timeout' seconds. Returns False if
+    it is held already.
+    '''
+    if not in_database(using):
+        return caches[using].add(key, True, timeout)
+    now = timezone.now()
+    # Takes over from a holder that let it expire.
+    CacheLock.objects.filter(key=key, expires__lte=now).delete()
+    try:
+        with transaction.atomic():
+            CacheLock.objects.create(key=key, expires=now + timedelta(seconds=timeout))
+    except IntegrityError:
+        return False
+    return True
+
+
+def release(keys, using=DEFAULT_CACHE_ALIAS):
+    '''
+    Lets go of the given locks.
+    '''
+    if in_database(using):
+        CacheLock.objects.filter(key__in=keys).delete()
+    else:
+        caches[using].delete_many(keys)
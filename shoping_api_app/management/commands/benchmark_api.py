@@ -0,0 +1,84 @@
+import json
+import random
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.test import Client
+from django.test.utils import (setup_databases, setup_test_environment,
+                               teardown_databases, teardown_test_environment)
+
+from shoping_api_app import benchmarks
+
+
+class Command(BaseCommand):
+    help = ('Benchmarks the API against a synthetic catalog in a throwaway '
+            'test database, reporting latency percentiles, throughput and '
+            'queries per request as JSON.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--products', type=int, default=10000)
+        parser.add_argument('--carts', type=int, default=100)
+        parser.add_argument('--items-per-cart', type=int, default=10)
+        parser.add_argument('--requests', type=int, default=200,
+                            help='Number of requests per scenario.')
+        parser.add_argument('--scenario', action='append', dest='scenarios',
+                            help='Only run this scenario (can be repeated).')
+        parser.add_argument('--warm-cache', action='store_true',
+                            help='Keep the cache between requests instead of clearing it.')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--output', help='File to write the results to.')
+        parser.add_argument('--baseline', help='Results of an earlier run to compare with.')
+        parser.add_argument('--tolerance', type=float, default=0.2,
+                            help='Growth of p95 latency or queries per request '
+                                 'counted as a regression (0.2 is 20%%).')
+
+    def handle(self, *args, **options):
+        baseline = None
+        if options['baseline']:
+            with open(options['baseline'], encoding='utf-8') as file:
+                baseline = json.load(file)
+
+        setup_test_environment()
+        databases = setup_databases(verbosity=0, interactive=False)
+        try:
+            results = self.benchmark(options)
+        finally:
+            teardown_databases(databases, verbosity=0)
+            teardown_test_environment()
+
+        output = json.dumps(results, indent=2)
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf-8') as file:
+                file.write(output + '\n')
+        else:
+            self.stdout.write(output)
+
+        if baseline is not None:
+            lines, regressions = benchmarks.compare(results, baseline, options['tolerance'])
+            for line in lines:
+                self.stderr.write(line)
+            if regressions:
+                raise CommandError('Regressed: {}'.format(', '.join(regressions)))
+
+    def benchmark(self, options):
+        rng = random.Random(options['seed'])
+        started = time.perf_counter()
+        benchmarks.seed(options['products'], options['carts'],
+                        options['items_per_cart'], rng)
+        self.stderr.write('Seeded in {:.1f}s'.format(time.perf_counter() - started))
+
+        client = Client()
+        results = {
+            'environment': benchmarks.environment(
+                products=options['products'], carts=options['carts'],
+                items_per_cart=options['items_per_cart'],
+                requests=options['requests'], warm_cache=options['warm_cache']),
+            'scenarios': {},
+        }
+        for name, scenario in benchmarks.scenarios(options['products'], rng):
+            if options['scenarios'] and name not in options['scenarios']:
+                continue
+            results['scenarios'][name] = benchmarks.run(
+                client, scenario, options['requests'], options['warm_cache'])
+            self.stderr.write('{}: {}'.format(name, results['scenarios'][name]))
+        return results
@@ -0,0 +1,56 @@
+import json
+import random
+
+from django.core.management.base import BaseCommand
+from django.test.utils import (setup_databases, setup_test_environment,
+                               teardown_databases, teardown_test_environment)
+from rest_framework.renderers import JSONRenderer
+
+from shoping_api_app import benchmarks
+from shoping_api_app.models import Product
+from shoping_api_app.renderers import FastJSONRenderer
+from shoping_api_app.serializers import ProductSerializer
+
+
+class PlainProductSerializer(ProductSerializer):
+    # Every field through DRF's own get_attribute()/to_representation().
+    compile_fields = False
+
+
+class Command(BaseCommand):
+    help = ('Times serializing and rendering a page of products, with DRF '
+            'as it comes (ProductSerializer without its field plan, '
+            'JSONRenderer) and with the fast path (field plan, '
+            'FastJSONRenderer).')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--page-size', type=int, default=100)
+        parser.add_argument('--rounds', type=int, default=200)
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, page_size, rounds, seed, **options):
+        setup_test_environment()
+        databases = setup_databases(verbosity=0, interactive=False)
+        try:
+            benchmarks.seed(page_size, max(page_size // 2, 1), 5, random.Random(seed))
+            products = list(Product.objects.select_related('stats')[:page_size])
+            results = {}
+            for name, fields in (('full', None), ('compact', ProductSerializer.compact_fields)):
+                plain = benchmarks.time_serialization(
+                    PlainProductSerializer, products, JSONRenderer().render, rounds,
+                    fields=fields)
+                fast = benchmarks.time_serialization(
+                    ProductSerializer, products, FastJSONRenderer().render, rounds,
+                    fields=fields)
+                results[name] = {
+                    'drf': plain,
+                    'fast': fast,
+                    'speedup': round(plain['total_ms'] / fast['total_ms'], 2),
+                }
+        finally:
+            teardown_databases(databases, verbosity=0)
+            teardown_test_environment()
+        self.stdout.write(json.dumps({
+            'environment': benchmarks.environment(page_size=page_size, rounds=rounds),
+            'representations': results,
+        }, indent=2))
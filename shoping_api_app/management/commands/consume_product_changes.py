@@ -0,0 +1,34 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from shoping_api_app import outbox
+
+
+class Command(BaseCommand):
+    help = ('Evicts the products changed since the last run from the cache, '
+            'for caches shared by the processes of a node (the web processes '
+            'poll the changes for their own local memory caches), and prunes '
+            'the changes older than PRODUCT_CHANGES_RETENTION seconds.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=float, default=0,
+                            help='Seconds between runs, run once if 0.')
+        parser.add_argument('--batch-size', type=int, default=outbox.BATCH_SIZE,
+                            help='Changes read and applied at a time.')
+        parser.add_argument('--no-prune', action='store_true',
+                            help='Leave the old changes alone.')
+
+    def handle(self, *args, **options):
+        retention = timezone.timedelta(
+            seconds=getattr(settings, 'PRODUCT_CHANGES_RETENTION', 24 * 60 * 60))
+        while True:
+            applied = outbox.consume(options['batch_size'])
+            pruned = 0 if options['no_prune'] else outbox.prune(timezone.now() - retention)
+            self.stdout.write(self.style.SUCCESS(
+                'Applied {} changes, pruned {}.'.format(applied, pruned)))
+            if not options['interval']:
+                return
+            time.sleep(options['interval'])
@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand
+
+from shoping_api_app import export
+from shoping_api_app.models import Product
+
+
+class Command(BaseCommand):
+    help = 'Exports the catalog as NDJSON or CSV, to a file or the standard output.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--format', choices=sorted(export.FORMATS),
+                            default='ndjson', dest='export_format')
+        parser.add_argument('--output', help='File to write to, the standard output by default.')
+        parser.add_argument('--chunk-size', type=int,
+                            help='Number of products read from the database at a time.')
+        parser.add_argument('--on-sale', action='store_true',
+                            help='Only export the products on sale now.')
+
+    def handle(self, *args, export_format, output, chunk_size, on_sale, **options):
+        queryset = Product.objects.all()
+        if on_sale:
+            queryset = queryset.on_sale()
+        lines = export.export_lines(export_format, queryset, chunk_size)
+        if output is None:
+            for line in lines:
+                self.stdout.write(line, ending='')
+            return
+        with open(output, 'w', newline='', encoding='utf-8') as file:
+            file.writelines(lines)
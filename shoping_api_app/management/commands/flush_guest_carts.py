@@ -0,0 +1,32 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from shoping_api_app import guest_carts
+
+
+class Command(BaseCommand):
+    help = ('Writes the guest carts checked out while checkouts are deferred '
+            '(GUEST_CART_DEFERRED_CHECKOUT) to the database, in batches.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help='Carts written per transaction.')
+        parser.add_argument('--interval', type=float, default=0,
+                            help='Seconds between runs, run once if 0.')
+
+    def handle(self, *args, **options):
+        while True:
+            started = time.monotonic()
+            total = 0
+            while True:
+                flushed = guest_carts.flush_queued(options['batch_size'])
+                total += flushed
+                if not flushed:
+                    break
+            self.stdout.write(self.style.SUCCESS(
+                'Flushed {} checked out guest carts in {:.1f}s.'.format(
+                    total, time.monotonic() - started)))
+            if not options['interval']:
+                return
+            time.sleep(options['interval'])
@@ -0,0 +1,64 @@
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import django
+from django.core.management.base import BaseCommand
+
+from shoping_api_app import images
+from shoping_api_app.models import Product
+
+
+def _init_worker():
+    # Needed when the workers are spawned rather than forked.
+    django.setup()
+
+
+def render(product_id, photo_name, variants):
+    '''
+    Runs in the worker processes: reads a photo and makes its copies.
+    '''
+    return (product_id, photo_name) + images.render_photo(photo_name, variants)
+
+
+class Command(BaseCommand):
+    help = ('Makes the resized copies of the product photos that do not have '
+            'them yet (or of all photos with --all), e.g. after adding a width '
+            'to PRODUCT_IMAGE_VARIANTS.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true', dest='everything',
+                            help='Make them again for every photo.')
+        parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                            help='Number of processes resizing photos '
+                                 '(0 does it all in this process).')
+
+    def handle(self, *args, everything, workers, **options):
+        products = Product.objects.exclude(photo='').exclude(photo__isnull=True).only(
+            'id', 'photo', 'photo_variants')
+        jobs = [(product.id, product.photo.name, images.get_variants())
+                for product in products.iterator()
+                if everything or images.is_stale(product)]
+        started = time.monotonic()
+        done = failed = 0
+        if workers:
+            with ProcessPoolExecutor(workers, initializer=_init_worker) as executor:
+                futures = [executor.submit(render, *job) for job in jobs]
+                for job, future in zip(jobs, futures):
+                    failed += not self.store(job, future.result)
+                    done += 1
+        else:
+            for job in jobs:
+                failed += not self.store(job, lambda: render(*job))
+                done += 1
+        self.stdout.write(self.style.SUCCESS(
+            'Made the copies of {} photos ({} failed) in {:.1f}s.'.format(
+                done - failed, failed, time.monotonic() - started)))
+
+    def store(self, job, get_result):
+        try:
+            images.store_variants(*get_result())
+        except Exception as exc:
+            self.stderr.write('Product {} ({}): {}'.format(job[0], job[1], exc))
+            return False
+        return True
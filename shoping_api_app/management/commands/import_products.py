@@ -0,0 +1,175 @@
+import csv
+import json
+import os
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+
+import django
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from shoping_api_app import bulk
+from shoping_api_app.models import ImportCheckpoint
+
+
+def read_rows(path, file_format):
+    '''
+    Yields the rows of the file: raw lines for NDJSON (decoded by the
+    workers), dicts for CSV. Blank NDJSON lines are not rows.
+    '''
+    with open(path, newline='', encoding='utf-8') as file:
+        if file_format == 'csv':
+            yield from csv.DictReader(file)
+        else:
+            yield from (line for line in file if line.strip())
+
+
+def parse_and_validate(start, rows, file_format):
+    '''
+    Runs in the worker processes: decodes and validates a batch of rows.
+    '''
+    if file_format == 'ndjson':
+        rows = [_decode(line) for line in rows]
+    else:
+        # Empty CSV cells are missing values, not empty strings.
+        rows = [{key: value for key, value in row.items() if value != ''}
+                for row in rows]
+    return bulk.validate_products(rows, start)
+
+
+def _decode(line):
+    try:
+        return json.loads(line)
+    except ValueError as exc:
+        return ValueError('Invalid JSON: {}'.format(exc))
+
+
+def _init_worker():
+    # Needed when the workers are spawned rather than forked.
+    django.setup()
+
+
+class Checkpoint:
+    '''
+    Number of rows of an input file already imported, kept in the database
+    (an ImportCheckpoint) so that an interrupted import carries on from
+    there. It is saved in the transaction writing the rows, a crash cannot
+    leave rows imported but not counted, and imported again on resume.
+    '''
+
+    def __init__(self, name, source):
+        self.name = name
+        self.source = os.path.abspath(source)
+        self.size = os.path.getsize(source)
+
+    def load(self):
+        saved = ImportCheckpoint.objects.filter(name=self.name).first()
+        if saved is None:
+            return 0
+        if saved.source != self.source or saved.size != self.size:
+            raise CommandError(
+                'The checkpoint {} belongs to another input, use --restart to '
+                'ignore it.'.format(self.name))
+        return saved.rows
+
+    def save(self, rows):
+        ImportCheckpoint.objects.update_or_create(name=self.name, defaults={
+            'source': self.source, 'size': self.size, 'rows': rows})
+
+    def clear(self):
+        ImportCheckpoint.objects.filter(name=self.name).delete()
+
+
+class Command(BaseCommand):
+    help = ('Imports products from a CSV or NDJSON file, validated like '
+            'ProductSerializer and written in batches. An interrupted import '
+            'resumes from its checkpoint when run again.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('path')
+        parser.add_argument('--format', choices=('csv', 'ndjson'), dest='file_format',
+                            help='Format of the file, guessed from its extension by default.')
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='Number of products written per transaction.')
+        parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                            help='Number of processes decoding and validating rows '
+                                 '(0 does it all in this process).')
+        parser.add_argument('--checkpoint',
+                            help='Name of the checkpoint, the absolute path of the file '
+                                 'by default.')
+        parser.add_argument('--restart', action='store_true',
+                            help='Start from the first row, ignoring any checkpoint.')
+
+    def handle(self, *args, path, file_format, batch_size, workers, checkpoint,
+               restart, **options):
+        if not os.path.exists(path):
+            raise CommandError('No such file: {}'.format(path))
+        file_format = file_format or ('csv' if path.endswith('.csv') else 'ndjson')
+        checkpoint = Checkpoint(checkpoint or os.path.abspath(path), path)
+        done = 0 if restart else checkpoint.load()
+        if done:
+            self.stdout.write('Resuming after row {}.'.format(done))
+
+        rows = islice(read_rows(path, file_format), done, None)
+        batches = ((start, batch, file_format) for start, batch in enumerate_batches(
+            rows, batch_size, done))
+
+        self.started = time.monotonic()
+        self.imported = self.invalid = 0
+        self.first_row = done
+        if workers:
+            with ProcessPoolExecutor(workers, initializer=_init_worker) as executor:
+                for start, batch, (valid, errors) in self.run_in(executor, batches, workers):
+                    self.save(checkpoint, start, batch, valid, errors)
+        else:
+            for start, batch, file_format in batches:
+                valid, errors = parse_and_validate(start, batch, file_format)
+                self.save(checkpoint, start, batch, valid, errors)
+
+        checkpoint.clear()
+        self.stdout.write(self.style.SUCCESS(
+            'Imported {} products, {} invalid rows.'.format(self.imported, self.invalid)))
+
+    def run_in(self, executor, batches, workers):
+        '''
+        Validates the batches in the pool, keeping only a couple of batches
+        per worker in flight, and yields the results in order.
+        '''
+        pending = deque()
+        for start, batch, file_format in batches:
+            pending.append((start, batch, executor.submit(
+                parse_and_validate, start, batch, file_format)))
+            if len(pending) >= workers * 2:
+                start, batch, future = pending.popleft()
+                yield start, batch, future.result()
+        while pending:
+            start, batch, future = pending.popleft()
+            yield start, batch, future.result()
+
+    def save(self, checkpoint, start, batch, valid, errors):
+        with transaction.atomic():
+            created, updated, save_errors = bulk.save_products(valid)
+            checkpoint.save(start + len(batch))
+
+        errors = sorted(errors + save_errors, key=lambda error: error['index'])
+        for error in errors:
+            self.stderr.write('Row {}: {}'.format(
+                error['index'] + 1, json.dumps(error['errors'])))
+        self.imported += len(created) + len(updated)
+        self.invalid += len(errors)
+        rows = start + len(batch) - self.first_row
+        elapsed = time.monotonic() - self.started
+        self.stdout.write('{} rows ({} imported, {} invalid), {:.0f} rows/s'.format(
+            start + len(batch), self.imported, self.invalid,
+            rows / elapsed if elapsed else 0))
+
+
+def enumerate_batches(rows, batch_size, start=0):
+    '''
+    Yields (index of the first row, rows) for consecutive batches.
+    '''
+    for batch in bulk.batches(rows, batch_size):
+        yield start, batch
+        start += len(batch)
@@ -0,0 +1,23 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from shoping_api_app import cache as product_cache
+from shoping_api_app import outbox
+from shoping_api_app import stats as product_stats
+
+
+class Command(BaseCommand):
+    help = ('Recomputes the statistics of every product (quantity in shopping '
+            'carts, number of carts) from the shopping cart items, e.g. after '
+            'items were written without going through the models.')
+
+    def handle(self, *args, **options):
+        started = time.monotonic()
+        count = product_stats.rebuild()
+        # 'average_product_sold' of the cached products may have changed.
+        product_cache.evict_all()
+        outbox.record_all()
+        self.stdout.write(self.style.SUCCESS(
+            'Rebuilt the statistics of {} products in {:.1f}s.'.format(
+                count, time.monotonic() - started)))
@@ -0,0 +1,37 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from shoping_api_app import prices
+
+
+class Command(BaseCommand):
+    help = ('Recomputes the stored effective price of the products whose sale '
+            'started or ended, for filtering and sorting the products by what '
+            'is paid for them. Run it every minute or so, e.g. from cron with '
+            '--since 120, or keep it running with --interval.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--since', type=float, default=None,
+                            help='Only the sales that started or ended in the last '
+                                 'SINCE seconds (all products otherwise).')
+        parser.add_argument('--interval', type=float, default=0,
+                            help='Seconds between runs, each catching up from the '
+                                 'previous one; run once if 0.')
+
+    def handle(self, *args, **options):
+        since = None
+        if options['since'] is not None:
+            since = timezone.now() - timezone.timedelta(seconds=options['since'])
+        while True:
+            started = time.monotonic()
+            now = timezone.now()
+            changed = prices.refresh(since, now)
+            self.stdout.write(self.style.SUCCESS(
+                'Updated the effective price of {} products in {:.1f}s.'.format(
+                    len(changed), time.monotonic() - started)))
+            if not options['interval']:
+                return
+            since = now
+            time.sleep(options['interval'])
@@ -0,0 +1,32 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from shoping_api_app import db
+
+
+class Command(BaseCommand):
+    help = ('Copies the database into the read replica (DATABASE_REPLICA_PATH), '
+            'for running SQLite with a replica. Run it periodically, e.g. from '
+            'cron, with --interval to keep copying.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--pages', type=int, default=1024,
+                            help='Pages copied at a time (-1 for all at once).')
+        parser.add_argument('--interval', type=float, default=0,
+                            help='Seconds between copies, copy once if 0.')
+
+    def handle(self, *args, **options):
+        if not db.has_replica():
+            raise CommandError('There is no replica, set DATABASE_REPLICA_PATH.')
+        while True:
+            started = time.monotonic()
+            try:
+                pages = db.sync_replica(options['pages'])
+            except ValueError as error:
+                raise CommandError(error)
+            self.stdout.write(self.style.SUCCESS(
+                'Copied {} pages in {:.1f}s.'.format(pages, time.monotonic() - started)))
+            if not options['interval']:
+                return
+            time.sleep(options['interval'])
@@ -0,0 +1,204 @@
+'''
+Per request instrumentation: number of SQL queries, time spent in the
+database, time spent serializing and total latency, aggregated per URL
+name ('listing-all-products', 'retrieving-updating-deleting-products',
+...) and exposed in the Prometheus text format by metrics_view.
+
+The numbers are kept per process, every worker exposes its own.
+'''
+import contextvars
+import threading
+import time
+from contextlib import ExitStack, contextmanager
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.db import connections
+from django.http import HttpResponse
+
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_current = contextvars.ContextVar('request_metrics', default=None)
+
+
+class RequestMetrics:
+    '''
+    What one request cost, filled in while it is handled.
+    '''
+
+    def __init__(self):
+        self.queries = 0
+        self.db_seconds = 0.0
+        self.serialization_seconds = 0.0
+        self.seconds = 0.0
+        self.url_name = None
+
+    def __call__(self, execute, sql, params, many, context):
+        # connection.execute_wrapper() hook, timing every query.
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries += 1
+            self.db_seconds += time.perf_counter() - started
+
+
+@contextmanager
+def timed_serialization():
+    '''
+    Adds the time spent in the block to the current request's
+    serialization time, if a request is being measured.
+    '''
+    metrics = _current.get()
+    if metrics is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics.serialization_seconds += time.perf_counter() - started
+
+
+class Registry:
+    '''
+    Running totals per URL name.
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.endpoints = {}
+
+    def record(self, metrics):
+        with self.lock:
+            endpoint = self.endpoints.setdefault(metrics.url_name, {
+                'requests': 0,
+                'queries': 0,
+                'db_seconds': 0.0,
+                'serialization_seconds': 0.0,
+                'seconds': 0.0,
+                'buckets': [0] * len(LATENCY_BUCKETS),
+            })
+            endpoint['requests'] += 1
+            endpoint['queries'] += metrics.queries
+            endpoint['db_seconds'] += metrics.db_seconds
+            endpoint['serialization_seconds'] += metrics.serialization_seconds
+            endpoint['seconds'] += metrics.seconds
+            for index, bound in enumerate(LATENCY_BUCKETS):
+                if metrics.seconds <= bound:
+                    endpoint['buckets'][index] += 1
+
+    def render(self):
+        '''
+        Returns the totals in the Prometheus text exposition format.
+        '''
+        with self.lock:
+            endpoints = {name: dict(endpoint, buckets=list(endpoint['buckets']))
+                         for name, endpoint in self.endpoints.items()}
+        lines = []
+
+        def family(name, kind, help_text, samples, suffix=''):
+            lines.append('# HELP {} {}'.format(name, help_text))
+            lines.append('# TYPE {} {}'.format(name, kind))
+            for labels, value in samples:
+                lines.append('{}{}{{{}}} {}'.format(name, suffix, ','.join(
+                    '{}="{}"'.format(key, label) for key, label in labels), value))
+
+        def totals(key):
+            return [((('url_name', name),), endpoint[key])
+                    for name, endpoint in sorted(endpoints.items())]
+
+        family('shopping_api_requests_total', 'counter',
+               'Requests handled.', totals('requests'))
+        family('shopping_api_db_queries_total', 'counter',
+               'SQL queries run.', totals('queries'))
+        family('shopping_api_db_seconds_total', 'counter',
+               'Time spent running SQL queries.', totals('db_seconds'))
+        family('shopping_api_serialization_seconds_total', 'counter',
+               'Time spent in the serializers.', totals('serialization_seconds'))
+
+        samples = []
+        for name, endpoint in sorted(endpoints.items()):
+            for bound, count in zip(LATENCY_BUCKETS, endpoint['buckets']):
+                samples.append(((('url_name', name), ('le', bound)), count))
+            samples.append(((('url_name', name), ('le', '+Inf')), endpoint['requests']))
+        family('shopping_api_request_duration_seconds', 'histogram',
+               'Time taken to handle requests.', samples, suffix='_bucket')
+        for name, endpoint in sorted(endpoints.items()):
+            lines.append('shopping_api_request_duration_seconds_sum{{url_name="{}"}} {}'
+                         .format(name, endpoint['seconds']))
+            lines.append('shopping_api_request_duration_seconds_count{{url_name="{}"}} {}'
+                         .format(name, endpoint['requests']))
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+
+def _watch(metrics):
+    # Times the queries of the current thread's connections, until the
+    # returned stack is closed.
+    stack = ExitStack()
+    for connection in connections.all():
+        stack.enter_context(connection.execute_wrapper(metrics))
+    return stack
+
+
+class RequestMetricsMiddleware:
+    '''
+    Measures every request and records it in the registry. The
+    measurements are also left on the response as 'response.metrics',
+    for the query budgets of the tests (see testing.py).
+
+    Async under ASGI, so that the async views are not pushed onto a
+    thread by it.
+    '''
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        metrics = RequestMetrics()
+        token = _current.set(metrics)
+        started = time.perf_counter()
+        try:
+            with _watch(metrics):
+                response = self.get_response(request)
+        finally:
+            _current.reset(token)
+        return self.record(request, response, metrics, started)
+
+    async def __acall__(self, request):
+        metrics = RequestMetrics()
+        token = _current.set(metrics)
+        started = time.perf_counter()
+        try:
+            # The queries run in the thread sync_to_async() hands the ORM
+            # and the sync views to, on that thread's own connections.
+            watching = await sync_to_async(_watch)(metrics)
+            try:
+                response = await self.get_response(request)
+            finally:
+                await sync_to_async(watching.close)()
+        finally:
+            _current.reset(token)
+        return self.record(request, response, metrics, started)
+
+    def record(self, request, response, metrics, started):
+        metrics.seconds = time.perf_counter() - started
+        match = request.resolver_match
+        metrics.url_name = (match and match.url_name) or 'unresolved'
+        registry.record(metrics)
+        response.metrics = metrics
+        return response
+
+
+def metrics_view(request):
+    return HttpResponse(registry.render(),
+                        content_type='text/plain; version=0.0.4; charset=utf-8')
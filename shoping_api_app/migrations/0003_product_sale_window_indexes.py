@@ -0,0 +1,21 @@
+# Generated by Django 4.2.30 on 2026-10-18 17:56
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shoping_api_app', '0002_product_keyset_indexes'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(fields=['sale_start', 'sale_end'], name='shoping_api_sale_st_2b272f_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(fields=['sale_end', 'sale_start'], name='shoping_api_sale_en_ea254e_idx'),
+        ),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 4.2.30 on 2026-10-18 18:06
+
+from django.db import migrations, models
+import django.db.models.deletion
+from django.db.models import Count, Sum
+
+
+def compute_stats(apps, schema_editor):
+    ShoppingCartItem = apps.get_model('shoping_api_app', 'ShoppingCartItem')
+    ProductStats = apps.get_model('shoping_api_app', 'ProductStats')
+    totals = ShoppingCartItem.objects.values('product_id').annotate(
+        total_quantity=Sum('quantity'),
+        cart_count=Count('shopping_cart', distinct=True),
+    ).order_by('product_id')
+    ProductStats.objects.bulk_create(
+        (ProductStats(**row) for row in totals), batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shoping_api_app', '0004_product_updated_at'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProductStats',
+            fields=[
+                ('product', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='stats', serialize=False, to='shoping_api_app.product')),
+                ('total_quantity', models.PositiveIntegerField(default=0)),
+                ('cart_count', models.PositiveIntegerField(default=0)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['total_quantity', 'product'], name='shoping_api_total_q_64cf26_idx')],
+            },
+        ),
+        migrations.RunPython(compute_stats, migrations.RunPython.noop),
+    ]
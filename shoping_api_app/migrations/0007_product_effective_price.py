@@ -0,0 +1,43 @@
+# Generated by Django 4.2.30 on 2026-10-18 18:22
+
+from django.db import migrations, models
+from django.utils import timezone
+
+
+DISCOUNT_RATE = 0.10
+
+
+def compute_effective_prices(apps, schema_editor):
+    Product = apps.get_model('shoping_api_app', 'Product')
+    now = timezone.now()
+    batch = []
+    for product in Product.objects.only('id', 'price', 'sale_start', 'sale_end').iterator():
+        on_sale = bool(product.sale_start and product.sale_start <= now and
+                       (product.sale_end is None or now <= product.sale_end))
+        price = product.price * (1 - DISCOUNT_RATE) if on_sale else product.price
+        product.effective_price = round(price, 2)
+        batch.append(product)
+        if len(batch) == 1000:
+            Product.objects.bulk_update(batch, ['effective_price'])
+            batch = []
+    Product.objects.bulk_update(batch, ['effective_price'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shoping_api_app', '0006_product_photo_variants'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='product',
+            name='effective_price',
+            field=models.FloatField(default=0, editable=False),
+        ),
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(fields=['effective_price', 'id'], name='shoping_api_effecti_4bc994_idx'),
+        ),
+        migrations.RunPython(compute_effective_prices, migrations.RunPython.noop),
+    ]
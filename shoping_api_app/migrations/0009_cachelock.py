@@ -0,0 +1,20 @@
+# Generated by Django 4.2.30 on 2026-10-18 18:42
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shoping_api_app', '0008_productchange'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CacheLock',
+            fields=[
+                ('key', models.CharField(max_length=250, primary_key=True, serialize=False)),
+                ('expires', models.DateTimeField()),
+            ],
+        ),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 4.2.30 on 2026-10-18 18:44
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shoping_api_app', '0009_cachelock'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ImportCheckpoint',
+            fields=[
+                ('name', models.CharField(max_length=1000, primary_key=True, serialize=False)),
+                ('source', models.CharField(max_length=1000)),
+                ('size', models.BigIntegerField()),
+                ('rows', models.IntegerField()),
+            ],
+        ),
+    ]
@@ -1,8 +1,86 @@
 from django.utils import timezone
-from django.db import models
+from django.db import models, transaction
 
 
-class Product(models.Model):
+def sale_is_active(sale_start, sale_end, now=None):
+    '''
+    Returns True if a sale running from sale_start to sale_end (no end
+    meaning it goes on for good) is on at 'now', False otherwise.
+    '''
+    if now is None:
+        now = timezone.now()
+    if sale_start:
+        if sale_end:
+            return sale_start <= now <= sale_end
+        return sale_start <= now
+    return False
+
+
+def sale_price(price, on_sale, discount_rate=0.10):
+    '''
+    Returns what is paid for a product of the given price, rounded.
+    '''
+    # 'price' is a Decimal on instances fresh from ProductSerializer.
+    price = float(price)
+    if on_sale:
+        return round(price * (1 - discount_rate), 2)
+    return round(price, 2)
+
+
+def on_sale_condition(now=None, prefix=''):
+    '''
+    Returns the condition for a product being on sale at 'now', the
+    database side of Product.is_on_sale(). 'prefix' is for applying it
+    through a relation, e.g. 'product__' from ShoppingCartItem.
+    '''
+    if now is None:
+        now = timezone.now()
+    return (models.Q(**{prefix + 'sale_start__lte': now}) &
+            (models.Q(**{prefix + 'sale_end__isnull': True}) |
+             models.Q(**{prefix + 'sale_end__gte': now})))
+
+
+class AtomicSaveModel(models.Model):
+    '''
+    Saves in a transaction that takes in the post_save signal handlers,
+    so that what they write (the product statistics, the change feed)
+    is committed along with the row, or not at all.
+    '''
+
+    class Meta:
+        abstract = True
+
+    def save(self, *args, **kwargs):
+        with transaction.atomic(using=kwargs.get('using')):
+            super().save(*args, **kwargs)
+
+
+class ProductQuerySet(models.QuerySet):
+
+    def on_sale(self, now=None):
+        '''
+        Returns the products that are on sale at 'now' (defaults to the
+        current time). A sale with no end is on sale for good once it
+        has started, like in Product.is_on_sale().
+        '''
+        return self.filter(on_sale_condition(now))
+
+    def next_sale_change(self, now=None):
+        '''
+        Returns the closest sale start or end after 'now' (defaults to
+        the current time) among the products, None if there is none.
+        Two lookups at the start of the sale window indexes.
+        '''
+        if now is None:
+            now = timezone.now()
+        changes = [
+            self.filter(sale_start__gt=now).aggregate(next=models.Min('sale_start'))['next'],
+            self.filter(sale_end__gte=now).aggregate(next=models.Min('sale_end'))['next'],
+        ]
+        return min((change for change in changes if change), default=None)
+
+
+class Product(AtomicSaveModel):
 
     # One of the attributes in class.
     DISCOUNT_RATE = 0.10
@@ -15,18 +93,51 @@ class Product(models.Model):
     sale_end = models.DateTimeField(blank=True, null=True, default=None)
     photo = models.ImageField(blank=True, null=True,
                               default=None, upload_to='products')
+    # The resized copies of the photo, see images.py.
+    photo_variants = models.JSONField(default=dict, blank=True)
+    # current_price() as of the last save or sale start/end, for
+    # filtering and sorting on it in the database, see prices.py.
+    effective_price = models.FloatField(default=0, editable=False)
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
+
+    objects = ProductQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            # For the keyset pages of ProductList ('?pagination=cursor').
+            models.Index(fields=['price', 'id']),
+            models.Index(fields=['sale_start', 'id']),
+            # For Product.objects.on_sale(), whichever end of the sale
+            # window is the more selective one.
+            models.Index(fields=['sale_start', 'sale_end']),
+            models.Index(fields=['sale_end', 'sale_start']),
+            # For ProductList's price ranges and '?ordering=current_price'.
+            models.Index(fields=['effective_price', 'id']),
+        ]
+
+    def save(self, *args, **kwargs):
+        self.set_effective_price()
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None:
+            kwargs['update_fields'] = {*update_fields, 'effective_price'}
+        super().save(*args, **kwargs)
+
+    def set_effective_price(self, now=None):
+        '''
+        Stores the price paid for the product at 'now' (defaults to the
+        current time) in effective_price, without saving it. Writes
+        going around save() (bulk_create() and such) call it themselves.
+        '''
+        self.effective_price = sale_price(
+            self.price, sale_is_active(self.sale_start, self.sale_end, now),
+            self.DISCOUNT_RATE)
 
     def is_on_sale(self):
         '''
         Returns True if there is Sale,
         False otherwise.
         '''
-        now = timezone.now()
-        if self.sale_start:
-            if self.sale_end:
-                return self.sale_start <= now <= self.sale_end
-            return self.sale_start <= now
-        return False
+        return sale_is_active(self.sale_start, self.sale_end)
 
     def get_rounded_price(self):
         '''
@@ -40,10 +151,7 @@ class Product(models.Model):
         If it is on sale, then its sale price or 
         else it's regular price is returned.
         '''
-        if self.is_on_sale():
-            discounted_price = float(self.price * (1 - self.DISCOUNT_RATE))
-            return round(discounted_price, 2)
-        return self.get_rounded_price()
+        return sale_price(self.price, self.is_on_sale(), self.DISCOUNT_RATE)
 
     def __repr__(self):
         '''
@@ -52,33 +160,59 @@ class Product(models.Model):
         return '<Product object ({}) "{}">'.format(self.id, self.name)
 
 
-class ShoppingCart(models.Model):
+class ShoppingCart(AtomicSaveModel):
     TAX_RATE = 0.13
 
     id = models.AutoField(primary_key=True)
     name = models.CharField(max_length=200)
     address = models.CharField(max_length=200)
 
+    def totals(self):
+        '''
+        Returns the subtotal, taxes and total of the Shopping cart,
+        priced in a single query whatever the number of items.
+        '''
+        now = timezone.now()
+        # Priced by sale_price() rather than in SQL, whose ROUND() does
+        # not round halves like Python's round() on floats.
+        lines = [(quantity, sale_price(price, sale_is_active(sale_start, sale_end, now),
+                                       Product.DISCOUNT_RATE))
+                 for quantity, price, sale_start, sale_end in self.items.values_list(
+                     'quantity', 'product__price', 'product__sale_start', 'product__sale_end')]
+        return self.price_lines(lines)
+
+    @classmethod
+    def price_lines(cls, lines):
+        '''
+        Returns the subtotal, taxes and total of (quantity, unit price)
+        lines, the unit prices being rounded to the cent already.
+        '''
+        # Added up in cents, for the order of the lines not to matter.
+        subtotal = sum(quantity * round(price * 100) for quantity, price in lines) / 100
+        taxes = round(cls.TAX_RATE * subtotal, 2)
+        return {
+            'subtotal': subtotal,
+            'taxes': taxes,
+            'total': round(subtotal + taxes, 2),
+        }
+
     def subtotal(self):
         '''
         Returns only the total price exclusive of taxes.
         '''
-        amount = 0.0
-        for item in self.shopping_cart_items:
-            amount += item.quantity * item.product.get_price()
-        return round(amount, 2)
+        return self.totals()['subtotal']
 
     def taxes(self):
         '''
         Returns only the tax price of the Shopping cart.
         '''
-        return round(self.TAX_RATE * self.subtotal(), 2)
+        return self.totals()['taxes']
 
     def total(self):
         '''
         Returns the total price inclusive of taxes.
         '''
-        return round(self.subtotal() * self.taxes(), 2)
+        return self.totals()['total']
 
     def __repr__(self):
         name = self.name or '[Guest]'
@@ -86,7 +220,7 @@ class ShoppingCart(models.Model):
         return '<ShoppingCart object ({}) "{}" "{}">'.format(self.id, name, address)
 
 
-class ShoppingCartItem(models.Model):
+class ShoppingCartItem(AtomicSaveModel):
     # If the shopping cart is deleted, obviously the items inside it are also going to be deleted or gone.
     shopping_cart = models.ForeignKey(
         ShoppingCart, related_name='items', related_query_name='item', on_delete=models.CASCADE)
@@ -100,3 +234,78 @@ class ShoppingCartItem(models.Model):
 
     def __repr__(self):
         return '<ShoppingCartItem object ({}) {}x "{}">'.format(self.id, self.quantity, self.product.name)
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        # Remembers what the item held when it was loaded, so that the
+        # product statistics can be moved by the difference on save.
+        instance = super().from_db(db, field_names, values)
+        instance._loaded_values = dict(zip(field_names, values))
+        return instance
+
+
+class ProductStats(models.Model):
+    '''
+    Running totals of a product's shopping cart items: the quantity of it
+    across all shopping carts and the number of carts it is in. Kept up
+    to date by the signal handlers (see stats.py), and rebuilt from the
+    items by 'manage.py rebuild_product_stats'.
+    '''
+    product = models.OneToOneField(
+        Product, primary_key=True, related_name='stats', on_delete=models.CASCADE)
+    total_quantity = models.PositiveIntegerField(default=0)
+    cart_count = models.PositiveIntegerField(default=0)
+    # For the Last-Modified of the product, see cache.py.
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            # For the top sellers, best selling first.
+            models.Index(fields=['total_quantity', 'product']),
+        ]
+
+    def __repr__(self):
+        return '<ProductStats object ({}) {} in {} carts>'.format(
+            self.product_id, self.total_quantity, self.cart_count)
+
+
+class ProductChange(models.Model):
+    '''
+    A write to a product or to what its representation is built from,
+    recorded in the same transaction as the write for the other processes
+    to evict it from their caches (see outbox.py). No product means all
+    of them. Not a foreign key, the product may be gone.
+    '''
+    seq = models.BigAutoField(primary_key=True)
+    product_id = models.IntegerField(blank=True, null=True)
+    created_at = models.DateTimeField(default=timezone.now, db_index=True)
+
+    def __repr__(self):
+        return '<ProductChange object ({}) {}>'.format(
+            self.seq, self.product_id or 'all products')
+
+
+class CacheLock(models.Model):
+    '''
+    A lock held by one process, in the database for the cache backends
+    whose add() is not atomic (see locks.py).
+    '''
+    key = models.CharField(max_length=250, primary_key=True)
+    expires = models.DateTimeField()
+
+    def __repr__(self):
+        return '<CacheLock object ({})>'.format(self.key)
+
+
+class ImportCheckpoint(models.Model):
+    '''
+    How many rows of a file the import_products command imported, saved
+    in the same transaction as their products.
+    '''
+    name = models.CharField(max_length=1000, primary_key=True)
+    source = models.CharField(max_length=1000)
+    size = models.BigIntegerField()
+    rows = models.IntegerField()
+
+    def __repr__(self):
+        return '<ImportCheckpoint object ({}) {} rows>'.format(self.name, self.rows)
@@ -0,0 +1,178 @@
+'''
+The change feed, for keeping the caches of several processes or nodes
+consistent.
+
+Every write to a product, or to what its representation is built from
+(its shopping cart items, the number of shopping carts), appends a
+ProductChange in the same transaction, numbered in order by 'seq'. The
+process making the write evicts its own cache right away (see
+signals.py). The others, whose caches (local memory ones especially)
+cannot be reached from there, catch up by reading the changes after the
+last one they applied and evicting those products in one go:
+
+- ProductChangesMiddleware does so in every process before handling a
+  request, at most every PRODUCT_CHANGES_POLL_INTERVAL seconds.
+- 'manage.py consume_product_changes' does it from outside the web
+  processes, for a cache they share (file based, say), and prunes the
+  changes older than PRODUCT_CHANGES_RETENTION seconds.
+- '/api/v1/product-changes/?since=<seq>' serves the feed to other
+  services.
+
+The position reached is kept in the cache it applies to. When it is
+missing (a new or culled cache), or the changes right after it were
+pruned already, the whole cache is invalidated instead.
+
+SQLite commits one write at a time, so the changes are committed in the
+order of their 'seq' and none shows up behind a position already reached.
+'''
+import logging
+import threading
+import time
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DatabaseError
+from django.db.models import Max
+
+from . import cache as product_cache
+from .models import ProductChange
+
+
+POSITION_KEY = 'product_changes_position'
+BATCH_SIZE = 500
+
+logger = logging.getLogger(__name__)
+
+
+def record(product_ids):
+    '''
+    Records changes to the given products, in the current transaction.
+    '''
+    ProductChange.objects.bulk_create(
+        [ProductChange(product_id=product_id) for product_id in product_ids])
+
+
+def record_all():
+    '''
+    Records a change to every product (the number of shopping carts
+    feeds into all of them).
+    '''
+    ProductChange.objects.create(product_id=None)
+
+
+def last_seq():
+    return ProductChange.objects.aggregate(seq=Max('seq'))['seq'] or 0
+
+
+def changes_since(seq, limit=BATCH_SIZE):
+    '''
+    Returns the first 'limit' changes after 'seq', and whether changes
+    after 'seq' may have been pruned already.
+    '''
+    oldest = ProductChange.objects.order_by('seq').values_list('seq', flat=True).first()
+    pruned = oldest is not None and seq < oldest - 1
+    changes = list(ProductChange.objects.filter(seq__gt=seq).order_by('seq')[:limit])
+    return changes, pruned
+
+
+def apply(changes):
+    '''
+    Evicts the products of the given changes from the cache.
+    '''
+    product_ids = set()
+    for change in changes:
+        if change.product_id is None:
+            product_cache.evict_all()
+            return
+        product_ids.add(change.product_id)
+    if product_ids:
+        product_cache.evict_products(product_ids)
+
+
+def _start_over():
+    # Read before evicting, for the changes made meanwhile to be applied
+    # on the next run.
+    position = last_seq()
+    product_cache.evict_all()
+    cache.set(POSITION_KEY, position, timeout=None)
+
+
+def consume(batch_size=BATCH_SIZE):
+    '''
+    Applies the changes made since the last ones applied to the cache,
+    batch by batch. Returns the number of changes applied.
+    '''
+    position = cache.get(POSITION_KEY)
+    if position is None:
+        _start_over()
+        return 0
+    applied = 0
+    while True:
+        changes, pruned = changes_since(position, batch_size)
+        if pruned:
+            _start_over()
+            return applied
+        if not changes:
+            return applied
+        apply(changes)
+        position = changes[-1].seq
+        cache.set(POSITION_KEY, position, timeout=None)
+        applied += len(changes)
+        if len(changes) < batch_size:
+            return applied
+
+
+def prune(before):
+    '''
+    Deletes the changes made before 'before', keeping the last one to
+    tell how far they were pruned. Returns the number deleted.
+    '''
+    deleted, _ = ProductChange.objects.filter(
+        created_at__lt=before, seq__lt=last_seq()).delete()
+    return deleted
+
+
+class ProductChangesMiddleware:
+    '''
+    Applies the changes made by the other processes to the cache of this
+    one, at most every PRODUCT_CHANGES_POLL_INTERVAL seconds, before the
+    request is handled. Async under ASGI, reading the changes in a thread.
+    '''
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.interval = getattr(settings, 'PRODUCT_CHANGES_POLL_INTERVAL', 1)
+        self.next_poll = 0
+        self.lock = threading.Lock()
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        if self.is_due():
+            self.poll()
+        return self.get_response(request)
+
+    async def __acall__(self, request):
+        if self.is_due():
+            await sync_to_async(self.poll)()
+        return await self.get_response(request)
+
+    def is_due(self):
+        # A single thread polls, the others go on with their requests.
+        if time.monotonic() >= self.next_poll and self.lock.acquire(blocking=False):
+            self.next_poll = time.monotonic() + self.interval
+            return True
+        return False
+
+    def poll(self):
+        try:
+            consume()
+        except DatabaseError:
+            logger.exception('Could not read the product changes')
+        finally:
+            self.lock.release()
@@ -0,0 +1,179 @@
+import json
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+
+from django.db import connections
+from django.db.models import Max, Q
+from django.utils.dateparse import parse_datetime
+from rest_framework.exceptions import NotFound, ValidationError
+from rest_framework.pagination import BasePagination, LimitOffsetPagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+
+def positive_int(value, strict=False, cutoff=None):
+    '''
+    Returns the integer in a query parameter, raising ValueError if it
+    is negative (or zero when 'strict'), and capped at 'cutoff'.
+    '''
+    value = int(value)
+    if value < 0 or (strict and value == 0):
+        raise ValueError(value)
+    if cutoff is not None:
+        value = min(value, cutoff)
+    return value
+
+
+class ProductsPagination(LimitOffsetPagination):
+    '''
+    Setting the default and maximum limit a client can request
+    for number of response objects on a single page.
+    '''
+    default_limit = 10
+    max_limit = 100
+
+
+class ProductsCursorPagination(BasePagination):
+    '''
+    Keyset pagination for walking through the whole catalog, asked for
+    with '?pagination=cursor' (the 'next' links then carry a 'cursor').
+
+    Each page continues right after the last product of the previous
+    one, using the (ordering field, id) pair rather than an OFFSET, so
+    the last page is as quick to get as the first. No COUNT(*) is run
+    unless '?count=exact' or '?count=estimate' is given.
+
+    Products can be ordered by 'id' (default), 'price', 'current_price'
+    (the stored effective price, see prices.py) or 'sale_start', ascending
+    or descending ('-price'), with 'id' breaking ties. Products with no
+    'sale_start' are left out when ordering by it.
+    '''
+    default_limit = 10
+    max_limit = 100
+    limit_query_param = 'limit'
+    cursor_query_param = 'cursor'
+    ordering_query_param = 'ordering'
+    count_query_param = 'count'
+    orderings = ('id', 'price', 'current_price', 'sale_start')
+    # The columns of the orderings not named after theirs.
+    columns = {'current_price': 'effective_price'}
+    invalid_cursor_message = 'Invalid cursor'
+
+    @classmethod
+    def is_requested(cls, request):
+        params = request.query_params
+        return (params.get('pagination') == 'cursor' or
+                cls.cursor_query_param in params)
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.base_url = request.build_absolute_uri()
+        self.limit = self.get_limit(request)
+        self.field, self.descending = self.get_ordering(request)
+        self.field = self.columns.get(self.field, self.field)
+
+        if self.field != 'id':
+            queryset = queryset.exclude(**{self.field + '__isnull': True})
+        self.count = self.get_count(queryset, request)
+        prefix = '-' if self.descending else ''
+        queryset = queryset.order_by(prefix + self.field, prefix + 'id')
+
+        position = self.decode_cursor(request)
+        if position is not None:
+            queryset = queryset.filter(self.after(*position))
+
+        products = list(queryset[:self.limit + 1])
+        self.has_next = len(products) > self.limit
+        self.page = products[:self.limit]
+        return self.page
+
+    def after(self, value, product_id):
+        '''
+        Returns the condition for the products coming after the given
+        position in the current ordering.
+        '''
+        lookup = '__lt' if self.descending else '__gt'
+        if self.field == 'id':
+            return Q(**{'id' + lookup: product_id})
+        return (Q(**{self.field + lookup: value}) |
+                Q(**{self.field: value, 'id' + lookup: product_id}))
+
+    def get_limit(self, request):
+        try:
+            return positive_int(request.query_params[self.limit_query_param],
+                                strict=True, cutoff=self.max_limit)
+        except (KeyError, ValueError):
+            return self.default_limit
+
+    def get_ordering(self, request):
+        ordering = request.query_params.get(self.ordering_query_param, 'id')
+        field = ordering.lstrip('-')
+        if field not in self.orderings:
+            raise ValidationError({self.ordering_query_param: (
+                'Ordering must be one of {}, optionally prefixed with "-".'
+                .format(', '.join(self.orderings)))})
+        return field, ordering.startswith('-')
+
+    def get_count(self, queryset, request):
+        count = request.query_params.get(self.count_query_param)
+        if count == 'exact':
+            return queryset.count()
+        if count == 'estimate':
+            return estimate_count(queryset)
+        return None
+
+    def decode_cursor(self, request):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if encoded is None:
+            return None
+        try:
+            value, product_id = json.loads(
+                urlsafe_b64decode(encoded.encode('ascii')))
+            product_id = int(product_id)
+            if self.field in ('price', 'effective_price'):
+                value = float(value)
+            elif self.field == 'sale_start':
+                value = parse_datetime(value)
+                if value is None:
+                    raise ValueError(value)
+        except (TypeError, ValueError):
+            raise NotFound(self.invalid_cursor_message)
+        return value, product_id
+
+    def encode_cursor(self, product):
+        value = getattr(product, self.field)
+        if self.field == 'sale_start':
+            value = value.isoformat()
+        encoded = urlsafe_b64encode(
+            json.dumps([value, product.id]).encode('ascii')).decode('ascii')
+        return replace_query_param(self.base_url, self.cursor_query_param, encoded)
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        return self.encode_cursor(self.page[-1])
+
+    def get_paginated_response(self, data):
+        body = {'next': self.get_next_link(), 'results': data}
+        if self.count is not None:
+            body = {'count': self.count, **body}
+        return Response(body)
+
+
+def estimate_count(queryset):
+    '''
+    Returns a rough number of rows for the queryset without counting
+    them. Only unfiltered querysets can be estimated (from the table
+    statistics on PostgreSQL, from the largest id elsewhere); filtered
+    ones are counted exactly.
+    '''
+    if queryset.query.where:
+        return queryset.count()
+    connection = connections[queryset.db]
+    if connection.vendor == 'postgresql':
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT reltuples FROM pg_class WHERE relname = %s',
+                           [queryset.model._meta.db_table])
+            row = cursor.fetchone()
+        if row and row[0] >= 0:
+            return int(row[0])
+    return queryset.aggregate(estimate=Max('pk'))['estimate'] or 0
@@ -0,0 +1,59 @@
+import json
+
+from django.conf import settings
+from rest_framework.exceptions import ParseError
+from rest_framework.parsers import BaseParser, JSONParser
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+
+def loads(data):
+    '''
+    Decodes JSON (bytes or str) with orjson when it is installed, with
+    the json module otherwise. Invalid JSON raises a ValueError.
+    '''
+    if orjson is None:
+        return json.loads(data)
+    return orjson.loads(data)
+
+
+class FastJSONParser(JSONParser):
+    '''
+    JSONParser decoding with orjson, for UTF-8 bodies (orjson does not
+    take any other encoding) when it is installed.
+    '''
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        parser_context = parser_context or {}
+        encoding = parser_context.get('encoding', settings.DEFAULT_CHARSET)
+        if orjson is None or encoding.lower().replace('-', '') != 'utf8':
+            return super().parse(stream, media_type, parser_context)
+        try:
+            return orjson.loads(stream.read())
+        except ValueError as exc:
+            raise ParseError('JSON parse error - %s' % str(exc))
+
+
+class NDJSONParser(BaseParser):
+    '''
+    Parses newline delimited JSON, one object per line. The lines are
+    decoded lazily as the returned iterator is consumed, so a large body
+    never has to be held in memory as a whole. A line that is not valid
+    JSON comes out as a ParseError instead of stopping the iteration.
+    '''
+    media_type = 'application/x-ndjson'
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        return self.iter_lines(stream)
+
+    def iter_lines(self, stream):
+        for number, line in enumerate(stream, 1):
+            if not line.strip():
+                continue
+            try:
+                yield loads(line)
+            except ValueError as exc:
+                yield ParseError('Line {}: {}'.format(number, exc))
@@ -0,0 +1,59 @@
+'''
+Keeping Product.effective_price, the price paid for a product, stored
+for ProductList to filter and sort on in the database ('?min_price=',
+'?max_price=' and '?ordering=current_price').
+
+It is set whenever a product is saved (Product.save(), and bulk.py for
+the writes going around it), but it also changes on its own when a sale
+starts or ends. 'manage.py refresh_effective_prices' catches up with
+those, for the products whose sale started or ended since its last run
+(looked up through the sale window indexes), and is meant to be run
+every minute or so. Until it does, filtering and sorting go by the price
+from before, the products themselves always show their current price.
+'''
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from . import cache as product_cache
+from . import outbox
+from .models import Product
+
+
+REFRESH_BATCH_SIZE = 1000
+
+
+def refresh(since=None, now=None):
+    '''
+    Recomputes the effective price at 'now' of the products whose sale
+    started or ended between 'since' and 'now', of all the products if
+    'since' is None, and writes the ones that changed. Returns their ids.
+    '''
+    if now is None:
+        now = timezone.now()
+    queryset = Product.objects.only(
+        'id', 'price', 'sale_start', 'sale_end', 'effective_price').order_by()
+    if since is not None:
+        queryset = queryset.filter(Q(sale_start__gte=since, sale_start__lte=now) |
+                                   Q(sale_end__gte=since, sale_end__lte=now))
+    changed = []
+    with transaction.atomic():
+        batch = []
+        for product in queryset.iterator(chunk_size=REFRESH_BATCH_SIZE):
+            stored = product.effective_price
+            product.set_effective_price(now)
+            if product.effective_price == stored:
+                continue
+            # For the storefront fragments, cached by it.
+            product.updated_at = now
+            batch.append(product)
+            if len(batch) == REFRESH_BATCH_SIZE:
+                Product.objects.bulk_update(batch, ['effective_price', 'updated_at'])
+                changed += [product.id for product in batch]
+                batch = []
+        Product.objects.bulk_update(batch, ['effective_price', 'updated_at'])
+        changed += [product.id for product in batch]
+        outbox.record(changed)
+    if changed:
+        product_cache.evict_products(changed)
+    return changed
@@ -0,0 +1,49 @@
+'''
+JSON rendering through orjson, when it is installed.
+
+orjson encodes the dicts and lists coming out of the serializers several
+times faster than the standard library's json module. Without it, or for
+output it does not produce the same way (indented or ASCII-only JSON),
+rendering goes through DRF's JSONRenderer as usual.
+'''
+from rest_framework.renderers import JSONRenderer
+from rest_framework.utils.encoders import JSONEncoder
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+
+# DRF's encoder knows about what orjson does not (Decimal, lazy strings,
+# querysets...), and writes datetimes the DRF way.
+_encoder = JSONEncoder()
+OPTIONS = orjson.OPT_PASSTHROUGH_DATETIME if orjson else 0
+
+
+def dumps(data):
+    '''
+    Returns data as compact JSON bytes, the way JSONRenderer does.
+    '''
+    if orjson is None:
+        return JSONRenderer().render(data)
+    ret = orjson.dumps(data, default=_encoder.default, option=OPTIONS)
+    # Escaped like JSONRenderer does, for output that is valid JavaScript.
+    if b'\xe2\x80\xa8' in ret or b'\xe2\x80\xa9' in ret:
+        ret = ret.replace(b'\xe2\x80\xa8', b'\\u2028').replace(b'\xe2\x80\xa9', b'\\u2029')
+    return ret
+
+
+class FastJSONRenderer(JSONRenderer):
+    '''
+    JSONRenderer encoding with orjson (see dumps()) whenever it gives the
+    same output.
+    '''
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        indent = self.get_indent(accepted_media_type, renderer_context or {})
+        if orjson is None or indent is not None or self.ensure_ascii or not self.compact:
+            return super().render(data, accepted_media_type, renderer_context)
+        return dumps(data)
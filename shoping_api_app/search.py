@@ -0,0 +1,121 @@
+'''
+Full-text search over the products' name and description.
+
+On SQLite the products are indexed in an FTS5 table kept in sync with the
+product table by triggers, so rows written with bulk_create() or
+QuerySet.update() are indexed as well. The table and triggers are
+(re)installed after every migrate, since SQLite migrations that rebuild
+the product table drop its triggers. On other databases, or when SQLite
+was built without FTS5, searching falls back to DRF's SearchFilter.
+'''
+from django.db import OperationalError, connections
+from django.db.models.expressions import RawSQL
+from rest_framework.filters import SearchFilter
+
+from .models import Product
+
+
+PRODUCT_TABLE = Product._meta.db_table
+FTS_TABLE = PRODUCT_TABLE + '_fts'
+
+_TRIGGERS = {
+    FTS_TABLE + '_insert': '''
+        CREATE TRIGGER IF NOT EXISTS {fts}_insert AFTER INSERT ON {table} BEGIN
+            INSERT INTO {fts}(rowid, name, description)
+            VALUES (new.id, new.name, new.description);
+        END''',
+    FTS_TABLE + '_delete': '''
+        CREATE TRIGGER IF NOT EXISTS {fts}_delete AFTER DELETE ON {table} BEGIN
+            INSERT INTO {fts}({fts}, rowid, name, description)
+            VALUES ('delete', old.id, old.name, old.description);
+        END''',
+    FTS_TABLE + '_update': '''
+        CREATE TRIGGER IF NOT EXISTS {fts}_update
+        AFTER UPDATE OF name, description ON {table} BEGIN
+            INSERT INTO {fts}({fts}, rowid, name, description)
+            VALUES ('delete', old.id, old.name, old.description);
+            INSERT INTO {fts}(rowid, name, description)
+            VALUES (new.id, new.name, new.description);
+        END''',
+}
+
+# Databases (by name) found to have the search index.
+_indexed_databases = {}
+
+
+def install(using='default'):
+    '''
+    Creates the search index and its triggers if they are missing,
+    indexing the existing products when anything had to be created.
+    '''
+    connection = connections[using]
+    if connection.vendor != 'sqlite':
+        return
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT name FROM sqlite_master WHERE name = %s OR "
+            "(type = 'trigger' AND tbl_name = %s)", [FTS_TABLE, PRODUCT_TABLE])
+        existing = {row[0] for row in cursor.fetchall()}
+        if existing.issuperset({FTS_TABLE, *_TRIGGERS}):
+            return
+        try:
+            cursor.execute(
+                "CREATE VIRTUAL TABLE IF NOT EXISTS {fts} USING fts5("
+                "name, description, content='{table}', content_rowid='id')"
+                .format(fts=FTS_TABLE, table=PRODUCT_TABLE))
+        except OperationalError:
+            # SQLite without FTS5, searches will use LIKE instead.
+            return
+        for sql in _TRIGGERS.values():
+            cursor.execute(sql.format(fts=FTS_TABLE, table=PRODUCT_TABLE))
+        cursor.execute("INSERT INTO {fts}({fts}) VALUES ('rebuild')"
+                       .format(fts=FTS_TABLE))
+    _indexed_databases.pop(connection.settings_dict['NAME'], None)
+
+
+def is_indexed(using='default'):
+    connection = connections[using]
+    if connection.vendor != 'sqlite':
+        return False
+    name = connection.settings_dict['NAME']
+    if name not in _indexed_databases:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT 1 FROM sqlite_master WHERE name = %s",
+                           [FTS_TABLE])
+            _indexed_databases[name] = cursor.fetchone() is not None
+    return _indexed_databases[name]
+
+
+def match_expression(terms):
+    '''
+    Turns the search terms into an FTS5 query matching products that
+    contain every term, each one as a word prefix ('sho' finds 'shoes').
+    '''
+    return ' '.join('"{}"*'.format(term.replace('"', '""')) for term in terms)
+
+
+class ProductSearchFilter(SearchFilter):
+    '''
+    SearchFilter that looks the products up in the full-text index when
+    the database has one. '?ordering=relevance' sorts the matches by
+    their rank, best first.
+    '''
+    relevance_ordering = 'relevance'
+
+    def filter_queryset(self, request, queryset, view):
+        terms = self.get_search_terms(request)
+        if not terms or not is_indexed(queryset.db):
+            return super().filter_queryset(request, queryset, view)
+
+        match = match_expression(terms)
+        queryset = queryset.filter(id__in=RawSQL(
+            'SELECT rowid FROM {fts} WHERE {fts} MATCH %s'.format(fts=FTS_TABLE),
+            [match]))
+        if request.query_params.get('ordering') == self.relevance_ordering:
+            # bm25() is lower for better matches.
+            queryset = queryset.annotate(search_rank=RawSQL(
+                'SELECT bm25({fts}) FROM {fts} WHERE {fts} MATCH %s '
+                'AND {fts}.rowid = {table}.id'.format(
+                    fts=FTS_TABLE, table=PRODUCT_TABLE),
+                [match])).order_by('search_rank', 'id')
+        return queryset
@@ -1,11 +1,125 @@
-from pyexpat import model
+import inspect
+from datetime import datetime
+from operator import attrgetter
+
+from django.core.exceptions import ObjectDoesNotExist
+from django.db import models
 from rest_framework.exceptions import ValidationError
+from rest_framework.fields import SkipField
+from rest_framework.relations import PKOnlyObject
+from rest_framework.settings import ISO_8601, api_settings
 from rest_framework import serializers
 
-from .models import Product, ShoppingCartItem, ShoppingCart
+from . import images
+from .metrics import timed_serialization
+from .models import Product, ProductChange, ProductStats, ShoppingCartItem, ShoppingCart
+
+
+# Conversions that are all there is to to_representation() of these
+# fields, for values that are not None.
+DIRECT_CONVERSIONS = {
+    serializers.CharField: str,
+    serializers.IntegerField: int,
+    serializers.FloatField: float,
+}
+_skip = object()
 
 
-class CartItemSerializer(serializers.ModelSerializer):
+class CompiledFieldsMixin:
+    '''
+    For ModelSerializers: serializes instances following a plan of the
+    readable fields worked out once per serializer (so once per page
+    when serializing many), with the common cases (attributes and methods
+    of the model, foreign key ids, strings and numbers) read and converted
+    directly instead of through the fields' get_attribute() and
+    to_representation(). The other fields go through those as usual.
+    '''
+    compile_fields = True
+
+    def to_representation(self, instance):
+        if not self.compile_fields or not isinstance(instance, models.Model):
+            return super().to_representation(instance)
+        plan = getattr(self, '_field_plan', None)
+        if plan is None:
+            plan = self._field_plan = [
+                (field.field_name,) + self.compile_field(field)
+                for field in self._readable_fields]
+        ret = {}
+        for name, get, convert in plan:
+            value = get(instance)
+            if value is _skip:
+                continue
+            ret[name] = value if value is None or convert is None else convert(value)
+        return ret
+
+    def compile_field(self, field):
+        '''
+        Returns how to get the value of a field from an instance and the
+        function converting it (None when it is ready as it is).
+        '''
+        model = self.Meta.model
+        if isinstance(field, serializers.SerializerMethodField):
+            return getattr(self, field.method_name), None
+        if len(field.source_attrs) == 1:
+            source = field.source_attrs[0]
+            if (isinstance(field, serializers.PrimaryKeyRelatedField) and
+                    field.pk_field is None):
+                model_field = model._meta.get_field(source)
+                return attrgetter(model_field.attname), None
+            convert = DIRECT_CONVERSIONS.get(type(field), field.to_representation)
+            if type(field) is serializers.DateTimeField:
+                convert = _datetime_converter(field)
+            attribute = getattr(model, source, None)
+            if inspect.isfunction(attribute) and attribute.__code__.co_argcount == 1:
+                # A method taking nothing but 'self'.
+                return _method_getter(source), convert
+            if source in {model_field.attname for model_field in model._meta.concrete_fields}:
+                return attrgetter(source), convert
+        return _field_getter(field), None
+
+
+def _method_getter(name):
+    def get(instance):
+        try:
+            return getattr(instance, name)()
+        except ObjectDoesNotExist:
+            return None
+    return get
+
+
+def _datetime_converter(field):
+    # DateTimeField.to_representation() looks the current time zone up
+    # for every value, this looks it up once for the whole plan.
+    output_format = getattr(field, 'format', api_settings.DATETIME_FORMAT)
+    if output_format is None or output_format.lower() != ISO_8601:
+        return field.to_representation
+    field_timezone = field.timezone if hasattr(field, 'timezone') else field.default_timezone()
+    if field_timezone is None:
+        return field.to_representation
+
+    def convert(value):
+        if isinstance(value, datetime) and value.utcoffset() is not None:
+            value = value.astimezone(field_timezone).isoformat()
+            if value.endswith('+00:00'):
+                value = value[:-6] + 'Z'
+            return value
+        return field.to_representation(value)
+    return convert
+
+
+def _field_getter(field):
+    # What Serializer.to_representation() does for every field.
+    def get(instance):
+        try:
+            attribute = field.get_attribute(instance)
+        except SkipField:
+            return _skip
+        check_for_none = attribute.pk if isinstance(attribute, PKOnlyObject) else attribute
+        return None if check_for_none is None else field.to_representation(attribute)
+    return get
+
+
+class CartItemSerializer(CompiledFieldsMixin, serializers.ModelSerializer):
     '''
     This serializer class serializes the ShoppingCartItem's product
     and quantity fields.
@@ -17,7 +131,131 @@ class CartItemSerializer(serializers.ModelSerializer):
         fields = ('product', 'quantity')
 
 
-class ProductSerializer(serializers.ModelSerializer):
+class ShoppingCartItemSerializer(CartItemSerializer):
+    '''
+    A shopping cart's item, with its id so that it can be updated or
+    removed afterwards.
+    '''
+
+    class Meta(CartItemSerializer.Meta):
+        fields = ('id', 'product', 'quantity')
+
+
+class CartItemQuantitySerializer(ShoppingCartItemSerializer):
+    '''
+    For changing the quantity of an item already in a shopping cart,
+    its product stays as it is.
+    '''
+
+    class Meta(ShoppingCartItemSerializer.Meta):
+        read_only_fields = ('product',)
+
+
+class ShoppingCartSerializer(serializers.ModelSerializer):
+    '''
+    A shopping cart along with its items and what it costs.
+    '''
+    items = ShoppingCartItemSerializer(many=True, read_only=True)
+
+    class Meta:
+        model = ShoppingCart
+        fields = ('id', 'name', 'address', 'items')
+
+    def to_representation(self, instance):
+        # Below 'data' variable is an ordered dictionary, to which the
+        # subtotal, taxes and total are added, all priced in one query.
+        data = super().to_representation(instance)
+        data.update(instance.totals())
+        return data
+
+    @property
+    def data(self):
+        with timed_serialization():
+            return super().data
+
+
+class GuestCartItemSerializer(serializers.Serializer):
+    '''
+    A product added to a guest cart (see guest_carts.py).
+    '''
+    product = serializers.PrimaryKeyRelatedField(queryset=Product.objects.only('id'))
+    quantity = serializers.IntegerField(min_value=1, max_value=100)
+
+
+class GuestCartQuantitySerializer(serializers.Serializer):
+    quantity = serializers.IntegerField(min_value=1, max_value=100)
+
+
+class GuestCartCheckoutSerializer(serializers.Serializer):
+    name = serializers.CharField(max_length=200)
+    address = serializers.CharField(max_length=200)
+
+
+def cart_data_for(product_ids, items=True):
+    '''
+    Returns the cart items of the given products grouped by product id,
+    along with the total number of shopping carts. Costs two queries
+    however many products are asked for, one with items=False (the cart
+    items are then left out).
+    '''
+    cart_items = {product_id: [] for product_id in product_ids}
+    if items:
+        items = ShoppingCartItem.objects.filter(
+            product_id__in=cart_items).only('product_id', 'quantity')
+        for item in CartItemSerializer(items, many=True).data:
+            cart_items[item['product']].append(item)
+    return {
+        'cart_items': cart_items,
+        'total_shopping_carts': ShoppingCart.objects.count(),
+    }
+
+
+async def acart_data_for(product_ids, items=True):
+    '''
+    Same as cart_data_for(), for async views.
+    '''
+    cart_items = {product_id: [] for product_id in product_ids}
+    if items:
+        items = [item async for item in ShoppingCartItem.objects.filter(
+            product_id__in=cart_items).only('product_id', 'quantity').aiterator()]
+        for item in CartItemSerializer(items, many=True).data:
+            cart_items[item['product']].append(item)
+    return {
+        'cart_items': cart_items,
+        'total_shopping_carts': await ShoppingCart.objects.acount(),
+    }
+
+
+class ProductListSerializer(serializers.ListSerializer):
+    '''
+    Serializes a page of products in one go. Instead of every product
+    querying its own cart items and the number of shopping carts, the
+    cart items for the whole page are fetched with a single query and the
+    shopping carts are counted once, then handed to the child serializer
+    through the context.
+    '''
+
+    def to_representation(self, data):
+        # 'data' can be a Manager/QuerySet or an already paginated list,
+        # either way we need the actual objects to know their ids.
+        iterable = data.all() if isinstance(data, models.manager.BaseManager) else data
+        products = list(iterable)
+        # Nothing to fetch for products serialized without 'cart_items'
+        # and 'average_product_sold' (see '?fields=').
+        fields = self.child.fields
+        if 'cart_data' not in self.context and (
+                'cart_items' in fields or 'average_product_sold' in fields):
+            self._context['cart_data'] = cart_data_for(
+                [product.id for product in products], items='cart_items' in fields)
+        return super().to_representation(products)
+
+    @property
+    def data(self):
+        with timed_serialization():
+            return super().data
+
+
+class ProductSerializer(CompiledFieldsMixin, serializers.ModelSerializer):
 
     # Below are validations or restrictions for the fields.
     # Check them in the frontend and you won't be able to violate them.
@@ -26,6 +264,7 @@ class ProductSerializer(serializers.ModelSerializer):
     description = serializers.CharField(min_length=2, max_length=200)
     cart_items = serializers.SerializerMethodField()
     average_product_sold = serializers.SerializerMethodField()
+    images = serializers.SerializerMethodField()
     #price = serializers.FloatField(min_value=1.0, max_value=100000)
     price = serializers.DecimalField(
         min_value=1.0, max_value=100000,
@@ -35,13 +274,90 @@ class ProductSerializer(serializers.ModelSerializer):
         model = Product
         fields = ('id', 'name', 'description',
                   'price', 'sale_start', 'sale_end',
-                  'is_on_sale', 'current_price', 'average_product_sold', 'cart_items',)
+                  'is_on_sale', 'current_price', 'average_product_sold', 'cart_items',
+                  'images', 'updated_at',)
+        # Serializing many products at once (e.g. a ProductList page)
+        # goes through the batched path above.
+        list_serializer_class = ProductListSerializer
+
+    # What ProductList serves unless asked for other fields.
+    compact_fields = ('id', 'name', 'price', 'sale_start', 'sale_end',
+                      'is_on_sale', 'current_price')
+    # The columns (or relations) the fields that are not columns
+    # themselves are computed from, for loading only what is needed.
+    field_columns = {
+        'is_on_sale': ('sale_start', 'sale_end'),
+        'current_price': ('price', 'sale_start', 'sale_end'),
+        'average_product_sold': ('stats__total_quantity',),
+        'cart_items': (),
+        'images': ('photo', 'photo_variants'),
+    }
+
+    def __init__(self, *args, fields=None, **kwargs):
+        '''
+        'fields' limits the representation to the given fields, in the
+        order of Meta.fields.
+        '''
+        super().__init__(*args, **kwargs)
+        if fields is not None:
+            for name in set(self.fields) - set(fields):
+                self.fields.pop(name)
+
+    @classmethod
+    def requested_fields(cls, query_params, default=None):
+        '''
+        Returns the fields asked for with '?fields=' and/or '?exclude='
+        (comma separated names), or 'default' (all fields if None) when
+        neither is given. '?exclude=' alone leaves out fields from all
+        of them.
+        '''
+        fields = query_params.get('fields')
+        exclude = query_params.get('exclude')
+        if fields is None and exclude is None:
+            return tuple(default or cls.Meta.fields)
+        errors = {}
+        selected = cls.Meta.fields
+        for param, value in (('fields', fields), ('exclude', exclude)):
+            if value is None:
+                continue
+            names = [name.strip() for name in value.split(',') if name.strip()]
+            unknown = [name for name in names if name not in cls.Meta.fields]
+            if unknown:
+                errors[param] = 'Unknown fields: {}.'.format(', '.join(unknown))
+            elif param == 'fields':
+                selected = [name for name in selected if name in names]
+            else:
+                selected = [name for name in selected if name not in names]
+        if errors:
+            raise ValidationError(errors)
+        return tuple(selected)
+
+    @classmethod
+    def columns_for(cls, fields):
+        '''
+        Returns what to give QuerySet.only() for serializing the given
+        fields.
+        '''
+        columns = set()
+        for name in fields:
+            columns.update(cls.field_columns.get(name, (name,)))
+        return columns
+
+    @property
+    def data(self):
+        with timed_serialization():
+            return super().data
 
     def get_cart_items(self, instance):
         '''
         This method would return a product X's quantity in each 
         shopping cart in which it is present.
         '''
+        # When serializing a whole page, ProductListSerializer has already
+        # fetched the cart items of every product on it.
+        cart_data = self.context.get('cart_data')
+        if cart_data is not None:
+            return cart_data['cart_items'].get(instance.id, [])
         # A particular product is going to be in many shopping carts,
         # therefore, 'items' below would have multiple ShoppingCartItem
         # objects assigned to it. (Idea : Draw ShoppingCartItem Table
@@ -50,28 +366,36 @@ class ProductSerializer(serializers.ModelSerializer):
         # Below many model instances are serialized. A List is then returned.
         return CartItemSerializer(items, many=True).data
 
+    def get_images(self, instance):
+        '''
+        The URLs of the product's photo and of its resized copies, see
+        images.urls_for().
+        '''
+        return images.urls_for(instance)
+
     def get_average_product_sold(self, instance):
 
         # It is the average of total number of a particular product
         # sold to the total number of shopping carts existing.
 
-        # For total number of that product sold :-
-        cart_items_list = self.get_cart_items(instance)
-
-        total_products_sold = 0
-        for i in range(len(cart_items_list)-1):
-            total_products_sold += cart_items_list[i]['quantity']
+        # For total number of that product sold, kept up to date in its
+        # statistics (a join when the product comes with
+        # select_related('stats')) :-
+        try:
+            total_products_sold = instance.stats.total_quantity
+        except ProductStats.DoesNotExist:
+            total_products_sold = 0
 
         # For total number of Shopping Carts :-
-        total_shopping_carts = ShoppingCart.objects.all().count()
-
-        try:
-            average = float(total_products_sold/total_shopping_carts)
-            return average
-        except:
-            average = 0
+        cart_data = self.context.get('cart_data')
+        if cart_data is not None:
+            total_shopping_carts = cart_data['total_shopping_carts']
+        else:
+            total_shopping_carts = ShoppingCart.objects.count()
 
-        return average
+        if not total_shopping_carts:
+            return 0
+        return float(total_products_sold/total_shopping_carts)
 
         # except ZeroDivisionError:
         #     average = 0
@@ -98,3 +422,26 @@ class ProductSerializer(serializers.ModelSerializer):
         #     data['current_price'] = instance.current_price()
 
         #     return data
+
+
+class TopSellerSerializer(ProductSerializer):
+    '''
+    A product along with how much of it is in shopping carts.
+    '''
+    total_quantity = serializers.IntegerField(source='stats.total_quantity', read_only=True)
+    cart_count = serializers.IntegerField(source='stats.cart_count', read_only=True)
+
+    class Meta(ProductSerializer.Meta):
+        fields = ProductSerializer.Meta.fields + ('total_quantity', 'cart_count')
+
+
+class ProductChangeSerializer(serializers.ModelSerializer):
+    '''
+    An entry of the change feed, 'product' being null when every
+    product changed.
+    '''
+    product = serializers.IntegerField(source='product_id')
+
+    class Meta:
+        model = ProductChange
+        fields = ('seq', 'product', 'created_at')
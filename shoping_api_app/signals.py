@@ -0,0 +1,104 @@
+from functools import partial
+
+from django.contrib.auth.signals import user_logged_in
+from django.db import transaction
+from django.db.backends.signals import connection_created
+from django.db.models.signals import (post_delete, post_migrate, post_save,
+                                      pre_delete, pre_save)
+from django.dispatch import receiver
+
+from . import cache as product_cache
+from . import db
+from . import guest_carts
+from . import images
+from . import outbox
+from . import search
+from . import stats as product_stats
+from .models import Product, ShoppingCart, ShoppingCartItem
+
+
+# The other processes evict what changed through the change feed, see
+# outbox.py. Its entries are written in the transaction of the change
+# (see AtomicSaveModel, deletes are atomic already).
+@receiver(post_save, sender=Product)
+@receiver(post_delete, sender=Product)
+def evict_product(sender, instance, **kwargs):
+    product_cache.evict_products([instance.id])
+    outbox.record([instance.id])
+
+
+# The resized copies of a new photo are made once it is committed.
+@receiver(post_save, sender=Product)
+def resize_product_photo(sender, instance, raw=False, **kwargs):
+    if not raw and (images.is_stale(instance) or
+                    (not instance.photo and instance.photo_variants)):
+        transaction.on_commit(partial(images.photo_saved, instance))
+
+
+# A product's 'cart_items' and 'average_product_sold' are built from the
+# shopping cart items, so they have to go whenever one of them changes.
+@receiver(post_save, sender=ShoppingCartItem)
+@receiver(post_delete, sender=ShoppingCartItem)
+def evict_cart_item_product(sender, instance, origin=None, **kwargs):
+    product_cache.evict_products([instance.product_id])
+    # Items going with their product or shopping cart are recorded as
+    # part of that change, deleted one at a time or with a QuerySet.
+    model = getattr(origin, 'model', type(origin))
+    if model not in (Product, ShoppingCart):
+        outbox.record([instance.product_id])
+
+
+# The number of shopping carts is part of every product's
+# 'average_product_sold'.
+@receiver(post_save, sender=ShoppingCart)
+@receiver(post_delete, sender=ShoppingCart)
+def evict_all_products(sender, instance, created=True, **kwargs):
+    if created:
+        product_cache.evict_all()
+        outbox.record_all()
+
+
+# The statistics of the products (see stats.py) move with their items.
+@receiver(pre_save, sender=ShoppingCartItem)
+def remember_cart_item(sender, instance, raw=False, **kwargs):
+    instance._previous_values = (
+        None if raw else product_stats.previous_values(instance))
+
+
+@receiver(post_save, sender=ShoppingCartItem)
+def count_saved_cart_item(sender, instance, raw=False, **kwargs):
+    if not raw:
+        product_stats.item_saved(instance, instance._previous_values)
+
+
+@receiver(post_delete, sender=ShoppingCartItem)
+def count_deleted_cart_item(sender, instance, origin=None, **kwargs):
+    # Items going with their shopping cart are taken care of by
+    # uncount_shopping_cart(), and with their product the statistics go
+    # too.
+    model = getattr(origin, 'model', type(origin))
+    if model not in (ShoppingCart, Product):
+        product_stats.item_deleted(instance)
+
+
+@receiver(pre_delete, sender=ShoppingCart)
+def uncount_shopping_cart(sender, instance, **kwargs):
+    product_stats.remove_cart(instance)
+
+
+@receiver(post_migrate)
+def install_search_index(sender, using, **kwargs):
+    if sender.label == 'shoping_api_app':
+        search.install(using)
+
+
+# SQLite is tuned per connection (see SQLITE_PRAGMAS in settings).
+@receiver(connection_created)
+def configure_connection(sender, connection, **kwargs):
+    db.configure_connection(connection)
+
+
+# A guest cart becomes the user's shopping cart when they log in.
+@receiver(user_logged_in)
+def flush_guest_cart(sender, request, user, **kwargs):
+    guest_carts.logged_in(request)
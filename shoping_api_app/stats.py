@@ -0,0 +1,135 @@
+'''
+Keeping ProductStats in step with the shopping cart items.
+
+Every item saved or deleted moves its product's totals by what changed,
+with a single UPDATE, instead of 'average_product_sold' summing all the
+items of a product each time it is serialized. A product without a
+ProductStats row yet gets one computed from its items.
+
+Deleting a shopping cart takes all its items away at once: its totals
+are taken off per product before the delete (see remove_cart()) and the
+handlers for the items themselves stand aside, as they do for items
+going with a deleted product, whose statistics go too.
+'''
+from django.db import transaction
+from django.db.models import Count, F, Sum
+from django.utils import timezone
+
+from .models import ProductStats, ShoppingCartItem
+
+
+REBUILD_BATCH_SIZE = 1000
+
+
+def refresh(product_id):
+    '''
+    Computes the statistics of a product from its items.
+    '''
+    totals = ShoppingCartItem.objects.filter(product_id=product_id).aggregate(
+        total_quantity=Sum('quantity'),
+        cart_count=Count('shopping_cart', distinct=True))
+    # A single INSERT ... ON CONFLICT rather than update_or_create()'s
+    # savepoints, lookup and insert.
+    ProductStats.objects.bulk_create(
+        [ProductStats(product_id=product_id,
+                      total_quantity=totals['total_quantity'] or 0,
+                      cart_count=totals['cart_count'])],
+        update_conflicts=True, unique_fields=['product'],
+        update_fields=['total_quantity', 'cart_count', 'updated_at'])
+
+
+def add(product_id, quantity=0, carts=0):
+    '''
+    Moves the statistics of a product by the given amounts.
+    '''
+    updated = ProductStats.objects.filter(product_id=product_id).update(
+        total_quantity=F('total_quantity') + quantity,
+        cart_count=F('cart_count') + carts, updated_at=timezone.now())
+    if not updated:
+        # The items already include this change.
+        refresh(product_id)
+
+
+def _in_other_line(item):
+    # Whether the item's cart holds the product on another line too, in
+    # which case the number of carts it is in does not change.
+    return ShoppingCartItem.objects.filter(
+        shopping_cart_id=item.shopping_cart_id, product_id=item.product_id,
+    ).exclude(id=item.id).exists()
+
+
+def previous_values(item):
+    '''
+    Returns the product and quantity an item had before being saved,
+    None for a new item.
+    '''
+    if item._state.adding:
+        return None
+    loaded = getattr(item, '_loaded_values', {})
+    if 'product_id' in loaded and isinstance(loaded.get('quantity'), int):
+        return loaded['product_id'], loaded['quantity']
+    return ShoppingCartItem.objects.filter(id=item.id).values_list(
+        'product_id', 'quantity').first()
+
+
+def item_saved(item, previous):
+    '''
+    Updates the statistics for an item that was saved, given what
+    previous_values() returned for it.
+    '''
+    if previous is not None and previous[0] == item.product_id:
+        if item.quantity != previous[1]:
+            add(item.product_id, item.quantity - previous[1])
+        return
+    if previous is not None:
+        # Moved to another product.
+        add(previous[0], -previous[1], 0 if ShoppingCartItem.objects.filter(
+            shopping_cart_id=item.shopping_cart_id, product_id=previous[0]).exists() else -1)
+    add(item.product_id, item.quantity, 0 if _in_other_line(item) else 1)
+
+
+def item_deleted(item):
+    '''
+    Updates the statistics for an item that was deleted on its own.
+    '''
+    add(item.product_id, -item.quantity, 0 if _in_other_line(item) else -1)
+
+
+def remove_cart(shopping_cart):
+    '''
+    Takes the items of a shopping cart about to be deleted off the
+    statistics of their products.
+    '''
+    totals = shopping_cart.items.values('product_id').annotate(
+        quantity=Sum('quantity')).order_by()
+    now = timezone.now()
+    for row in totals:
+        # No refresh() for a product without statistics, its items are
+        # still there: they get computed on the next change instead.
+        ProductStats.objects.filter(product_id=row['product_id']).update(
+            total_quantity=F('total_quantity') - row['quantity'],
+            cart_count=F('cart_count') - 1, updated_at=now)
+
+
+def rebuild():
+    '''
+    Recomputes the statistics of every product from the items, in a
+    single transaction. Products without any item get none.
+    '''
+    totals = ShoppingCartItem.objects.values('product_id').annotate(
+        total_quantity=Sum('quantity'),
+        cart_count=Count('shopping_cart', distinct=True),
+    ).order_by('product_id')
+    count = 0
+    with transaction.atomic():
+        ProductStats.objects.all().delete()
+        batch = []
+        for row in totals.iterator(chunk_size=REBUILD_BATCH_SIZE):
+            batch.append(ProductStats(**row))
+            if len(batch) == REBUILD_BATCH_SIZE:
+                ProductStats.objects.bulk_create(batch)
+                count += len(batch)
+                batch = []
+        ProductStats.objects.bulk_create(batch)
+        count += len(batch)
+    return count
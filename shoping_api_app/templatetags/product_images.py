@@ -0,0 +1,38 @@
+from django import template
+
+from shoping_api_app import images
+
+register = template.Library()
+
+
+@register.inclusion_tag('shoping_api_app/picture.html')
+def product_picture(product, display_width=320):
+    '''
+    Renders the photo of a product shown 'display_width' pixels wide, as
+    a <picture> letting the browser pick the copy that fits (WebP if it
+    can), the original while there is no copy yet.
+    '''
+    urls = images.urls_for(product)
+    if urls is None:
+        return {'src': None}
+    # Copies of a small photo can share a width, one of each will do.
+    variants = sorted({variant['width']: variant for name, variant in urls.items()
+                       if name != 'original'}.values(),
+                      key=lambda variant: variant['width'])
+    if not variants:
+        return {'src': urls['original'], 'alt': product.name, 'display_width': display_width}
+    # The smallest copy as wide as it is shown, for browsers ignoring srcset.
+    fallback = next((variant for variant in variants
+                     if variant['width'] >= display_width), variants[-1])
+    return {
+        'src': fallback['url'],
+        'width': fallback['width'],
+        'height': fallback['height'],
+        'srcset': ', '.join('{} {}w'.format(variant['url'], variant['width'])
+                            for variant in variants),
+        'webp_srcset': ', '.join('{} {}w'.format(variant['webp'], variant['width'])
+                                 for variant in variants),
+        'sizes': '(max-width: {0}px) 100vw, {0}px'.format(display_width),
+        'alt': product.name,
+        'display_width': display_width,
+    }
@@ -0,0 +1,40 @@
+'''
+Helpers for the tests.
+'''
+from django.test import Client
+
+
+class QueryBudgetClient(Client):
+    '''
+    Test client failing the test when a request runs more SQL queries
+    than the budget of its URL name allows (as measured by
+    RequestMetricsMiddleware).
+    '''
+    query_budgets = {}
+
+    def request(self, **request):
+        response = super().request(**request)
+        metrics = getattr(response, 'metrics', None)
+        if metrics is not None:
+            budget = self.query_budgets.get(metrics.url_name)
+            if budget is not None and metrics.queries > budget:
+                raise AssertionError(
+                    '{} ran {} queries, its budget is {}.'.format(
+                        metrics.url_name, metrics.queries, budget))
+        return response
+
+
+class QueryBudgetMixin:
+    '''
+    For TestCases: declare the budgets per URL name, e.g.
+
+        query_budgets = {'listing-all-products': 4}
+
+    and every request made through self.client is checked against them.
+    '''
+    client_class = QueryBudgetClient
+    query_budgets = {}
+
+    def _pre_setup(self):
+        super()._pre_setup()
+        self.client.query_budgets = self.query_budgets
@@ -1,3 +1,1062 @@
-from django.test import TestCase
+import csv
+import io
+import json
+import math
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+from datetime import timedelta
+from types import SimpleNamespace
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import async_to_sync
+from django.core.cache import cache
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import connection, transaction
+from django.utils.http import http_date, parse_http_date
+from django.test import AsyncRequestFactory, RequestFactory, TestCase, override_settings
+from django.utils import timezone
+
+from . import async_views
+from . import bulk
+from . import cache as product_cache
+from . import db
+from . import export
+from . import guest_carts
+from . import images
+from . import locks
+from . import outbox
+from . import prices
+from . import search
+from . import stats as product_stats
+from .models import (CacheLock, ImportCheckpoint, Product, ProductChange, ProductStats,
+                     ShoppingCart, ShoppingCartItem)
+from .api_views import ProductList
+from .cache_backends import NonCullingDatabaseCache
+from .serializers import ProductSerializer
+from .testing import QueryBudgetMixin
+
+
+def on_sale_product(price):
+    now = timezone.now()
+    return Product.objects.create(name='On sale', description='', price=price,
+                                  sale_start=now - timedelta(days=1),
+                                  sale_end=now + timedelta(days=1))
+
+
+class CartTotalsTest(TestCase):
+
+    def test_half_cent_sale_price(self):
+        # 1.15 * 0.9 is 1.035, 1.03 in Python, 1.04 with SQLite's ROUND().
+        product = on_sale_product(1.15)
+        self.assertEqual(product.current_price(), 1.03)
+        cart = ShoppingCart.objects.create(name='Customer', address='Street')
+        ShoppingCartItem.objects.create(shopping_cart=cart, product=product, quantity=3)
+        self.assertEqual(cart.totals(), {'subtotal': 3.09, 'taxes': 0.4, 'total': 3.49})
+
+    def test_guest_cart_totals_match(self):
+        products = [on_sale_product(price) for price in (1.15, 2.05, 10.45)]
+        token = self.client.post('/api/v1/guest-carts/').json()['token']
+        cart = ShoppingCart.objects.create(name='Customer', address='Street')
+        for quantity, product in enumerate(products, 1):
+            self.client.post('/api/v1/guest-carts/{}/items/'.format(token),
+                             {'product': product.id, 'quantity': quantity},
+                             content_type='application/json')
+            ShoppingCartItem.objects.create(shopping_cart=cart, product=product,
+                                            quantity=quantity)
+        guest_cart = self.client.get('/api/v1/guest-carts/{}'.format(token)).json()
+        totals = cart.totals()
+        for key in ('subtotal', 'taxes', 'total'):
+            self.assertEqual(guest_cart[key], totals[key])
+
+
+class ProductBulkTest(TestCase):
+
+    def setUp(self):
+        self.product = Product.objects.create(name='Kept', description='', price=10)
+
+    def test_delete_rejects_booleans(self):
+        response = self.client.delete('/api/v1/bulk-products/', [True],
+                                      content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        self.assertTrue(Product.objects.filter(id=self.product.id).exists())
+
+    def test_update_rejects_boolean_id(self):
+        response = self.client.post('/api/v1/bulk-products/', [{'id': True, 'name': 'Renamed'}],
+                                    content_type='application/json')
+        self.assertEqual(response.json()['errors'][0]['index'], 0)
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.name, 'Kept')
+
+
+class StorefrontTest(TestCase):
+
+    def setUp(self):
+        for number in range(30):
+            Product.objects.create(name='Product {}'.format(number), description='', price=1)
+
+    def test_page_past_the_end(self):
+        for page in ('99999999999999999999', '3'):
+            response = self.client.get('/', {'page': page})
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.context['page'], 2)
+            self.assertEqual(len(response.context['products']), 6)
+
+    def test_page_not_a_number(self):
+        response = self.client.get('/', {'page': 'last'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['page'], 1)
+
+
+class QueryBudgetTest(QueryBudgetMixin, TestCase):
+    # Whatever the number of products on the page, in the batch or in the
+    # cart: a test failing here means an N+1 query crept in.
+    query_budgets = {
+        'listing-all-products': 4,
+        'retrieving-updating-deleting-products': 7,
+        'batch-retrieving-products': 3,
+        'catalog-stats': 3,
+        'creating-products': 7,
+        'retrieving-shopping-carts': 3,
+        # The product, the cart and its line for the product, then in one
+        # transaction (BEGIN and COMMIT count): the item, its entry in
+        # the change feed (outbox.py), whether the cart has the product
+        # on another line, and the product's statistics (stats.py), an
+        # UPDATE or, for a product without any yet, a count and INSERT.
+        'adding-shopping-cart-items': 11,
+    }
+
+    def setUp(self):
+        cache.clear()
+        self.products = [Product.objects.create(
+            name='Product {}'.format(number), description='', price=10 + number)
+            for number in range(30)]
+        self.cart = ShoppingCart.objects.create(name='Customer', address='Street')
+        for product in self.products[:10]:
+            ShoppingCartItem.objects.create(shopping_cart=self.cart, product=product,
+                                            quantity=2)
+
+    def test_read_products(self):
+        responses = [
+            self.client.get('/api/v1/products/', {
+                'limit': 30, 'fields': 'id,name,cart_items,average_product_sold'}),
+            self.client.get('/api/v1/retrieve-update-destroy-products/{}'.format(
+                self.products[0].id)),
+            self.client.get('/api/v1/batch-products/', {
+                'ids': ','.join(str(product.id) for product in self.products)}),
+            self.client.get('/api/v1/catalog-stats/'),
+        ]
+        self.assertEqual([response.status_code for response in responses], [200] * 4)
+
+    def test_write_products(self):
+        response = self.client.post('/api/v1/create-products/',
+                                    {'name': 'New', 'description': 'Brand new', 'price': 3},
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+        url = '/api/v1/retrieve-update-destroy-products/{}'.format(self.products[0].id)
+        response = self.client.patch(url, {'name': 'Renamed'}, content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.client.delete(url).status_code, 204)
+
+    def test_shopping_carts(self):
+        for product in self.products[10:]:
+            response = self.client.post('/api/v1/carts/{}/items/'.format(self.cart.id),
+                                        {'product': product.id, 'quantity': 2},
+                                        content_type='application/json')
+            self.assertEqual(response.status_code, 201)
+        response = self.client.get('/api/v1/carts/{}'.format(self.cart.id))
+        self.assertEqual(len(response.json()['items']), 30)
+
+    def test_over_budget(self):
+        self.client.query_budgets = {'listing-all-products': 0}
+        with self.assertRaises(AssertionError):
+            self.client.get('/api/v1/products/')
+
+
+class ProductCacheTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.products = [Product.objects.create(
+            name='Product {}'.format(number), description='', price=10 + number)
+            for number in range(10)]
+        self.url = '/api/v1/retrieve-update-destroy-products/{}'.format(self.products[0].id)
+
+    def cached_list(self, params):
+        request = RequestFactory().get('/api/v1/products/', params)
+        return cache.get(product_cache.LIST_KEY.format(product_cache._list_digest(request)))
+
+    def test_list_cached_until_a_write(self):
+        response = self.client.get('/api/v1/products/', {'limit': 5})
+        cached = self.client.get('/api/v1/products/', {'limit': 5})
+        self.assertEqual(cached.metrics.queries, 0)
+        self.assertEqual(cached.content, response.content)
+        product = self.products[0]
+        product.name = 'Renamed'
+        product.save()
+        response = self.client.get('/api/v1/products/', {'limit': 5})
+        self.assertEqual(response.json()['results'][0]['name'], 'Renamed')
+
+    def test_create(self):
+        self.client.get('/api/v1/products/')
+        response = self.client.post('/api/v1/create-products/',
+                                    {'name': 'New', 'description': 'Brand new', 'price': 3},
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(self.client.get('/api/v1/products/').json()['count'], 11)
+
+    def test_update(self):
+        self.client.get(self.url)
+        response = self.client.patch(self.url, {'name': 'Renamed'},
+                                     content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.client.get(self.url).json()['name'], 'Renamed')
+
+    def test_delete(self):
+        self.client.get(self.url)
+        self.assertEqual(self.client.delete(self.url).status_code, 204)
+        self.assertEqual(self.client.get(self.url).status_code, 404)
+
+    def test_filtered_page_expires_at_the_next_sale_start(self):
+        on_sale_product(5)
+        product = self.products[-1]
+        product.sale_start = timezone.now() + timedelta(seconds=30)
+        product.save()
+        for params in ({'on_sale': 'true'}, {'max_price': '12'}):
+            self.client.get('/api/v1/products/', params)
+            self.assertLessEqual(self.cached_list(params)['expires'], time.time() + 30)
+        # The unfiltered pages keep to the products on them.
+        self.client.get('/api/v1/products/', {'limit': 5})
+        self.assertGreater(self.cached_list({'limit': 5})['expires'], time.time() + 60)
+
+
+class CursorPaginationTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.products = [Product.objects.create(
+            name='Product {}'.format(number), description='', price=10 + number)
+            for number in range(30)]
+
+    def test_cursor_pages(self):
+        ids, url = [], '/api/v1/products/?pagination=cursor&limit=7'
+        while url:
+            page = self.client.get(url).json()
+            ids.extend(product['id'] for product in page['results'])
+            url = page['next']
+        self.assertEqual(ids, [product.id for product in self.products])
+
+    def test_bad_limit(self):
+        for limit, expected in (('0', 10), ('-3', 10), ('many', 10), ('1000', 30)):
+            response = self.client.get('/api/v1/products/', {
+                'pagination': 'cursor', 'limit': limit})
+            self.assertEqual(len(response.json()['results']), expected)
+
+
+class ProductSearchTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.shoes = Product.objects.create(name='Running shoes', price=60,
+                                            description='Wool-blend, "light" and near weightless')
+        self.socks = Product.objects.create(name='Socks', description='Cotton', price=5)
+
+    def search(self, terms):
+        response = self.client.get('/api/v1/products/', {'search': terms})
+        self.assertEqual(response.status_code, 200)
+        return [product['name'] for product in response.json()['results']]
+
+    def test_uses_the_index(self):
+        self.assertTrue(search.is_indexed())
+        self.assertEqual(self.search('runn'), ['Running shoes'])
+
+    def test_follows_writes(self):
+        self.shoes.name = 'Trail boots'
+        self.shoes.save()
+        self.assertEqual(self.search('running'), [])
+        self.assertEqual(self.search('boots'), ['Trail boots'])
+        # Writes going around save() are indexed by the triggers too.
+        Product.objects.filter(id=self.socks.id).update(description='Merino wool')
+        self.assertEqual(self.search('merino'), ['Socks'])
+        self.socks.delete()
+        self.assertEqual(self.search('merino'), [])
+
+    def test_operators_are_searched_for(self):
+        self.assertEqual(self.search('wool-blend'), ['Running shoes'])
+        self.assertEqual(self.search('-blend'), ['Running shoes'])
+        self.assertEqual(self.search('"light"'), ['Running shoes'])
+        self.assertEqual(self.search('NEAR'), ['Running shoes'])
+        self.assertEqual(self.search('NEAR(shoes socks)'), [])
+        self.assertEqual(self.search('shoes OR socks'), [])
+        self.assertEqual(self.search('name:socks'), [])
+
+
+class ShoppingCartTest(TestCase):
+
+    def setUp(self):
+        self.cart = ShoppingCart.objects.create(name='Customer', address='Street')
+        self.products = [Product.objects.create(
+            name='Product {}'.format(number), description='', price=1.5)
+            for number in range(20)]
+
+    def test_totals(self):
+        for product in self.products:
+            response = self.client.post('/api/v1/carts/{}/items/'.format(self.cart.id),
+                                        {'product': product.id, 'quantity': 2},
+                                        content_type='application/json')
+            self.assertEqual(response.status_code, 201)
+        cart = self.client.get('/api/v1/carts/{}'.format(self.cart.id)).json()
+        self.assertEqual(len(cart['items']), 20)
+        self.assertEqual((cart['subtotal'], cart['taxes'], cart['total']), (60.0, 7.8, 67.8))
+
+    def test_adding_a_product_again(self):
+        url = '/api/v1/carts/{}/items/'.format(self.cart.id)
+        for quantity in (2, 3):
+            self.client.post(url, {'product': self.products[0].id, 'quantity': quantity},
+                             content_type='application/json')
+        item = self.cart.items.get()
+        self.assertEqual(item.quantity, 5)
+        self.assertEqual(item.product.stats.total_quantity, 5)
+        self.assertEqual(item.product.stats.cart_count, 1)
+
+
+class ProductExportTest(TestCase):
+
+    def setUp(self):
+        self.products = [
+            Product.objects.create(name='Plain', description='Nothing special', price=10),
+            Product.objects.create(name='Comma, "quoted"', price=2.5,
+                                   description='Two lines,\nand a comma'),
+            on_sale_product(20),
+        ]
+
+    def export(self, export_format):
+        response = self.client.get('/api/v1/export-products/',
+                                   {'export_format': export_format})
+        self.assertEqual(response.status_code, 200)
+        return b''.join(response.streaming_content).decode('utf-8')
+
+    def test_ndjson(self):
+        lines = self.export('ndjson').splitlines()
+        self.assertEqual(len(lines), 3)
+        rows = [json.loads(line) for line in lines]
+        self.assertEqual(list(rows[0]), list(export.EXPORT_FIELDS))
+        self.assertEqual(rows[1]['name'], 'Comma, "quoted"')
+        self.assertEqual(rows[1]['description'], 'Two lines,\nand a comma')
+        self.assertEqual((rows[2]['is_on_sale'], rows[2]['current_price']), (True, 18.0))
+
+    def test_csv(self):
+        rows = list(csv.reader(io.StringIO(self.export('csv'), newline='')))
+        self.assertEqual(rows[0], list(export.EXPORT_FIELDS))
+        self.assertEqual(len(rows), 4)
+        self.assertEqual(rows[2][1:3], ['Comma, "quoted"', 'Two lines,\nand a comma'])
+        self.assertEqual(rows[3][-2:], ['True', '18.0'])
+
+    def test_command(self):
+        out = io.StringIO()
+        call_command('export_products', '--on-sale', '--chunk-size', '1', stdout=out)
+        self.assertEqual([json.loads(line)['id'] for line in out.getvalue().splitlines()],
+                         [self.products[2].id])
+
+
+class ImportProductsTest(TestCase):
+
+    def setUp(self):
+        file, self.path = tempfile.mkstemp(suffix='.ndjson')
+        with os.fdopen(file, 'w') as file:
+            for number in range(5):
+                file.write(json.dumps({'name': 'Imported {}'.format(number),
+                                       'description': 'From a file',
+                                       'price': 1 + number}) + '\n')
+        self.addCleanup(os.remove, self.path)
+
+    def run_import(self):
+        call_command('import_products', self.path, '--batch-size', '2', '--workers', '0',
+                     stdout=io.StringIO(), stderr=io.StringIO())
+
+    def test_resumes_after_an_interruption(self):
+        save_products = bulk.save_products
+        calls = []
+
+        def interrupted(rows):
+            calls.append(rows)
+            if len(calls) == 2:
+                raise KeyboardInterrupt
+            return save_products(rows)
+
+        with mock.patch.object(bulk, 'save_products', interrupted):
+            with self.assertRaises(KeyboardInterrupt):
+                self.run_import()
+        # The second batch was rolled back along with its checkpoint.
+        self.assertEqual(Product.objects.count(), 2)
+        self.assertEqual(ImportCheckpoint.objects.get().rows, 2)
+
+        self.run_import()
+        self.assertEqual(sorted(Product.objects.values_list('name', flat=True)),
+                         ['Imported {}'.format(number) for number in range(5)])
+        self.assertFalse(ImportCheckpoint.objects.exists())
+
+
+class AsyncProductReadTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.products = [Product.objects.create(
+            name='Product {}'.format(number), description='', price=10 + number)
+            for number in range(5)]
+
+    def get(self, view, path, params=None, **kwargs):
+        request = AsyncRequestFactory().get(path, params)
+        return async_to_sync(view)(request, **kwargs)
+
+    def test_list_matches_the_sync_view(self):
+        params = {'limit': 3, 'fields': 'id,name,cart_items'}
+        response = self.get(async_views.product_list, '/api/v1/products/', params)
+        self.assertEqual(response.status_code, 200)
+        cache.clear()
+        expected = self.client.get('/api/v1/products/', params).json()
+        self.assertEqual(json.loads(response.content), expected)
+
+    def test_bad_price_range(self):
+        response = self.get(async_views.product_list, '/api/v1/products/',
+                            {'max_price': 'abc'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_detail(self):
+        product = self.products[0]
+        response = self.get(async_views.product_detail,
+                            '/api/v1/retrieve-update-destroy-products/{}'.format(product.id),
+                            id=product.id)
+        self.assertEqual(json.loads(response.content)['name'], 'Product 0')
+        response = self.get(async_views.product_detail,
+                            '/api/v1/retrieve-update-destroy-products/1000', id=1000)
+        self.assertEqual(response.status_code, 404)
+
+
+class ConditionalGetTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.cart = ShoppingCart.objects.create(name='Customer', address='Street')
+        self.product = Product.objects.create(name='Product', description='', price=10)
+        Product.objects.filter(id=self.product.id).update(
+            updated_at=timezone.now() - timedelta(seconds=10))
+        self.product.refresh_from_db()
+        self.url = '/api/v1/retrieve-update-destroy-products/{}'.format(self.product.id)
+        # Nothing to catch up with, and no shopping cart created or
+        # deleted for a while.
+        cache.set(outbox.POSITION_KEY, outbox.last_seq(), None)
+        cache.set(product_cache.CARTS_VERSION_KEY, 0, None)
+
+    def test_list(self):
+        response = self.client.get('/api/v1/products/')
+        response = self.client.get('/api/v1/products/', HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+
+    def test_retrieve(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.json()['name'], 'Product')
+        cached = self.client.get(self.url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(cached.status_code, 304)
+        self.assertEqual(cached.metrics.queries, 0)
+
+    def test_last_modified_is_the_product_write(self):
+        response = self.client.get(self.url)
+        last_modified = http_date(math.ceil(self.product.updated_at.timestamp()))
+        self.assertEqual(response['Last-Modified'], last_modified)
+        cached = self.client.get(self.url, HTTP_IF_MODIFIED_SINCE=last_modified)
+        self.assertEqual(cached.status_code, 304)
+
+        # 'cart_items' changed, the product itself did not.
+        ShoppingCartItem.objects.create(shopping_cart=self.cart, product=self.product,
+                                        quantity=1)
+        with mock.patch('time.time', return_value=time.time() + 2):
+            response = self.client.get(self.url, HTTP_IF_MODIFIED_SINCE=last_modified)
+        self.assertEqual(response.status_code, 200)
+        self.assertGreater(parse_http_date(response['Last-Modified']),
+                           parse_http_date(last_modified))
+
+    def test_no_last_modified_within_its_second(self):
+        self.product.name = 'Renamed'
+        self.product.save()
+        updated_at = self.product.updated_at.timestamp()
+        with mock.patch('time.time', return_value=updated_at):
+            response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('Last-Modified', response)
+        with mock.patch('time.time', return_value=math.ceil(updated_at)):
+            response = self.client.get(self.url)
+        self.assertEqual(response['Last-Modified'], http_date(math.ceil(updated_at)))
+
+
+class ProductStatsTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.carts = [ShoppingCart.objects.create(name='Customer', address='Street')
+                      for _ in range(2)]
+        self.products = [Product.objects.create(
+            name='Product {}'.format(number), description='', price=1)
+            for number in range(2)]
+
+    def totals(self):
+        return {stats.product_id: (stats.total_quantity, stats.cart_count)
+                for stats in ProductStats.objects.all()}
+
+    def assertRebuilt(self):
+        # The running totals are what rebuilding them from the items gives.
+        totals = self.totals()
+        product_stats.rebuild()
+        self.assertEqual(self.totals(), {product_id: counts for product_id, counts
+                                         in totals.items() if counts[0]})
+
+    def test_quantity_changes(self):
+        item = ShoppingCartItem.objects.create(shopping_cart=self.carts[0],
+                                               product=self.products[0], quantity=2)
+        ShoppingCartItem.objects.create(shopping_cart=self.carts[1],
+                                        product=self.products[0], quantity=1)
+        item.quantity = 5
+        item.save()
+        self.assertEqual(self.totals()[self.products[0].id], (6, 2))
+        item.delete()
+        self.assertEqual(self.totals()[self.products[0].id], (1, 1))
+        self.assertRebuilt()
+
+    def test_item_moved_to_another_product(self):
+        item = ShoppingCartItem.objects.create(shopping_cart=self.carts[0],
+                                               product=self.products[0], quantity=3)
+        item = ShoppingCartItem.objects.get(id=item.id)
+        item.product = self.products[1]
+        item.save()
+        self.assertEqual(self.totals(), {self.products[0].id: (0, 0),
+                                         self.products[1].id: (3, 1)})
+        self.assertRebuilt()
+
+    def test_cascade_deletes(self):
+        for cart in self.carts:
+            for product in self.products:
+                ShoppingCartItem.objects.create(shopping_cart=cart, product=product,
+                                                quantity=2)
+        self.carts[0].delete()
+        self.assertEqual(self.totals(), {product.id: (2, 1) for product in self.products})
+        self.products[0].delete()
+        self.assertEqual(self.totals(), {self.products[1].id: (2, 1)})
+        self.assertRebuilt()
+
+    def test_item_average_product_sold(self):
+        ShoppingCartItem.objects.create(shopping_cart=self.carts[0],
+                                        product=self.products[0], quantity=4)
+        url = '/api/v1/retrieve-update-destroy-products/{}'.format(self.products[0].id)
+        self.assertEqual(self.client.get(url).json()['average_product_sold'], 2)
+
+    def test_rebuild_command(self):
+        ShoppingCartItem.objects.create(shopping_cart=self.carts[0],
+                                        product=self.products[0], quantity=4)
+        ProductStats.objects.all().delete()
+        call_command('rebuild_product_stats', stdout=io.StringIO())
+        self.assertEqual(self.totals(), {self.products[0].id: (4, 1)})
+
+
+class SparseFieldsetsTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.products = [Product.objects.create(
+            name='Product {}'.format(number), description='', price=10 + number)
+            for number in range(30)]
+        cart = ShoppingCart.objects.create(name='Customer', address='Street')
+        for product in self.products[:10]:
+            ShoppingCartItem.objects.create(shopping_cart=cart, product=product, quantity=2)
+
+    def test_list(self):
+        response = self.client.get('/api/v1/products/', {
+            'limit': 30, 'fields': 'id,name,cart_items,average_product_sold'})
+        self.assertEqual(response.status_code, 200)
+        results = response.json()['results']
+        self.assertEqual(len(results), 30)
+        self.assertEqual(set(results[0]), {'id', 'name', 'cart_items', 'average_product_sold'})
+        self.assertEqual(results[0]['average_product_sold'], 2)
+        self.assertEqual(results[-1]['cart_items'], [])
+
+    def test_compact_by_default(self):
+        results = self.client.get('/api/v1/products/').json()['results']
+        self.assertEqual(set(results[0]), set(ProductSerializer.compact_fields))
+
+    def test_unknown_field(self):
+        response = self.client.get('/api/v1/products/', {'fields': 'id,bogus'})
+        self.assertEqual(response.status_code, 400)
+
+
+def photo(name, mode='RGB', size=(40, 30)):
+    from PIL import Image
+
+    buffer = io.BytesIO()
+    Image.new(mode, size, 'red').save(buffer, 'PNG')
+    return SimpleUploadedFile(name, buffer.getvalue(), content_type='image/png')
+
+
+@override_settings(PRODUCT_IMAGE_WORKERS=0,
+                   PRODUCT_IMAGE_VARIANTS={'thumbnail': 10, 'large': 100})
+class ProductImagesTest(TestCase):
+
+    def setUp(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        media = override_settings(MEDIA_ROOT=media_root)
+        media.enable()
+        self.addCleanup(media.disable)
+
+    def create(self, name, **kwargs):
+        with self.captureOnCommitCallbacks(execute=True):
+            product = Product.objects.create(name='Product', description='', price=1,
+                                             photo=photo(name, **kwargs))
+        product.refresh_from_db()
+        return product
+
+    def test_variants(self):
+        product = self.create('red.png')
+        self.assertFalse(images.is_stale(product))
+        variants = product.photo_variants
+        self.assertEqual((variants['source'], variants['width'], variants['height']),
+                         (product.photo.name, 40, 30))
+        thumbnail, large = variants['variants']['thumbnail'], variants['variants']['large']
+        # Never enlarged.
+        self.assertEqual((thumbnail['width'], thumbnail['height']), (10, 8))
+        self.assertEqual((large['width'], large['height']), (40, 30))
+        digest = thumbnail['webp'].split('/')[-2]
+        self.assertEqual(thumbnail['webp'], 'products/variants/{}/10.webp'.format(digest))
+        self.assertEqual(thumbnail['jpeg'], 'products/variants/{}/10.jpg'.format(digest))
+        self.assertTrue(all(default_storage.exists(path) for path in
+                            (thumbnail['webp'], thumbnail['jpeg'], large['webp'])))
+
+        urls = images.urls_for(product)
+        self.assertEqual(urls['original'], '/media/' + product.photo.name)
+        self.assertEqual(urls['thumbnail']['url'], '/media/' + thumbnail['jpeg'])
+        self.assertEqual(urls['large']['webp'], '/media/' + large['webp'])
+
+        # The same photo shares the copies.
+        other = self.create('copy.png')
+        self.assertEqual(other.photo_variants['variants'], variants['variants'])
+
+    def test_new_photo(self):
+        product = self.create('red.png')
+        product.photo = photo('transparent.png', mode='RGBA')
+        self.assertTrue(images.is_stale(product))
+        self.assertEqual(set(images.urls_for(product)), {'original'})
+        with self.captureOnCommitCallbacks(execute=True):
+            product.save()
+        product.refresh_from_db()
+        self.assertFalse(images.is_stale(product))
+        self.assertIn('png', product.photo_variants['variants']['thumbnail'])
+
+
+class ReplicaTest(TestCase):
+
+    def read_from(self, last_write, synced_at):
+        router = db.PrimaryReplicaRouter()
+        with mock.patch.object(db, 'has_replica', return_value=True), \
+                mock.patch.object(db, 'replica_synced_at', return_value=synced_at):
+            with db.replica_reads(last_write):
+                self.assertEqual(router.db_for_write(Product), 'default')
+                return router.db_for_read(Product)
+
+    def test_router(self):
+        self.assertEqual(self.read_from(last_write=100, synced_at=110), 'replica')
+        # Synced before the write, or too close to it to be sure.
+        self.assertEqual(self.read_from(last_write=100, synced_at=90), 'default')
+        self.assertEqual(self.read_from(last_write=100, synced_at=100.5), 'default')
+        # Never synced, or no idea when the last write was.
+        self.assertEqual(self.read_from(last_write=100, synced_at=None), 'default')
+        self.assertEqual(self.read_from(last_write=None, synced_at=110), 'default')
+        self.assertEqual(db.PrimaryReplicaRouter().db_for_read(Product), 'default')
+        self.assertFalse(db.PrimaryReplicaRouter().allow_migrate('replica', 'shoping_api_app'))
+
+    def test_sync_records_when(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        names = {alias: os.path.join(directory, alias + '.sqlite3')
+                 for alias in ('default', 'replica')}
+        with sqlite3.connect(names['default']) as primary:
+            primary.execute('CREATE TABLE product (name TEXT)')
+            primary.execute("INSERT INTO product VALUES ('Copied')")
+        primary.close()
+        databases = {alias: SimpleNamespace(vendor='sqlite', settings_dict={'NAME': name})
+                     for alias, name in names.items()}
+        with mock.patch.object(db, 'connections', databases):
+            self.assertIsNone(db.replica_synced_at())
+            started = time.time()
+            db.sync_replica()
+            synced_at = db.replica_synced_at()
+        self.assertTrue(started - 1 < synced_at <= time.time())
+        replica = sqlite3.connect(names['replica'])
+        self.addCleanup(replica.close)
+        self.assertEqual(replica.execute('SELECT name FROM product').fetchall(), [('Copied',)])
+
+
+class ListRebuildTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.product = Product.objects.create(name='Product', description='', price=1)
+        self.request = RequestFactory().get('/api/v1/products/')
+        self.lock_key = product_cache.LIST_LOCK_KEY.format(
+            product_cache._list_digest(self.request))
+
+    def names(self):
+        response = self.client.get('/api/v1/products/')
+        return [product['name'] for product in response.json()['results']], response
+
+    def rename(self, name):
+        self.product.name = name
+        self.product.save()
+
+    def test_stale_page_served_while_rebuilt(self):
+        self.names()
+        self.rename('Renamed')
+        # Another worker is rebuilding the page.
+        self.assertTrue(locks.acquire(self.lock_key, 10))
+        stale = product_cache.stats()['stale']
+        names, response = self.names()
+        self.assertEqual(names, ['Product'])
+        self.assertEqual(response.metrics.queries, 0)
+        self.assertEqual(product_cache.stats()['stale'], stale + 1)
+        locks.release([self.lock_key])
+        self.assertEqual(self.names()[0], ['Renamed'])
+
+    def test_wait_for_a_page_being_built(self):
+        self.assertTrue(locks.acquire(self.lock_key, 10))
+        versions = product_cache._tag_versions([product_cache.CATALOG_VERSION_KEY])
+
+        def built(seconds):
+            # The other worker is done.
+            product_cache.set_list(self.request, [self.product], {'count': 1}, versions)
+
+        with mock.patch.object(product_cache.time, 'sleep', side_effect=built) as sleep:
+            entry, versions = product_cache.get_list(self.request)
+        self.assertEqual(sleep.call_count, 1)
+        self.assertEqual(entry['data'], {'count': 1})
+        self.assertIsNone(versions)
+
+    @override_settings(PRODUCT_CACHE_LOCK_TIMEOUT=0.1)
+    def test_wait_gives_up_after_the_lock_timeout(self):
+        self.assertTrue(locks.acquire(self.lock_key, 10))
+        entry, versions = product_cache.get_list(self.request)
+        self.assertIsNone(entry)
+        self.assertIn(product_cache.CATALOG_VERSION_KEY, versions)
+
+    def test_lock_expires(self):
+        self.assertTrue(locks.acquire(self.lock_key, 10))
+        self.assertFalse(locks.acquire(self.lock_key, 10))
+        with mock.patch('time.time', return_value=time.time() + 11):
+            self.assertTrue(locks.acquire(self.lock_key, 10))
+
+    def test_lock_released_on_failure(self):
+        with mock.patch.object(ProductList, 'paginate_queryset', side_effect=RuntimeError):
+            with self.assertRaises(RuntimeError):
+                self.client.get('/api/v1/products/')
+        self.assertTrue(locks.acquire(self.lock_key, 10))
+
+
+@override_settings(CACHES={'default': {
+    'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+    'LOCATION': os.path.join(tempfile.gettempdir(), 'shoping_api_app_test_cache'),
+}})
+class CacheLockTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+
+    def test_locks_in_the_database(self):
+        self.assertTrue(locks.in_database())
+        self.assertTrue(locks.acquire('key', 10))
+        self.assertFalse(locks.acquire('key', 10))
+        self.assertTrue(locks.acquire('other', 10))
+        self.assertEqual(CacheLock.objects.count(), 2)
+        locks.release(['key', 'other'])
+        self.assertFalse(CacheLock.objects.exists())
+        self.assertTrue(locks.acquire('key', 10))
+
+    def test_expired_lock_taken_over(self):
+        self.assertTrue(locks.acquire('key', 10))
+        later = timezone.now() + timedelta(seconds=11)
+        with mock.patch.object(locks.timezone, 'now', return_value=later):
+            self.assertTrue(locks.acquire('key', 10))
+        self.assertEqual(CacheLock.objects.get().expires, later + timedelta(seconds=10))
+
+    def test_list_rebuilt_once(self):
+        Product.objects.create(name='Product', description='', price=1)
+        self.assertEqual(self.client.get('/api/v1/products/').json()['count'], 1)
+        self.assertFalse(CacheLock.objects.exists())
+        self.assertEqual(self.client.get('/api/v1/products/').metrics.queries, 0)
+
+
+class ProductBatchTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.products = [Product.objects.create(
+            name='Product {}'.format(number), description='', price=10 + number)
+            for number in range(30)]
+
+    def test_batch(self):
+        ids = [product.id for product in self.products] + [1000]
+        response = self.client.get('/api/v1/batch-products/',
+                                   {'ids': ','.join(map(str, ids))})
+        self.assertEqual(len(response.json()['results']), 30)
+        self.assertEqual(response.json()['missing'], [1000])
+
+    def test_order_and_fields(self):
+        # One from the cache, the other from the database.
+        self.client.get('/api/v1/retrieve-update-destroy-products/{}'.format(
+            self.products[0].id))
+        ids = '{},{}'.format(self.products[1].id, self.products[0].id)
+        response = self.client.get('/api/v1/batch-products/', {'ids': ids, 'fields': 'id,name'})
+        self.assertEqual(response.json()['results'], [
+            {'id': self.products[1].id, 'name': 'Product 1'},
+            {'id': self.products[0].id, 'name': 'Product 0'},
+        ])
+
+    def test_bad_ids(self):
+        for ids in ('', '1,x'):
+            response = self.client.get('/api/v1/batch-products/', {'ids': ids})
+            self.assertEqual(response.status_code, 400)
+
+
+class EffectivePriceTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.cheap = Product.objects.create(name='Cheap', description='', price=5)
+        self.dear = Product.objects.create(name='Dear', description='', price=20)
+        self.sale = on_sale_product(10)
+
+    def names(self, params):
+        response = self.client.get('/api/v1/products/', params)
+        self.assertEqual(response.status_code, 200)
+        return [product['name'] for product in response.json()['results']]
+
+    def test_price_range(self):
+        # 10 on sale is 9.
+        self.assertEqual(self.names({'min_price': 8, 'max_price': 9}), ['On sale'])
+        self.assertEqual(self.names({'min_price': 9.5}), ['Dear'])
+
+    def test_ordering(self):
+        self.assertEqual(self.names({'ordering': '-current_price'}),
+                         ['Dear', 'On sale', 'Cheap'])
+
+    def test_bad_price_range(self):
+        for params in ({'min_price': 'abc'}, {'max_price': 'nan'}, {'max_price': 'inf'}):
+            response = self.client.get('/api/v1/products/', params)
+            self.assertEqual(response.status_code, 400)
+
+    def test_refresh_at_a_sale_start(self):
+        start = timezone.now() + timedelta(hours=1)
+        Product.objects.filter(id=self.dear.id).update(sale_start=start)
+        self.assertEqual(prices.refresh(since=start - timedelta(minutes=1),
+                                        now=start - timedelta(seconds=1)), [])
+        self.assertEqual(prices.refresh(since=start - timedelta(minutes=1), now=start),
+                         [self.dear.id])
+        self.dear.refresh_from_db()
+        self.assertEqual(self.dear.effective_price, 18)
+
+
+@override_settings(PRODUCT_CHANGES_POLL_INTERVAL=0)
+class ProductChangesTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.products = [Product.objects.create(
+            name='Product {}'.format(number), description='', price=1)
+            for number in range(3)]
+        self.carts = [ShoppingCart.objects.create(name='Customer', address='Street')
+                      for _ in range(2)]
+        for cart in self.carts:
+            for product in self.products:
+                ShoppingCartItem.objects.create(shopping_cart=cart, product=product, quantity=1)
+        self.url = '/api/v1/retrieve-update-destroy-products/{}'.format(self.products[0].id)
+
+    def recorded(self, write):
+        seq = outbox.last_seq()
+        write()
+        return sorted(ProductChange.objects.filter(seq__gt=seq).values_list(
+            'product_id', flat=True), key=str)
+
+    def test_deletes_record_their_own_change(self):
+        # Not one more per cart item going with them.
+        self.assertEqual(self.recorded(lambda: bulk.delete_products([self.products[0].id])),
+                         [self.products[0].id])
+        self.assertEqual(self.recorded(lambda: ShoppingCart.objects.all().delete()),
+                         [None, None])
+        self.assertEqual(self.recorded(lambda: self.carts[0].items.all().delete()), [])
+
+    def test_consume(self):
+        # No position yet: everything is evicted, from the last change on.
+        self.assertEqual(outbox.consume(), 0)
+        self.assertEqual(cache.get(outbox.POSITION_KEY), outbox.last_seq())
+
+        self.client.get(self.url)
+        key = product_cache.PRODUCT_KEY.format(self.products[0].id)
+        self.assertIsNotNone(cache.get(key))
+        outbox.record([self.products[0].id])
+        self.assertEqual(outbox.consume(), 1)
+        self.assertIsNone(cache.get(key))
+        self.assertEqual(outbox.consume(), 0)
+
+        carts = cache.get(product_cache.CARTS_VERSION_KEY)
+        outbox.record_all()
+        self.assertEqual(outbox.consume(), 1)
+        self.assertNotEqual(cache.get(product_cache.CARTS_VERSION_KEY), carts)
+
+    def test_prune(self):
+        outbox.consume()
+        outbox.record([self.products[0].id])
+        outbox.record([self.products[1].id])
+        count = ProductChange.objects.count()
+        # The last change is kept, to tell how far they were pruned.
+        self.assertEqual(outbox.prune(timezone.now() + timedelta(seconds=1)), count - 1)
+        changes, pruned = outbox.changes_since(0)
+        self.assertTrue(pruned)
+        self.assertEqual(outbox.consume(), 0)
+        self.assertEqual(cache.get(outbox.POSITION_KEY), outbox.last_seq())
+
+    def test_middleware_applies_other_processes_changes(self):
+        self.assertEqual(self.client.get(self.url).json()['name'], 'Product 0')
+        # Another process renames the product: its own cache is evicted,
+        # this one only hears of it through the change feed.
+        with transaction.atomic():
+            Product.objects.filter(id=self.products[0].id).update(name='Renamed')
+            outbox.record([self.products[0].id])
+        self.assertEqual(self.client.get(self.url).json()['name'], 'Renamed')
+
+
+class GuestCartTest(TestCase):
+
+    def setUp(self):
+        cache.set(outbox.POSITION_KEY, outbox.last_seq(), None)
+        self.products = [Product.objects.create(
+            name='Product {}'.format(number), description='', price=10)
+            for number in range(2)]
+        self.token = self.client.post('/api/v1/guest-carts/').json()['token']
+        self.url = '/api/v1/guest-carts/{}'.format(self.token)
+
+    def add(self, product, quantity=1):
+        return self.client.post(self.url + '/items/',
+                                {'product': product.id, 'quantity': quantity},
+                                content_type='application/json')
+
+    def checkout(self):
+        return self.client.post(self.url + '/checkout',
+                                {'name': 'Guest', 'address': 'Street'},
+                                content_type='application/json')
+
+    def test_outlive_the_default_cache(self):
+        self.add(self.products[0], 2)
+        cache.clear()
+        self.assertEqual(self.client.get(self.url).json()['items'],
+                         [{'product': self.products[0].id, 'quantity': 2}])
+
+    def test_changes_wait_for_one_another(self):
+        # A second add made while the first one has the cart waits for it
+        # rather than saving the cart as it was before the first one.
+        get = guest_carts.get
+        during = []
+
+        def get_and_add(token):
+            cart = get(token)
+            if not during:
+                during.append(self.add(self.products[1]))
+            return cart
+
+        with mock.patch.object(guest_carts, 'LOCK_WAIT', 0.05), \
+                mock.patch.object(guest_carts, 'get', get_and_add):
+            self.assertEqual(self.add(self.products[0]).status_code, 201)
+        self.assertEqual(during[0].status_code, 409)
+        self.assertEqual(self.add(self.products[1]).status_code, 201)
+        self.assertEqual(self.client.get(self.url).json()['items'], [
+            {'product': self.products[0].id, 'quantity': 1},
+            {'product': self.products[1].id, 'quantity': 1},
+        ])
+
+    @override_settings(GUEST_CART_DEFERRED_CHECKOUT=True)
+    def test_deferred_checkout(self):
+        self.add(self.products[0], 2)
+        response = self.checkout()
+        self.assertEqual(response.status_code, 202)
+        self.assertTrue(response.json()['checked_out'])
+        self.assertFalse(ShoppingCart.objects.exists())
+        self.assertEqual(self.add(self.products[1]).status_code, 400)
+
+        self.assertEqual(guest_carts.flush_queued(), 1)
+        shopping_cart = ShoppingCart.objects.get()
+        self.assertEqual((shopping_cart.name, shopping_cart.address), ('Guest', 'Street'))
+        self.assertEqual(list(shopping_cart.items.values_list('product_id', 'quantity')),
+                         [(self.products[0].id, 2)])
+        self.assertEqual(self.client.get(self.url).json(),
+                         {'token': self.token, 'shopping_cart': shopping_cart.id})
+        self.assertEqual(guest_carts.flush_queued(), 0)
+
+    @override_settings(GUEST_CART_DEFERRED_CHECKOUT=True)
+    def test_flush_queued_leaves_locked_carts_queued(self):
+        self.add(self.products[0])
+        self.checkout()
+        key = guest_carts.LOCK_KEY.format(self.token)
+        locks.acquire(key, 10, using=guest_carts.get_cache_alias())
+        self.assertEqual(guest_carts.flush_queued(), 0)
+        self.assertFalse(ShoppingCart.objects.exists())
+
+        locks.release([key], using=guest_carts.get_cache_alias())
+        call_command('flush_guest_carts', stdout=io.StringIO())
+        self.assertEqual(ShoppingCart.objects.count(), 1)
+
+    def test_expiry(self):
+        self.add(self.products[0])
+        expired = timezone.now() + timedelta(seconds=guest_carts.get_timeout() + 1)
+        with mock.patch('django.core.cache.backends.db.tz_now', return_value=expired):
+            self.assertEqual(self.client.get(self.url).status_code, 404)
+            self.assertEqual(self.add(self.products[0]).status_code, 404)
+
+    def test_cache_only_deletes_expired_entries(self):
+        backend = NonCullingDatabaseCache('guest_carts_cache', {'OPTIONS': {'MAX_ENTRIES': 2}})
+        backend.clear()
+        backend.set('expiring', True, 1)
+        later = timezone.now() + timedelta(seconds=5)
+        with mock.patch('django.core.cache.backends.db.tz_now', return_value=later):
+            for key in 'abcd':
+                backend.set(key, True, 60)
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT cache_key FROM guest_carts_cache')
+            self.assertEqual(sorted(row[0] for row in cursor.fetchall()),
+                             [backend.make_key(key) for key in 'abcd'])
+
+
+class CatalogStatsTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.products = [Product.objects.create(
+            name='Product {}'.format(number), description='', price=number)
+            for number in range(1, 31)]
+
+    def cached_stats(self, params):
+        request = RequestFactory().get('/api/v1/catalog-stats/', params)
+        return cache.get(product_cache.STATS_KEY.format(product_cache._list_digest(request)))
+
+    def test_stats(self):
+        response = self.client.get('/api/v1/catalog-stats/', {'buckets': 3, 'fields': 'bogus'})
+        self.assertEqual(response.status_code, 200)
+        stats = response.json()
+        self.assertEqual(stats['count'], 30)
+        self.assertEqual([bucket['count'] for bucket in stats['histogram']], [10, 10, 10])
+
+    def test_filtered_stats_expire_at_the_next_sale_start(self):
+        product = self.products[-1]
+        product.sale_start = timezone.now() + timedelta(seconds=30)
+        product.save()
+        for params in ({'on_sale': 'true'}, {'max_price': '12'}):
+            self.client.get('/api/v1/catalog-stats/', params)
+            self.assertLessEqual(self.cached_stats(params)['expires'], time.time() + 30)
@@ -1,20 +1,63 @@
-from django.shortcuts import render
+import math
+
+from django.conf import settings
+from django.shortcuts import get_object_or_404, render
 
 from .models import Product, ShoppingCart
 
 
+MAX_PAGE = 10 ** 9
+
+
+def get_fragment_timeout():
+    return getattr(settings, 'STOREFRONT_FRAGMENT_TIMEOUT', 3600)
+
+
+def _page_of_products(page, page_size):
+    offset = (page - 1) * page_size
+    # Only what the product cards show, and 'updated_at' for their
+    # cached fragments.
+    return list(Product.objects.order_by('id').only(
+        'id', 'name', 'photo', 'photo_variants', 'updated_at'
+    )[offset:offset + page_size + 1])
+
+
 def index(request):
+    '''
+    A page of products, STOREFRONT_PAGE_SIZE of them in id order. One
+    more product than shown is fetched to know whether there is a next
+    page, so no page has to count the whole catalog. Pages past the end
+    show the last one.
+    '''
+    page_size = getattr(settings, 'STOREFRONT_PAGE_SIZE', 24)
+    try:
+        # Bounded for the offset to fit in SQLite's integers.
+        page = min(max(int(request.GET.get('page', 1)), 1), MAX_PAGE)
+    except ValueError:
+        page = 1
+    products = _page_of_products(page, page_size)
+    if not products and page > 1:
+        # Only then is the catalog counted.
+        page = max(math.ceil(Product.objects.count() / page_size), 1)
+        products = _page_of_products(page, page_size)
     context = {
-        'products': Product.objects.all(),
+        'products': products[:page_size],
+        'page': page,
+        'previous_page': page - 1 if page > 1 else None,
+        'next_page': page + 1 if len(products) > page_size else None,
+        'fragment_timeout': get_fragment_timeout(),
     }
-    return render(request, 'store/product_list.html', context)
+    return render(request, 'shoping_api_app/product_list.html', context)
 
 
 def show(request, id):
+    product = get_object_or_404(Product.objects.only(
+        'id', 'name', 'description', 'price', 'sale_start', 'sale_end', 'updated_at'), id=id)
     context = {
-        'product': Product.objects.get(id=id),
+        'product': product,
+        'fragment_timeout': get_fragment_timeout(),
     }
-    return render(request, 'store/product.html', context)
+    return render(request, 'shoping_api_app/product.html', context)
 
 
 def cart(request):
@@ -25,4 +68,4 @@ def cart(request):
         'tax_total': 2.0,
         'total': 3.0,
     }
-    return render(request, 'store/cart.html', context)
+    return render(request, 'shoping_api_app/cart.html', context)
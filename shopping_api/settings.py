@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/4.0/ref/settings/
 """
 
+import os
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -43,6 +44,10 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    # Before the metrics, its occasional query is not the request's.
+    'shoping_api_app.outbox.ProductChangesMiddleware',
+    # First after it, so that it measures everything below it.
+    'shoping_api_app.metrics.RequestMetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -63,6 +68,7 @@ TEMPLATES = [
             'context_processors': [
                 'django.template.context_processors.debug',
                 'django.template.context_processors.request',
+                'django.template.context_processors.media',
                 'django.contrib.auth.context_processors.auth',
                 'django.contrib.messages.context_processors.messages',
             ],
@@ -76,11 +82,139 @@ WSGI_APPLICATION = 'shopping_api.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/4.0/ref/settings/#databases
 
+# The database file can be moved with DATABASE_PATH. Connections are kept
+# open for DATABASE_CONN_MAX_AGE seconds (0 to close them after every
+# request) and checked before being reused.
+DATABASE = {
+    'ENGINE': 'django.db.backends.sqlite3',
+    'NAME': os.environ.get('DATABASE_PATH', BASE_DIR / 'db.sqlite3'),
+    'CONN_MAX_AGE': int(os.environ.get('DATABASE_CONN_MAX_AGE', 60)),
+    'CONN_HEALTH_CHECKS': True,
+}
+
 DATABASES = {
-    'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
+    'default': DATABASE,
+}
+
+# With DATABASE_REPLICA_PATH set, the product list and detail reads go to
+# that copy of the database (see shoping_api_app/db.py), kept up to date
+# with 'manage.py sync_replica'. Tests read it from the test database.
+if os.environ.get('DATABASE_REPLICA_PATH'):
+    DATABASES['replica'] = {
+        **DATABASE,
+        'NAME': os.environ['DATABASE_REPLICA_PATH'],
+        'TEST': {'MIRROR': 'default'},
     }
+
+DATABASE_ROUTERS = ['shoping_api_app.db.PrimaryReplicaRouter']
+
+# The product reads go to the replica only once it was synced more than
+# this many seconds after the last change to the catalog (the longest a
+# write transaction takes to commit).
+DATABASE_REPLICA_LAG = 1
+
+# Run on every new SQLite connection. WAL lets the readers go on while
+# a write is made, and only needs syncing to disk at checkpoints; writers
+# wait for each other up to busy_timeout (milliseconds) rather than fail
+# with 'database is locked'; mmap_size (bytes) of the file is read
+# through memory mapping instead of read() calls; the page cache holds
+# 20 MB (KiB when negative) and temporary tables stay in memory.
+SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'busy_timeout': 5000,
+    'mmap_size': 256 * 1024 * 1024,
+    'cache_size': -20000,
+    'temp_store': 'MEMORY',
+}
+
+
+# Cache
+# https://docs.djangoproject.com/en/4.0/topics/cache/
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'TIMEOUT': 300,
+        'OPTIONS': {
+            # Least recently used entries are culled past this size.
+            'MAX_ENTRIES': 10000,
+        },
+    },
+    # Guest carts (see shoping_api_app/guest_carts.py) and their locks.
+    # Unlike 'default' this cache has to be shared by every process and
+    # must never cull a cart that did not expire: the database one below
+    # only deletes expired carts (once it holds MAX_ENTRIES rows), and
+    # needs its table made once with 'manage.py createcachetable'. Redis
+    # with 'maxmemory-policy noeviction' does as well.
+    'guest_carts': {
+        'BACKEND': 'shoping_api_app.cache_backends.NonCullingDatabaseCache',
+        'LOCATION': 'guest_carts_cache',
+        'OPTIONS': {
+            'MAX_ENTRIES': 10000,
+        },
+    },
+}
+
+# Serve the product list and detail reads with the async views (for
+# deployments running under ASGI), set ASYNC_PRODUCT_READS=1 to turn on.
+ASYNC_PRODUCT_READS = os.environ.get('ASYNC_PRODUCT_READS') == '1'
+
+# Seconds a serialized product or ProductList page is kept in the cache.
+PRODUCT_CACHE_TIMEOUT = 300
+
+# Seconds a ProductList page is still served past its timeout or a
+# change, while a single worker rebuilds it, and seconds that worker
+# has for it before another one takes over.
+PRODUCT_CACHE_STALE_TIMEOUT = 60
+PRODUCT_CACHE_LOCK_TIMEOUT = 10
+
+# Every process applies the changes made by the others to its product
+# cache at most every PRODUCT_CHANGES_POLL_INTERVAL seconds, and 'manage.py
+# consume_product_changes' prunes those older than
+# PRODUCT_CHANGES_RETENTION seconds (see shoping_api_app/outbox.py).
+PRODUCT_CHANGES_POLL_INTERVAL = 1
+PRODUCT_CHANGES_RETENTION = 24 * 60 * 60
+
+# Guest carts live in the GUEST_CART_CACHE cache (see CACHES above and
+# shoping_api_app/guest_carts.py) and expire GUEST_CART_TIMEOUT seconds after their last change unless checked
+# out. With GUEST_CART_DEFERRED_CHECKOUT=1, checkouts are queued and
+# written in batches by 'manage.py flush_guest_carts' instead of right away.
+GUEST_CART_CACHE = 'guest_carts'
+GUEST_CART_TIMEOUT = 3 * 24 * 60 * 60
+GUEST_CART_DEFERRED_CHECKOUT = os.environ.get('GUEST_CART_DEFERRED_CHECKOUT') == '1'
+
+# Most products the batch endpoint reads in one request.
+PRODUCT_BATCH_MAX_IDS = 200
+
+# Number of products written per transaction by the bulk endpoint.
+PRODUCT_BULK_BATCH_SIZE = 500
+
+# Number of products read from the database at a time when exporting.
+PRODUCT_EXPORT_CHUNK_SIZE = 2000
+
+# Number of products per page of the HTML storefront, and seconds its
+# rendered product cards and details are cached for (they are cached per
+# product version, an update renders them afresh).
+STOREFRONT_PAGE_SIZE = 24
+STOREFRONT_FRAGMENT_TIMEOUT = 3600
+
+
+# Django REST framework
+# https://www.django-rest-framework.org/api-guide/settings/
+
+# JSON goes through orjson when it is installed (see renderers.py and
+# parsers.py), through the json module otherwise.
+REST_FRAMEWORK = {
+    'DEFAULT_RENDERER_CLASSES': (
+        'shoping_api_app.renderers.FastJSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ),
+    'DEFAULT_PARSER_CLASSES': (
+        'shoping_api_app.parsers.FastJSONParser',
+        'rest_framework.parsers.FormParser',
+        'rest_framework.parsers.MultiPartParser',
+    ),
 }
 
 
@@ -120,6 +254,25 @@ USE_TZ = True
 
 STATIC_URL = 'static/'
 
+# Uploaded files (product photos and their resized copies)
+
+MEDIA_URL = 'media/'
+MEDIA_ROOT = BASE_DIR / 'media'
+
+# Widths in pixels of the resized copies of product photos, made as WebP
+# and JPEG (see shoping_api_app/images.py). Their URLs change with their
+# content: wherever media is served from, they can be cached for good.
+PRODUCT_IMAGE_VARIANTS = {
+    'thumbnail': 160,
+    'small': 320,
+    'medium': 640,
+    'large': 1280,
+}
+
+# Number of processes resizing photos in the background, 0 for resizing
+# them in the request instead.
+PRODUCT_IMAGE_WORKERS = 2
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/4.0/ref/settings/#default-auto-field
 
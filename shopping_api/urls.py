@@ -3,23 +3,82 @@ from django.conf.urls.static import static
 from django.contrib import admin
 from django.urls import path
 
-from shoping_api_app import views, api_views
+from shoping_api_app import views, api_views, async_views, images, metrics
+
+
+# The product reads are served by the async views under ASGI deployments
+# that ask for it (see ASYNC_PRODUCT_READS in settings).
+if settings.ASYNC_PRODUCT_READS:
+    product_list_view = async_views.product_list
+    product_detail_view = async_views.product_detail
+else:
+    product_list_view = api_views.ProductList.as_view()
+    product_detail_view = api_views.ProductRetrieveUpdateDestroy.as_view()
 
 
 urlpatterns = [
 
     path('admin/', admin.site.urls),
+    path('metrics', metrics.metrics_view, name='metrics'),
     path('products/<int:id>/', views.show, name='show-product'),
     path('cart/', views.cart, name='shopping-cart'),
     path('', views.index, name='list-products'),
 
-    path('api/v1/products/', api_views.ProductList.as_view(),
+    path('api/v1/products/', product_list_view,
          name='listing-all-products'),
     path('api/v1/create-products/',
          api_views.ProductCreate.as_view(),
          name='creating-products'),
     path('api/v1/retrieve-update-destroy-products/<int:id>',
-         api_views.ProductRetrieveUpdateDestroy.as_view(),
+         product_detail_view,
          name='retrieving-updating-deleting-products'),
+    path('api/v1/catalog-stats/',
+         api_views.CatalogStats.as_view(),
+         name='catalog-stats'),
+    path('api/v1/top-selling-products/',
+         api_views.TopSellers.as_view(),
+         name='listing-top-selling-products'),
+    path('api/v1/batch-products/',
+         api_views.ProductBatch.as_view(),
+         name='batch-retrieving-products'),
+    path('api/v1/bulk-products/',
+         api_views.ProductBulk.as_view(),
+         name='bulk-writing-products'),
+    path('api/v1/export-products/',
+         api_views.ProductExport.as_view(),
+         name='exporting-products'),
+    path('api/v1/carts/',
+         api_views.ShoppingCartCreate.as_view(),
+         name='creating-shopping-carts'),
+    path('api/v1/carts/<int:id>',
+         api_views.ShoppingCartRetrieve.as_view(),
+         name='retrieving-shopping-carts'),
+    path('api/v1/carts/<int:id>/items/',
+         api_views.ShoppingCartItemCreate.as_view(),
+         name='adding-shopping-cart-items'),
+    path('api/v1/carts/<int:id>/items/<int:item_id>',
+         api_views.ShoppingCartItemUpdateDestroy.as_view(),
+         name='updating-removing-shopping-cart-items'),
+    path('api/v1/product-changes/',
+         api_views.ProductChanges.as_view(),
+         name='listing-product-changes'),
+    path('api/v1/guest-carts/',
+         api_views.GuestCartCreate.as_view(),
+         name='creating-guest-carts'),
+    path('api/v1/guest-carts/<str:token>',
+         api_views.GuestCartRetrieve.as_view(),
+         name='retrieving-guest-carts'),
+    path('api/v1/guest-carts/<str:token>/items/',
+         api_views.GuestCartItemCreate.as_view(),
+         name='adding-guest-cart-items'),
+    path('api/v1/guest-carts/<str:token>/items/<int:product_id>',
+         api_views.GuestCartItemUpdateDestroy.as_view(),
+         name='updating-removing-guest-cart-items'),
+    path('api/v1/guest-carts/<str:token>/checkout',
+         api_views.GuestCartCheckout.as_view(),
+         name='checking-out-guest-carts'),
+    path('api/v1/product-cache-stats/',
+         api_views.ProductCacheStats.as_view(),
+         name='product-cache-stats'),
 
-] + static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
+] + static(settings.MEDIA_URL, view=images.serve, document_root=settings.MEDIA_ROOT)